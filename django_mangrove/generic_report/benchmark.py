@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Benchmark of the data grid pipeline: a synthetic report is generated
+    with a given number of records, stored indicators, levels of nested
+    calculated indicators and areas, then the data grid of a view is
+    computed stage by stage for each kind of aggregation.
+
+    Each stage gives its wall time, its number of SQL queries and how
+    much it raised the peak memory of the process, as a dict that can be
+    dumped as JSON to compare runs (see the 'benchmark_grid' command).
+
+    Run it on a test database: it creates reports, areas and attributes.
+"""
+
+import gc
+import time
+import random
+import resource
+import platform
+from datetime import datetime, timedelta
+
+import django
+from django.conf import settings
+from django.db import connection, reset_queries, transaction
+
+from eav.models import Attribute
+from simple_locations.models import Area, AreaType
+
+from generic_report import conf
+from generic_report.models import (Report, ReportView, Record, Indicator,
+                                   Aggregator, ValueIndicator, DateIndicator,
+                                   LocationIndicator, SumIndicator,
+                                   RatioIndicator, AverageIndicator,
+                                   DateAggregator, LocationAggregator,
+                                   ValueAggregator)
+from generic_report.engine import RecordLoader, LRUCache, grid_cache
+
+
+AGGREGATIONS = ('none', 'date', 'location', 'value')
+
+# calculated indicators are nested by using these types in turn
+CALCULATED_TYPES = (SumIndicator, RatioIndicator, AverageIndicator)
+
+STAGES = ('plan', 'load', 'evaluate', 'aggregate', 'finalize', 'format')
+
+
+def get_peak_memory():
+    """
+        Return the peak resident memory of the process, in kilobytes on
+        Linux.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(func, *args, **kwargs):
+    """
+        Call the function and return its result with a dict giving the
+        wall time in seconds, the number of SQL queries and how much the
+        peak memory of the process grew during the call.
+
+        Queries are counted only if settings.DEBUG is True.
+    """
+    gc.collect()
+    reset_queries()
+    peak_memory = get_peak_memory()
+    start = time.time()
+    result = func(*args, **kwargs)
+    stats = {'time': time.time() - start,
+             'queries': len(connection.queries),
+             'peak_memory_growth': get_peak_memory() - peak_memory}
+    return result, stats
+
+
+
+class SyntheticReport(object):
+    """
+        Report with generated areas, indicators and records.
+
+        There are 'values' stored integer indicators, a kind, a date and a
+        place, plus 'depth' calculated indicators, each one using the
+        previous one as first parameter. Places are villages in
+        'districts' districts of 'villages' villages each, in one country.
+
+        The same seed generates the same records.
+    """
+
+
+    def __init__(self, records=1000, values=4, depth=3, districts=5,
+                 villages=10, seed=0):
+        self.record_count = records
+        self.value_count = max(values, 1)
+        self.depth = depth
+        self.district_count = districts
+        self.village_count = villages
+        self.random = random.Random(seed)
+
+        self.report = None
+        self.villages = []
+        self.values = []
+        self.calculated = []
+
+
+    def get_parameters(self):
+        return {'records': self.record_count, 'values': self.value_count,
+                'depth': self.depth, 'districts': self.district_count,
+                'villages': self.village_count}
+
+
+    def build(self):
+        """
+            Create the report, its indicators and its records.
+        """
+        self.report = Report.objects.create(name='Benchmark %s' %
+                                            Report.objects.count())
+        self.create_areas()
+        self.create_indicators()
+        self.create_records()
+        return self.report
+
+
+    def create_areas(self):
+        self.country_type = AreaType.objects.create(name='Country')
+        self.district_type = AreaType.objects.create(name='District')
+        self.village_type = AreaType.objects.create(name='Village')
+
+        country = Area.objects.create(name='Country', code='country',
+                                      kind=self.country_type)
+        for i in range(self.district_count):
+            district = Area.objects.create(name='District %s' % i,
+                                           code='district%s' % i,
+                                           kind=self.district_type,
+                                           parent=country)
+            for j in range(self.village_count):
+                village = Area.objects.create(name='Village %s %s' % (i, j),
+                                              code='village%s_%s' % (i, j),
+                                              kind=self.village_type,
+                                              parent=district)
+                self.villages.append(village)
+
+
+    def create_indicator(self, name, datatype=Attribute.TYPE_INT,
+                         indicator_type=ValueIndicator, args=(), kwargs=None):
+        indicator = Indicator.create_with_attribute(name, datatype,
+                                                    indicator_type, args,
+                                                    kwargs)
+        self.report.indicators.add(indicator)
+        return indicator
+
+
+    def create_indicators(self):
+        for i in range(self.value_count):
+            self.values.append(self.create_indicator('Value %s' % i))
+        self.kind = self.create_indicator('Kind')
+        self.date = self.create_indicator('Date', Attribute.TYPE_DATE,
+                                          DateIndicator)
+        self.place = self.create_indicator('Place', Attribute.TYPE_OBJECT,
+                                     LocationIndicator,
+                                     kwargs={'area_type': self.village_type})
+
+        previous = self.values[0]
+        for level in range(self.depth):
+            indicator_type = CALCULATED_TYPES[level % len(CALCULATED_TYPES)]
+            operand = self.values[(level + 1) % self.value_count]
+            # ratios take their operands as fields, not as parameters
+            if indicator_type is RatioIndicator:
+                args = ()
+                kwargs = {'numerator': previous, 'denominator': operand}
+            else:
+                args, kwargs = (previous, operand), None
+            previous = self.create_indicator('Calculated %s' % (level + 1),
+                                             Attribute.TYPE_FLOAT,
+                                             indicator_type, args, kwargs)
+            self.calculated.append(previous)
+
+
+    def generate_data(self):
+        """
+            Return the data of a record, mapping slugs to values.
+        """
+        start = datetime(2010, 1, 1)
+        data = {self.kind.concept.slug: self.random.randint(1, 5),
+                self.date.concept.slug: start + timedelta(
+                                            days=self.random.randint(0, 364)),
+                self.place.concept.slug: self.random.choice(self.villages)}
+        for indicator in self.values:
+            # no zero, ratios would have nothing to divide by
+            data[indicator.concept.slug] = self.random.randint(1, 100)
+        return data
+
+
+    def create_records(self):
+        data_list = [self.generate_data() for i in range(self.record_count)]
+        Record.create_in_bulk(self.report, data_list)
+
+
+    def create_view(self, aggregation):
+        """
+            Create a view of the report showing all its indicators, grouped
+            by the given aggregation (one of AGGREGATIONS).
+        """
+        view = ReportView.create_from_report(self.report, name=aggregation)
+        if aggregation == 'date':
+            Aggregator.objects.create(view=view, indicator=self.date,
+                       strategy=DateAggregator.objects.create(time_period='month'))
+        elif aggregation == 'location':
+            Aggregator.objects.create(view=view, indicator=self.place,
+                       strategy=LocationAggregator.objects.create(
+                                                area_type=self.district_type))
+        elif aggregation == 'value':
+            Aggregator.objects.create(view=view, indicator=self.kind,
+                                      strategy=ValueAggregator.objects.create())
+        return view
+
+
+
+def _load_plan(view):
+    indicators = view.get_demanded_indicators()
+    return (indicators, view.get_evaluation_plan(indicators),
+            view.get_evaluation_plan(indicators, aggregated=True))
+
+
+def run_stages(view, engine=None):
+    """
+        Compute the data grid of the view without any cache, one stage
+        after the other. Return the formated grid and the stats of each
+        stage (see measure()).
+    """
+    grid_cache.backend.clear()
+    view = ReportView.objects.get(pk=view.pk)
+    stats = {}
+
+    (indicators, plan, aggregated_plan), stats['plan'] = measure(_load_plan,
+                                                                 view)
+    records = view.report.records.all()
+    rows, stats['load'] = measure(RecordLoader(indicators).get_rows, records)
+    grid, stats['evaluate'] = measure(plan.update_grid, rows.values(),
+                                      engine or conf.GRID_ENGINE)
+    state, stats['aggregate'] = measure(view._create_grid_state_from_rows,
+                                        rows, indicators)
+    grid, stats['finalize'] = measure(state.get_grid, aggregated_plan)
+    grid, stats['format'] = measure(view._format_data_grid, grid)
+    return grid, stats
+
+
+def run_pipeline(view, method, *args, **kwargs):
+    """
+        Call this method of a new copy of the view, without any cache, and
+        return its result and its stats.
+    """
+    grid_cache.backend.clear()
+    view = ReportView.objects.get(pk=view.pk)
+    return measure(getattr(view, method), *args, **kwargs)
+
+
+def get_best(runs):
+    """
+        Merge the stats of several runs of the same thing, keeping the
+        shortest time, and the most queries and memory.
+    """
+    best = dict(runs[0])
+    for stats in runs[1:]:
+        best['time'] = min(best['time'], stats['time'])
+        best['queries'] = max(best['queries'], stats['queries'])
+        best['peak_memory_growth'] = max(best['peak_memory_growth'],
+                                         stats['peak_memory_growth'])
+    return best
+
+
+def benchmark_view(view, engine=None, workers=(1,), repeat=1):
+    """
+        Return the stats of the data grid of the view: for each stage, for
+        the whole pipeline, for the aggregation by the database if the view
+        allows it, and for the parallel computation with each number of
+        workers, with its speedup compared to one worker.
+    """
+    engine = engine or conf.GRID_ENGINE
+    result = {'view': view.name, 'stages': []}
+
+    runs = [run_stages(view, engine) for i in range(repeat)]
+    result['groups'] = len(runs[0][0])
+    for name in STAGES:
+        stage = get_best([stats[name] for grid, stats in runs])
+        stage['stage'] = name
+        result['stages'].append(stage)
+
+    runs = [run_pipeline(view, '_compute_data_grid', engine, workers=1)
+            for i in range(repeat)]
+    result['total'] = get_best([stats for grid, stats in runs])
+
+    state, stats = run_pipeline(view, '_create_grid_state_in_db')
+    if state is None:
+        result['sql_aggregation'] = None
+    else:
+        runs = [run_pipeline(view, '_create_grid_state_in_db')
+                for i in range(repeat)]
+        result['sql_aggregation'] = get_best([stats for s, stats in runs])
+
+    result['parallel'] = []
+    serial_time = None
+    for count in workers:
+        runs = [run_pipeline(view, '_create_grid_state_in_parallel', engine,
+                             workers=count, partitions=count)
+                for i in range(repeat)]
+        stats = get_best([stats for state, stats in runs])
+        stats['workers'] = count
+        if serial_time is None:
+            serial_time = stats['time']
+        stats['speedup'] = serial_time / max(stats['time'], 1e-6)
+        result['parallel'].append(stats)
+
+    return result
+
+
+def get_environment():
+    return {'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'database': connection.settings_dict['ENGINE'],
+            'engine': conf.GRID_ENGINE}
+
+
+def run_benchmark(records=1000, values=4, depth=3, districts=5, villages=10,
+                  aggregations=AGGREGATIONS, engine=None, workers=(1,),
+                  repeat=1, seed=0):
+    """
+        Build a synthetic report, then benchmark one view for each
+        aggregation. Return the results as a dict of simple types.
+
+        Workers are measured in the given order, the speedups being
+        relative to the first count. The database must be shared by the
+        processes, so with an in-memory SQLite database or in a managed
+        transaction, only one worker is used.
+
+        The grids are cached in the memory of the process during the
+        benchmark, whatever the cache backend of the settings.
+    """
+    old_debug, old_backend = settings.DEBUG, grid_cache._backend
+    settings.DEBUG = True
+    grid_cache._backend = LRUCache(conf.GRID_CACHE_SIZE)
+
+    if (connection.settings_dict['NAME'] == ':memory:' or
+        transaction.is_managed()):
+        workers = [1]
+
+    try:
+        synthetic = SyntheticReport(records, values, depth, districts,
+                                    villages, seed)
+        report, setup = measure(synthetic.build)
+        parameters = synthetic.get_parameters()
+        parameters.update({'aggregations': list(aggregations),
+                           'workers': list(workers), 'repeat': repeat,
+                           'seed': seed})
+        results = {'date': datetime.now().isoformat(),
+                   'environment': get_environment(),
+                   'parameters': parameters,
+                   'setup': setup,
+                   'views': []}
+        for aggregation in aggregations:
+            view = synthetic.create_view(aggregation)
+            results['views'].append(benchmark_view(view, engine, workers,
+                                                   repeat))
+        return results
+    finally:
+        settings.DEBUG = old_debug
+        grid_cache._backend = old_backend
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Settings of the app, with their default values. Override them in your
+    settings file.
+"""
+
+from django.conf import settings
+
+
+# engine used to calculate the data grids: 'python' (list of dicts) or 
+# 'numpy' (one array per indicator, requires numpy)
+GRID_ENGINE = getattr(settings, 'GENERIC_REPORT_GRID_ENGINE', 'python')
+
+
+# cache backend used for data grids, as a django cache backend URI 
+# (e.g: 'memcached://127.0.0.1:11211/'). If None, a cache in the 
+# process memory is used, with at most GRID_CACHE_SIZE entries.
+GRID_CACHE_BACKEND = getattr(settings, 'GENERIC_REPORT_CACHE_BACKEND', None)
+GRID_CACHE_SIZE = getattr(settings, 'GENERIC_REPORT_CACHE_SIZE', 200)
+
+# cache backend URI the versions of the grids are stored in. It must be 
+# shared by all the processes, e.g: memcached. If None, they are stored in
+# the database.
+GRID_VERSION_BACKEND = getattr(settings, 'GENERIC_REPORT_VERSION_BACKEND', 
+                               None)
+
+# versions are read once per request, and at most every this number of
+# seconds by code running outside requests (e.g: the SMS router)
+GRID_VERSION_MAX_AGE = getattr(settings, 'GENERIC_REPORT_VERSION_MAX_AGE', 1)
+
+# number of seconds a data grid stays in the cache
+GRID_CACHE_TIMEOUT = getattr(settings, 'GENERIC_REPORT_CACHE_TIMEOUT', 
+                             60 * 60 * 24)
+
+# number of records read at once when the data grid is streamed
+GRID_CHUNK_SIZE = getattr(settings, 'GENERIC_REPORT_CHUNK_SIZE', 500)
+
+# let the database group and sum the values when a view is aggregated by
+# date or by value, instead of loading all the records
+GRID_SQL_AGGREGATION = getattr(settings, 'GENERIC_REPORT_SQL_AGGREGATION', True)
+
+# keep sums of the records values by period of time up to date, and use
+# them for views aggregated by date
+GRID_ROLLUPS = getattr(settings, 'GENERIC_REPORT_ROLLUPS', True)
+
+# number of processes computing the grid of a view when it can't be 
+# aggregated by the database: the records are split in as many parts, 
+# computed in parallel then combined. 1 to compute it in this process.
+GRID_WORKERS = getattr(settings, 'GENERIC_REPORT_WORKERS', 1)
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+from _loader import *
+from _plan import *
+from _columnar import *
+from _cache import *
+from _aggregation import *
+from _sql import *
+from _bktree import *
+from _locations import *
+from _bulk import *
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Grouping of data dicts in one pass, with groups that can be updated
+    record by record: adding the data of a new record or removing the
+    data of an old one doesn't need to read the other records again.
+"""
+
+from django.utils.datastructures import SortedDict
+
+
+class SumState(object):
+    """
+        Sum of the values. It's None as soon as one value is None, so we
+        keep the number of None values to know when it's not the case
+        anymore if this value is removed.
+    """
+
+
+    def __init__(self):
+        self.total = 0
+        self.nulls = 0
+
+
+    def add(self, value, sign=1):
+        if value is None:
+            self.nulls += sign
+        else:
+            self.total += sign * value
+
+
+    def merge(self, total, nulls=0):
+        self.total += total
+        self.nulls += nulls
+
+
+    def combine(self, other):
+        self.merge(other.total, other.nulls)
+
+
+    def get_value(self):
+        if self.nulls:
+            return None
+        return self.total
+
+
+
+class CountState(object):
+    """
+        Number of values that are not None.
+    """
+
+
+    def __init__(self):
+        self.count = 0
+
+
+    def add(self, value, sign=1):
+        if value is not None:
+            self.count += sign
+
+
+    def combine(self, other):
+        self.count += other.count
+
+
+    def get_value(self):
+        return self.count
+
+
+
+class MinState(object):
+    """
+        Smallest value, None values being ignored. We count each value
+        so the minimum can still be found after a value is removed.
+    """
+
+
+    def __init__(self):
+        self.values = {}
+
+
+    def add(self, value, sign=1):
+        if value is None:
+            return
+        count = self.values.get(value, 0) + sign
+        if count:
+            self.values[value] = count
+        else:
+            self.values.pop(value, None)
+
+
+    def combine(self, other):
+        for value, count in other.values.iteritems():
+            self.add(value, count)
+
+
+    def get_value(self):
+        if not self.values:
+            return None
+        return min(self.values)
+
+
+
+class MaxState(MinState):
+    """
+        Biggest value, None values being ignored.
+    """
+
+
+    def get_value(self):
+        if not self.values:
+            return None
+        return max(self.values)
+
+
+
+class MeanState(object):
+    """
+        Average of the values, None values being ignored. It's rounded the 
+        same way than the average indicator.
+    """
+
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+
+    def add(self, value, sign=1):
+        if value is not None:
+            self.total += sign * value
+            self.count += sign
+
+
+    def combine(self, other):
+        self.total += other.total
+        self.count += other.count
+
+
+    def get_value(self):
+        if not self.count:
+            return None
+        return round(float(self.total) / self.count, 2)
+
+
+
+# partial states for each way to aggregate an indicator 
+PARTIAL_STATES = (
+    ('sum', SumState),
+    ('count', CountState),
+    ('min', MinState),
+    ('max', MaxState),
+    ('mean', MeanState),
+)
+
+
+class Group(object):
+    """
+        Aggregated data of several records sharing the same key.
+        
+        'aggregations' maps each name of the data to the way it must be 
+        aggregated (see PARTIAL_STATES), or to None if it's derived from 
+        the other aggregated values, like a ratio of two sums. Derived
+        values are None in the group data: they must be calculated after.
+        If 'aggregations' is None, all values are summed.
+        
+        If the data is grouped around several indicators, 'key_slug' is a
+        tuple of slugs and 'key' a tuple of values, in the same order.
+    """
+
+
+    def __init__(self, key_slug, key, aggregations=None):
+        self.key_slug = key_slug
+        self.key = key
+        if isinstance(key_slug, tuple):
+            self.keys = dict(zip(key_slug, key))
+        else:
+            self.keys = {key_slug: key}
+        self.aggregations = aggregations
+        self.count = 0
+        self.names = []
+        self.states = {}
+
+
+    def get_state(self, name):
+        """
+            Return the partial state of this name, or None if it's derived.
+        """
+        try:
+            return self.states[name]
+        except KeyError:
+            if self.aggregations is None:
+                aggregation = 'sum'
+            else:
+                aggregation = self.aggregations.get(name)
+            if aggregation is None:
+                return None
+            state = self.states[name] = dict(PARTIAL_STATES)[aggregation]()
+            return state
+
+
+    def add(self, data, sign=1):
+        if not self.names:
+            self.names = data.keys()
+        for name, value in data.iteritems():
+            if name not in self.keys:
+                state = self.get_state(name)
+                if state is not None:
+                    state.add(value, sign)
+        self.count += sign
+
+
+    def remove(self, data):
+        self.add(data, sign=-1)
+
+
+    def merge(self, names, count, sums, nulls):
+        """
+            Add the sums of several records at once (e.g: computed by the
+            database). 'nulls' is the number of None values for each name.
+            
+            Only names aggregated by sum can be merged this way.
+        """
+        if not self.names:
+            self.names = list(names)
+        for name, value in sums.iteritems():
+            self.get_state(name).merge(value)
+        for name, value in nulls.iteritems():
+            self.get_state(name).merge(0, value)
+        self.count += count
+
+
+    def combine(self, other):
+        """
+            Add the data of another group with the same key, e.g: computed 
+            from another part of the records.
+        """
+        if not self.names:
+            self.names = list(other.names)
+        for name, state in other.states.iteritems():
+            self.get_state(name).combine(state)
+        self.count += other.count
+
+
+    def get_data(self):
+        data = SortedDict()
+        for name in self.names:
+            if name in self.keys:
+                data[name] = self.keys[name]
+            else:
+                state = self.get_state(name)
+                data[name] = state and state.get_value()
+        return data
+
+
+
+class GridState(object):
+    """
+        Data of a view after calculation and aggregation but before the
+        formating. It's what we cache to be able to update a view when
+        one record changes.
+
+        If 'key_slug' is None, the data is not aggregated and the state
+        just holds a data dict per record. Else, data dicts are grouped by
+        the key given when adding them, and 'key_slug' is the indicator
+        which value is replaced by this key. To group around several
+        indicators at once, use a tuple of slugs and tuples as keys.
+
+        If 'incremental' is False, the state can't be updated this way
+        and must be created again from all the records.
+        
+        'aggregations' is the way to aggregate each indicator, see Group.
+    """
+
+
+    def __init__(self, key_slug=None, incremental=True, aggregations=None):
+        self.key_slug = key_slug
+        self.incremental = incremental
+        self.aggregations = aggregations
+        self.rows = SortedDict()
+
+
+    @property
+    def aggregated(self):
+        return self.key_slug is not None
+
+
+    def add(self, record_id, data, key=None):
+        """
+            Add the data of this record to the state. If the data is
+            aggregated, it's added to the group matching the key.
+        """
+        if not self.aggregated:
+            self.rows[record_id] = data
+            return
+
+        try:
+            group = self.rows[key]
+        except KeyError:
+            group = self.rows[key] = Group(self.key_slug, key, self.aggregations)
+        group.add(data)
+
+
+    def add_group(self, key, names, count, sums, nulls):
+        """
+            Add the sums of several records to the group matching the key.
+            See Group.merge().
+        """
+        try:
+            group = self.rows[key]
+        except KeyError:
+            group = self.rows[key] = Group(self.key_slug, key, self.aggregations)
+        group.merge(names, count, sums, nulls)
+
+
+    def combine(self, other):
+        """
+            Add the data of another state, created the same way from other
+            records. Records and groups it doesn't have yet come after the
+            ones it has, so combining the states of consecutive parts of the
+            records in order gives the state of all the records.
+        """
+        for key, row in other.rows.iteritems():
+            if not self.aggregated or key not in self.rows:
+                self.rows[key] = row
+            else:
+                self.rows[key].combine(row)
+
+
+    def remove(self, record_id, data, key=None):
+        """
+            Remove the data of this record from the state. 'data' and 'key'
+            must be the same than when it was added.
+        """
+        if not self.aggregated:
+            self.rows.pop(record_id, None)
+            return
+
+        group = self.rows.get(key)
+        if group is not None:
+            group.remove(data)
+            if not group.count:
+                del self.rows[key]
+
+
+    def replace(self, record_id, old_data, new_data, old_key=None,
+                new_key=None):
+        """
+            Replace the data of a record by a new version. When the data
+            is not aggregated, the record keeps its place in the grid.
+        """
+        if not self.aggregated and record_id in self.rows:
+            self.rows[record_id] = new_data
+        else:
+            self.remove(record_id, old_data, old_key)
+            self.add(record_id, new_data, new_key)
+
+
+    def get_grid(self, plan=None):
+        """
+            Return the data as a list of data dicts that can be modified
+            without changing the state.
+            
+            If the data is aggregated, 'plan' is the evaluation plan 
+            calculating the derived values of each group.
+        """
+        return list(self.iter_grid(plan))
+
+
+    def iter_grid(self, plan=None):
+        """
+            Same as get_grid() but yield the data dicts one by one.
+        """
+        for row in self.rows.itervalues():
+            if self.aggregated:
+                data = row.get_data()
+                if plan is not None:
+                    plan.evaluate(data)
+                yield data
+            else:
+                yield row.copy()
+
+
+    def get_crosstab(self, plan=None, rows=0, columns=1):
+        """
+            Return the aggregated data as a matrix for a state grouped
+            around several indicators: the 'rows' part of the keys gives
+            the rows, the 'columns' part the columns.
+
+            Return a tuple (row keys, column keys, cells), cells being a 
+            sorted dict mapping each row key to a sorted dict mapping each 
+            column key to the data of the group, or None if there is no
+            group for these keys. Other parts of the keys, if any, must be
+            the same for all groups.
+        """
+        if not isinstance(self.key_slug, tuple):
+            raise ValueError('A crosstab needs data grouped around at least '\
+                             'two indicators')
+        row_keys, column_keys = [], []
+        cells = SortedDict()
+        for group in self.rows.itervalues():
+            row_key, column_key = group.key[rows], group.key[columns]
+            if row_key not in cells:
+                row_keys.append(row_key)
+                cells[row_key] = SortedDict()
+            if column_key not in column_keys:
+                column_keys.append(column_key)
+            data = group.get_data()
+            if plan is not None:
+                plan.evaluate(data)
+            cells[row_key][column_key] = data
+
+        # put the cells of each row in the same order
+        for row_key, row in cells.items():
+            cells[row_key] = SortedDict((c, row.get(c)) for c in column_keys)
+        return row_keys, column_keys, cells
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    BK-tree: words indexed by edit distance, so we can find the words
+    close to a mistyped one without comparing it to all of them.
+"""
+
+
+def levenshtein(first, second):
+    """
+        Return the number of characters to insert, delete or replace to
+        turn one string into the other.
+    """
+    if len(first) < len(second):
+        first, second = second, first
+    previous = range(len(second) + 1)
+    for i, char in enumerate(first):
+        current = [i + 1]
+        for j, other in enumerate(second):
+            current.append(min(previous[j + 1] + 1,
+                               current[j] + 1,
+                               previous[j] + (char != other)))
+        previous = current
+    return previous[-1]
+
+
+
+class BKTree(object):
+    """
+        Words with the items they stand for (e.g: area ids). Each node is
+        a list [word, set of items, {distance: child node}], and all the
+        words of a child are at this distance of the word of the node, so
+        a search can skip the children too far from the searched word.
+
+        Removing the last item of a word leaves its node in the tree, as a
+        tombstone, since its children depend on it. The tree is rebuilt
+        when there are more tombstones than words.
+    """
+
+
+    def __init__(self, distance=levenshtein):
+        self.distance = distance
+        self.root = None
+        self.words = 0
+        self.tombstones = 0
+
+
+    def add(self, word, item):
+        if self.root is None:
+            self.root = [word, set([item]), {}]
+            self.words += 1
+            return
+
+        node = self.root
+        while True:
+            distance = self.distance(word, node[0])
+            if not distance:
+                if not node[1]:
+                    self.tombstones -= 1
+                    self.words += 1
+                node[1].add(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [word, set([item]), {}]
+                self.words += 1
+                return
+            node = child
+
+
+    def remove(self, word, item):
+        node = self.root
+        while node is not None:
+            distance = self.distance(word, node[0])
+            if not distance:
+                if item in node[1]:
+                    node[1].discard(item)
+                    if not node[1]:
+                        self.words -= 1
+                        self.tombstones += 1
+                break
+            node = node[2].get(distance)
+
+        if self.tombstones > self.words:
+            self.rebuild()
+
+
+    def iter_nodes(self):
+        stack = self.root and [self.root] or []
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node[2].itervalues())
+
+
+    def rebuild(self):
+        """
+            Create the tree again without the tombstones.
+        """
+        entries = [(node[0], node[1]) for node in self.iter_nodes() if node[1]]
+        self.root = None
+        self.words = self.tombstones = 0
+        for word, items in entries:
+            for item in items:
+                self.add(word, item)
+
+
+    def search(self, word, max_distance=2):
+        """
+            Return (distance, word, items) for all the words at most at
+            'max_distance' of this word, closest first.
+        """
+        results = []
+        stack = self.root and [self.root] or []
+        while stack:
+            node = stack.pop()
+            distance = self.distance(word, node[0])
+            if distance <= max_distance and node[1]:
+                results.append((distance, node[0], node[1]))
+            for child_distance, child in node[2].iteritems():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[:2])
+        return results
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Bulk writing: many objects of the same model inserted with one
+    executemany() instead of one save() each, for imports of thousands of
+    records and EAV values.
+"""
+
+from django.db import connections, router
+from django.db.models import AutoField
+from django.db.models.sql import InsertQuery
+
+
+def get_insert_values(obj, fields, connection):
+    """
+        Return the (field, value ready for the database) pairs save() would
+        insert for this object.
+    """
+    return [(f, f.get_db_prep_save(f.pre_save(obj, True), connection=connection))
+            for f in fields]
+
+
+def bulk_insert(model, objects, using=None, batch_size=1000):
+    """
+        Insert these unsaved objects of the model in the database, by
+        batches of 'batch_size' objects sharing one INSERT statement.
+
+        save() is not called and no signal is sent. The ids of the objects
+        are not set.
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    fields = [f for f in model._meta.local_fields
+              if not isinstance(f, AutoField)]
+    cursor = connection.cursor()
+
+    sql = None
+    batch = []
+    for obj in objects:
+        values = get_insert_values(obj, fields, connection)
+        if sql is None:
+            query = InsertQuery(model)
+            query.insert_values(values)
+            sql, params = query.get_compiler(using=using).as_sql()
+            batch.append(params)
+        else:
+            batch.append([value for field, value in values])
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+
+
+def insert(obj, using=None):
+    """
+        Insert this unsaved object and return its id, without calling
+        save() nor sending any signal.
+    """
+    model = obj.__class__
+    using = using or router.db_for_write(model)
+    fields = [f for f in model._meta.local_fields
+              if not isinstance(f, AutoField)]
+    values = get_insert_values(obj, fields, connections[using])
+    obj.pk = model._default_manager._insert(values, return_id=True,
+                                            using=using)
+    return obj.pk
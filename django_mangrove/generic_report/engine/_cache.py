@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Cache for data grids. Cached grids are never deleted: their keys
+    contain a version number for the report data and one for the reports
+    schema (indicators, views, aggregators...). Changing the data or the
+    schema bumps the version, and old entries are just not read anymore.
+
+    Versions are bumped by signals (see models/_signals.py). They are
+    shared by all the processes, stored in the database by default, while
+    the grids may be cached in the memory of each process.
+"""
+
+import time
+import threading
+
+from collections import OrderedDict
+
+from django.core.cache import get_cache
+
+from generic_report import conf
+
+
+class LRUCache(object):
+    """
+        Cache in the process memory with a limited number of entries. When
+        it's full, the least recently used entry is removed.
+
+        It implements the same API as django cache backends, so both can
+        be used for the grid cache.
+    """
+
+
+    def __init__(self, max_entries=200, default_timeout=None):
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+
+    def _get_expiration(self, timeout):
+        timeout = timeout or self.default_timeout
+        if timeout:
+            return time.time() + timeout
+        return None
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expiration, value = self._entries.pop(key)
+            except KeyError:
+                return default
+            if expiration is not None and expiration <= time.time():
+                return default
+            # put it back on top of the queue
+            self._entries[key] = (expiration, value)
+            return value
+
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self._get_expiration(timeout), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+    def add(self, key, value, timeout=None):
+        """
+            Set the value only if the key is not in the cache. Return True
+            if it has been set.
+        """
+        with self._lock:
+            if self.has_key(key):
+                return False
+            self.set(key, value, timeout)
+            return True
+
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            value = self.get(key)
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            expiration = self._entries[key][0]
+            self._entries[key] = (expiration, value + delta)
+            return value + delta
+
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def has_key(self, key):
+        return self.get(key) is not None
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+
+class GridCache(object):
+    """
+        Versioned cache for data grids, using the backend declared in
+        the settings or an LRUCache by default.
+        
+        Versions are kept in a store shared by all the processes: the
+        database, or the cache declared in the settings. Each thread reads
+        them once per request, and at most every GRID_VERSION_MAX_AGE 
+        seconds outside requests.
+    """
+
+    PREFIX = 'generic_report'
+
+    # versions must stay longer in the cache than what they version
+    VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+    def __init__(self, backend=None, versions=None):
+        self._backend = backend
+        self._versions = versions
+        self._local = threading.local()
+
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            if conf.GRID_CACHE_BACKEND:
+                self._backend = get_cache(conf.GRID_CACHE_BACKEND)
+            else:
+                self._backend = LRUCache(conf.GRID_CACHE_SIZE)
+        return self._backend
+
+
+    @property
+    def versions(self):
+        if self._versions is None:
+            if conf.GRID_VERSION_BACKEND:
+                self._versions = get_cache(conf.GRID_VERSION_BACKEND)
+            else:
+                from generic_report.models import DatabaseVersions
+                self._versions = DatabaseVersions()
+        return self._versions
+
+
+    def make_key(self, *parts):
+        return ':'.join([self.PREFIX] + [str(part) for part in parts])
+
+
+    @classmethod
+    def new_version(cls):
+        """
+            Versions start with a timestamp so if a version is removed from
+            the cache, the new one will never match an old entry.
+        """
+        return int(time.time() * 1000)
+
+
+    def _get_read_versions(self):
+        """
+            Return the versions this thread read recently, by name.
+        """
+        local = self._local
+        now = time.time()
+        if getattr(local, 'expires', 0) < now:
+            local.versions = {}
+            local.expires = now + conf.GRID_VERSION_MAX_AGE
+        return local.versions
+        
+        
+    def forget_versions(self, **kwargs):
+        """
+            Read the versions from the store again the next time they are
+            needed. Called at the start of each request.
+        """
+        self._local.versions = {}
+        self._local.expires = 0
+
+
+    def get_versions(self, *names):
+        """
+            Return the versions with these names, read in one go from the
+            store if this thread didn't read them recently.
+        """
+        read_versions = self._get_read_versions()
+        keys = dict((self.make_key('version', name), name) for name in names
+                    if name not in read_versions)
+        if keys:
+            found = self.versions.get_many(keys.keys())
+            for key, name in keys.iteritems():
+                version = found.get(key)
+                if version is None:
+                    self.versions.add(key, self.new_version(), 
+                                      self.VERSION_TIMEOUT)
+                    version = self.versions.get(key)
+                read_versions[name] = version
+        return [read_versions[name] for name in names]
+
+
+    def get_version(self, name):
+        return self.get_versions(name)[0]
+
+
+    def bump_version(self, name):
+        key = self.make_key('version', name)
+        try:
+            version = self.versions.incr(key)
+        except ValueError:
+            version = self.new_version()
+            self.versions.set(key, version, self.VERSION_TIMEOUT)
+        self._get_read_versions()[name] = version
+        return version
+
+
+    def get_data_version(self, report_id):
+        """
+            Version of the records of this report.
+        """
+        return self.get_version('report.%s' % report_id)
+
+
+    def bump_data_version(self, report_id):
+        return self.bump_version('report.%s' % report_id)
+
+
+    def get_schema_version(self):
+        """
+            Version of all the reports definitions: indicators, views,
+            aggregators, etc.
+        """
+        return self.get_version('schema')
+
+
+    def bump_schema_version(self):
+        return self.bump_version('schema')
+
+
+    def get_view_key(self, view, name, data_version=None):
+        """
+            Key of the 'name' cache entry for this view with the current 
+            versions, or the given data version.
+        """
+        data_name = 'report.%s' % view.report_id
+        if data_version is None:
+            data_version, schema_version = self.get_versions(data_name, 
+                                                             'schema')
+        else:
+            schema_version = self.get_schema_version()
+        return self.make_key('view', view.report_id, view.pk, data_version,
+                             schema_version, name)
+
+
+    def get_report_key(self, report, name):
+        """
+            Key of the 'name' cache entry for this report with the current
+            versions.
+        """
+        versions = self.get_versions('report.%s' % report.pk, 'schema')
+        return self.make_key('report', report.pk, *(versions + [name]))
+
+
+    def get(self, key, default=None):
+        return self.backend.get(key, default)
+
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout or conf.GRID_CACHE_TIMEOUT)
+
+
+    def clear(self):
+        """
+            Remove all the grids of the backend, and forget the versions
+            read by this thread, e.g: between tests.
+        """
+        self.backend.clear()
+        self.forget_versions()
+
+
+
+grid_cache = GridCache()
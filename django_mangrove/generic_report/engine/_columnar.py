@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Columnar data grid: one NumPy masked array per indicator instead of
+    one dict per record. Calculated indicators are then evaluated on whole
+    columns at once. Masked cells are the None values of the dict grid.
+
+    NumPy is optional, you need it only if you use this engine.
+"""
+
+import operator
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.datastructures import SortedDict
+
+try:
+    import numpy
+    from numpy import ma
+except ImportError:
+    numpy = ma = None
+
+
+def round_column(column, digits):
+    """
+        Round the values of the column like the Python round() function,
+        as the calculated indicators do. Masked cells stay masked, and NaN
+        values stay NaN.
+        
+        numpy scales the values and rounds them half to even, so only the
+        values exactly half way once scaled can be rounded differently:
+        they are rounded again with round().
+    """
+    data = column.filled(0)
+    scaled = data * 10.0 ** digits
+    rounded = numpy.round(scaled) / 10.0 ** digits
+    for index in numpy.flatnonzero(abs(scaled - numpy.trunc(scaled)) == 0.5):
+        rounded[index] = round(data[index], digits)
+    return ma.array(rounded, mask=ma.getmaskarray(column))
+
+
+def divide_columns(numerator, denominator):
+    """
+        True division of two columns. Cells with a zero denominator are
+        masked, as the dict grid set them to None.
+    """
+    return ma.true_divide(numerator, denominator)
+
+
+# same operations as the calculate() methods of the calculated indicators
+COLUMN_OPERATIONS = (
+    ('sum', lambda *columns: reduce(operator.add, columns)),
+    ('product', lambda *columns: reduce(operator.mul, columns)),
+    ('difference', operator.sub),
+    ('average', lambda *columns: round_column(
+                    divide_columns(reduce(operator.add, columns), len(columns)),
+                    2)),
+    ('ratio', lambda n, d: round_column(divide_columns(n, d), 2)),
+    ('rate', lambda n, d: round_column(divide_columns(n, d) * 100, 2)),
+)
+
+
+class ColumnarGrid(object):
+    """
+        A data grid stored as one masked array per indicator slug.
+
+        Integer and float values are stored as typed arrays, other values
+        (dates, locations, text...) as object arrays.
+    """
+
+
+    def __init__(self, columns, length):
+        self.columns = columns
+        self.length = length
+
+
+    @classmethod
+    def check_numpy(cls):
+        if numpy is None:
+            raise ImproperlyConfigured('You must install numpy to use the '\
+                                       'columnar engine')
+
+
+    @classmethod
+    def from_rows(cls, rows, slugs=None):
+        """
+            Create a columnar grid from a list of data dicts. If no slugs
+            are given, the keys of the first data dict are used.
+        """
+        cls.check_numpy()
+
+        if slugs is None:
+            slugs = rows and rows[0].keys() or []
+
+        columns = SortedDict()
+        for slug in slugs:
+            columns[slug] = cls.to_column([row.get(slug) for row in rows])
+        return cls(columns, len(rows))
+
+
+    @classmethod
+    def to_column(cls, values):
+        """
+            Turn a list of values into a masked array, choosing the type
+            of the array according to the values.
+        """
+        mask = [value is None for value in values]
+        types = set(type(value) for value in values if value is not None)
+
+        if types <= set((int, long)):
+            dtype = 'i8'
+        elif types <= set((int, long, float)):
+            dtype = 'f8'
+        else:
+            return ma.array(values, mask=mask, dtype=object)
+
+        values = [0 if value is None else value for value in values]
+        return ma.array(values, mask=mask, dtype=dtype)
+
+
+    def evaluate(self, plan):
+        """
+            Calculate the indicators of the evaluation plan, one column at
+            a time.
+        """
+        operations = dict(COLUMN_OPERATIONS)
+        for slug, operation, operands in plan.operations:
+            calculate = operations[operation]
+            self.columns[slug] = calculate(*[self.columns[o] for o in operands])
+        return self
+
+
+    def get_values(self, slug):
+        """
+            Return the values of this column as a list of Python objects,
+            with None for masked cells.
+        """
+        return self.columns[slug].tolist()
+
+
+    def update_rows(self, rows, slugs=None):
+        """
+            Copy the values of the columns (all of them or only the given
+            slugs) into the data dicts of the list.
+
+            WARNING:
+
+            This modifies the rows in place but return them for convenience.
+        """
+        for slug in (slugs or self.columns.keys()):
+            for row, value in zip(rows, self.get_values(slug)):
+                row[slug] = value
+        return rows
+
+
+    def to_rows(self):
+        """
+            Return the grid as a list of sorted dicts.
+        """
+        rows = [SortedDict() for i in xrange(self.length)]
+        return self.update_rows(rows)
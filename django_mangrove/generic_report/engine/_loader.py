@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Bulk loading of the records data. Instead of asking each record for
+    each of its EAV values, all the values of all the records are fetched
+    with a few set based queries then pivoted into a data grid in memory.
+"""
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import ForeignKey
+from django.utils.datastructures import SortedDict
+
+from eav.models import Attribute, Value
+
+
+class RecordLoader(object):
+    """
+        Load the values of the given indicators for a set of records and
+        turn them into a data grid: a list of sorted dicts, one per record,
+        mapping each indicator concept slug to its value.
+
+        The number of queries doesn't depend of the number of records:
+        one to get the records ids, one to get all the EAV values and one
+        per type of object referenced by the values (e.g: Area for
+        location indicators).
+    """
+
+
+    def __init__(self, indicators):
+
+        # attribute id => (slug, datatype), and slugs in the indicators order
+        self.attributes = {}
+        self.slugs = []
+        for indicator in indicators:
+            concept = indicator.concept
+            if concept.slug not in self.slugs:
+                self.slugs.append(concept.slug)
+                self.attributes[concept.pk] = (concept.slug, concept.datatype)
+
+        # columns of the EAV value table we need to read
+        self.columns = []
+        for slug, datatype in self.attributes.values():
+            for column in self.get_value_columns(datatype):
+                if column not in self.columns:
+                    self.columns.append(column)
+
+        # columns that are foreign keys (e.g: enum values) are fetched
+        # like objects: column name => content type id
+        self.relations = {}
+        for column in self.columns:
+            field = Value._meta.get_field(column)
+            if isinstance(field, ForeignKey) and column != 'generic_value_ct':
+                ct = ContentType.objects.get_for_model(field.rel.to)
+                self.relations[column] = ct.pk
+
+
+    @classmethod
+    def get_value_columns(cls, datatype):
+        """
+            Return the names of the columns of the EAV value table holding
+            the values for this datatype.
+        """
+        if datatype == Attribute.TYPE_OBJECT:
+            return ('generic_value_ct', 'generic_value_id')
+        return ('value_%s' % datatype,)
+
+
+    def get_grid(self, records):
+        """
+            Return the data grid for all the records of this queryset, in
+            the queryset order.
+        """
+        return self.get_rows(records).values()
+
+
+    def get_rows(self, records):
+        """
+            Return a sorted dict mapping the id of each record of this 
+            queryset to its data, in the queryset order.
+        """
+        ids = list(records.values_list('pk', flat=True))
+        values = self.get_values(records.model,
+                                 records.values_list('pk', flat=True))
+        return self.pivot(ids, values)
+
+
+    def iter_rows(self, records, chunk_size=500):
+        """
+            Same as get_rows() but read the records by chunks of 'chunk_size'
+            records, in the order of their ids, and yield a sorted dict 
+            for each chunk.
+        """
+        last_id = None
+        while True:
+            chunk = records.order_by('pk')
+            if last_id is not None:
+                chunk = chunk.filter(pk__gt=last_id)
+            ids = list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not ids:
+                return
+            yield self.pivot(ids, self.get_values(records.model, ids))
+            last_id = ids[-1]
+
+
+    def get_values(self, model, ids):
+        """
+            Return the raw values of the EAV table for the given records as
+            tuples (record_id, attribute_id, column values...).
+
+            'ids' can be a list or a queryset, in which case it will be
+            used as a sub query.
+        """
+
+        if not self.attributes:
+            return []
+
+        entity_ct = ContentType.objects.get_for_model(model)
+        values = Value.objects.filter(entity_ct=entity_ct,
+                                      entity_id__in=ids,
+                                      attribute__in=self.attributes.keys())
+        return values.values_list('entity_id', 'attribute', *self.columns)
+
+
+    def pivot(self, ids, values):
+        """
+            Turn the raw EAV values into a sorted dict mapping each record id
+            to a data dict. Each data dict contains all the indicators slugs,
+            with None if the record has no value for this indicator.
+
+            Values that are references to other objects are fetched in
+            one query per type of object.
+        """
+
+        rows = SortedDict((pk, SortedDict((s, None) for s in self.slugs))
+                           for pk in ids)
+        positions = dict((c, i + 2) for i, c in enumerate(self.columns))
+        references = {}
+
+        for value in values:
+            try:
+                row = rows[value[0]]
+            except KeyError:
+                continue
+            slug, datatype = self.attributes[value[1]]
+
+            if datatype == Attribute.TYPE_OBJECT:
+                ct_id = value[positions['generic_value_ct']]
+                obj_id = value[positions['generic_value_id']]
+                if ct_id and obj_id is not None:
+                    references.setdefault(ct_id, []).append((row, slug, obj_id))
+                continue
+
+            column = self.get_value_columns(datatype)[0]
+            raw_value = value[positions[column]]
+
+            if column in self.relations and raw_value is not None:
+                ct_id = self.relations[column]
+                references.setdefault(ct_id, []).append((row, slug, raw_value))
+            else:
+                row[slug] = raw_value
+
+        for ct_id, refs in references.iteritems():
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            objects = self.get_objects(model, set(r[2] for r in refs))
+            for row, slug, obj_id in refs:
+                row[slug] = objects.get(obj_id)
+
+        return rows
+
+
+    @classmethod
+    def get_objects(cls, model, ids, chunk_size=500):
+        """
+            Same as in_bulk() but split the ids into chunks so we don't hit
+            the maximum number of SQL parameters of some databases.
+        """
+        ids = list(ids)
+        objects = {}
+        for i in xrange(0, len(ids), chunk_size):
+            objects.update(model._default_manager.in_bulk(ids[i:i + chunk_size]))
+        return objects
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Index of the areas hierarchy, so finding the parent of an area with a
+    given type doesn't need one query per level for each record, and of
+    the areas codes, so checking the location of an SMS doesn't need any
+    query.
+"""
+
+import time
+import threading
+
+from simple_locations.models import Area, AreaType
+
+from _cache import grid_cache
+from _bktree import BKTree
+
+
+class AreaIndex(object):
+    """
+        Parent and kind of all the areas, loaded in one query and kept in
+        the process memory. Closest ancestors with a given kind are
+        memorized once found, so looking for them again is a dict lookup.
+
+        Areas can be found by code, case insensitively, with the slug of
+        their type: codes map to (area id, type slug, area name). Codes 
+        and names are also in a BK-tree, built the first time we look for 
+        the codes close to a mistyped one.
+
+        Saving or deleting an area updates the index of the current 
+        process (see update_area()), saving or deleting an area type 
+        invalidates it. Both bump the 'areas' version of the grid cache so
+        other processes sharing the cache load the areas again too. This 
+        version is checked at most every CHECK_INTERVAL seconds.
+    """
+
+    CHECK_INTERVAL = 5
+
+
+    def __init__(self):
+        self.version = None
+        self.checked_at = 0
+        self.areas = {}
+        self.parents = {}
+        self.kinds = {}
+        self.codes = {}
+        self.kind_slugs = {}
+        self.kind_names = {}
+        self._ancestors = {}
+        self._tree = None
+        self._lock = threading.RLock()
+
+
+    def load(self):
+        """
+            Load all the areas.
+        """
+        with self._lock:
+            version = grid_cache.get_version('areas')
+            kind_slugs = {}
+            kind_names = {}
+            for kind in AreaType.objects.all():
+                kind_slugs[kind.pk] = kind.slug
+                kind_names[kind.slug] = kind.name
+
+            self.kind_slugs, self.kind_names = kind_slugs, kind_names
+            self.areas, self.parents, self.kinds, self.codes = {}, {}, {}, {}
+            self._tree = None
+            for area in Area.objects.all():
+                self._add_area(area)
+            self._ancestors = {}
+            self.version = version
+            self.checked_at = time.time()
+
+
+    def _add_area(self, area):
+        self.areas[area.pk] = area
+        self.parents[area.pk] = area.parent_id
+        self.kinds[area.pk] = area.kind_id
+        if area.code:
+            self.codes[self.normalize_code(area.code)] = (
+                            area.pk, self.kind_slugs.get(area.kind_id), 
+                            area.name)
+        if self._tree is not None:
+            for word in self.get_words(area):
+                self._tree.add(word, area.pk)
+
+
+    def _remove_area(self, area_id):
+        area = self.areas.pop(area_id, None)
+        if area is None:
+            return
+        self.parents.pop(area_id, None)
+        self.kinds.pop(area_id, None)
+        if area.code:
+            code = self.normalize_code(area.code)
+            if self.codes.get(code, (None,))[0] == area_id:
+                del self.codes[code]
+        if self._tree is not None:
+            for word in self.get_words(area):
+                self._tree.remove(word, area_id)
+
+
+    def update_area(self, area, version, deleted=False):
+        """
+            Replace the area in the index by its new version, or remove it
+            if it's deleted, instead of loading all the areas again. 
+            
+            'version' is the 'areas' version after the change. If the index 
+            is older than the version before the change, it's loaded again 
+            instead.
+        """
+        with self._lock:
+            if self.version is None:
+                return
+            if not isinstance(version, (int, long)) or \
+               self.version != version - 1:
+                return self.invalidate()
+            self._remove_area(area.pk)
+            if not deleted:
+                self._add_area(area)
+            self._ancestors = {}
+            self.version = version
+
+
+    def invalidate(self):
+        self.version = None
+
+
+    def check(self, area_id=None):
+        """
+            Load the areas again if they changed since the last load, or
+            if this area is unknown.
+        """
+        if self.version is None or \
+           (area_id is not None and area_id not in self.parents):
+            return self.load()
+            
+        now = time.time()
+        if now - self.checked_at > self.CHECK_INTERVAL:
+            self.checked_at = now
+            if self.version != grid_cache.get_version('areas'):
+                self.load()
+
+
+    @classmethod
+    def normalize_code(cls, code):
+        return code.strip().lower()
+
+
+    def get_by_code(self, code):
+        """
+            Return (area id, type slug, area name) for the area with this
+            code, ignoring the case, or None if there is none.
+        """
+        self.check()
+        return self.codes.get(self.normalize_code(code))
+
+
+    @classmethod
+    def get_words(cls, area):
+        """
+            Return the words a mistyped code could be close to: the code 
+            and the name of the area.
+        """
+        words = set()
+        for word in (area.code, area.name):
+            if word:
+                words.add(cls.normalize_code(word))
+        return words
+
+
+    def get_suggestions(self, code, max_distance=2, limit=3):
+        """
+            Return the codes of at most 'limit' areas which code or name is
+            close to this code, the closest first.
+        """
+        self.check()
+        with self._lock:
+            if self._tree is None:
+                self._tree = BKTree()
+                for area in self.areas.itervalues():
+                    for word in self.get_words(area):
+                        self._tree.add(word, area.pk)
+            results = self._tree.search(self.normalize_code(code), 
+                                        max_distance)
+        
+        suggestions = []
+        for distance, word, area_ids in results:
+            for area_id in sorted(area_ids):
+                area = self.areas.get(area_id)
+                if area is not None and area.code and \
+                   area.code not in suggestions:
+                    suggestions.append(area.code)
+        return suggestions[:limit]
+
+
+    def get_area(self, area_id):
+        """
+            Return the area object with this id, as loaded with the index.
+        """
+        self.check(area_id)
+        return self.areas.get(area_id)
+
+
+    def get_kind_name(self, slug):
+        """
+            Return the name of the area type with this slug, or None.
+        """
+        self.check()
+        return self.kind_names.get(slug)
+
+
+    def get_ancestor(self, area, kind):
+        """
+            Return the closest area with this kind among the area and its
+            parents, or None if there is none.
+
+            'area' and 'kind' can be objects or ids.
+        """
+        if area is None or kind is None:
+            return None
+        area_id = getattr(area, 'pk', area)
+        kind_id = getattr(kind, 'pk', kind)
+        self.check(area_id)
+
+        try:
+            ancestor_id = self._ancestors[(area_id, kind_id)]
+        except KeyError:
+            ancestor_id = self._find_ancestor(area_id, kind_id)
+        return self.areas.get(ancestor_id)
+
+
+    def _find_ancestor(self, area_id, kind_id):
+        """
+            Walk up the parents of the area until we find the kind, and
+            memorize the result for all the areas on the way.
+        """
+        path = []
+        visited = set()
+        current = area_id
+        ancestor_id = None
+        while current is not None and current not in visited:
+            known = self._ancestors.get((current, kind_id), False)
+            if known is not False:
+                ancestor_id = known
+                break
+            if self.kinds.get(current) == kind_id:
+                ancestor_id = current
+                break
+            path.append(current)
+            visited.add(current)
+            current = self.parents.get(current)
+
+        for pk in path:
+            self._ancestors[(pk, kind_id)] = ancestor_id
+        if current is not None:
+            self._ancestors[(current, kind_id)] = ancestor_id
+        return ancestor_id
+
+
+
+area_index = AreaIndex()
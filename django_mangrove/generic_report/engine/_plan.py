@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Compilation of the calculated indicators of a view into an evaluation
+    plan: a list of plain Python functions, ordered so that each indicator
+    is calculated after the indicators it depends on. Once compiled, a plan
+    can run on any number of rows without accessing the database.
+"""
+
+from _columnar import ColumnarGrid
+
+
+# ways to calculate the indicators of a grid (see EvaluationPlan.update_grid())
+GRID_ENGINES = ('python', 'numpy')
+
+
+class EvaluationPlan(object):
+    """
+        Calculated indicators resolved once (strategy, slug, operands) and
+        ready to be applied to data dicts.
+
+        Stored indicators (values, dates, locations) are skipped since their
+        value is already in the data.
+        
+        If any operand of an indicator is None, its value will be None.
+        
+        If 'aggregated' is True, the plan is for aggregated data: only the
+        indicators derived from aggregated values (their aggregation is 
+        None, like ratios) are calculated, the others are aggregated like 
+        stored values.
+    """
+
+
+    def __init__(self, indicators, aggregated=False):
+        self.steps = []
+        self.slugs = []
+        
+        # (slug, operation name, operands), for the columnar engine
+        self.operations = []
+        
+        for indicator in self.sort(indicators):
+            strategy = indicator.strategy
+            if aggregated and strategy.aggregation is not None:
+                continue
+            if strategy.is_calculated:
+                slug = indicator.concept.slug
+                operands = indicator.get_operands()
+                self.steps.append(self.compile_step(slug, strategy.calculate,
+                                                    operands))
+                self.operations.append((slug, strategy.operation, operands))
+                self.slugs.append(slug)
+
+
+    @classmethod
+    def compile_step(cls, slug, calculate, operands):
+        """
+            Return a function calculating the value of one indicator and
+            saving it in the data dict.
+        """
+        def step(data):
+            values = [data[operand] for operand in operands]
+            if None in values:
+                data[slug] = None
+            else:
+                data[slug] = calculate(*values)
+        return step
+
+
+    @classmethod
+    def sort(cls, indicators):
+        """
+            Return the given indicators and all their dependancies, each
+            indicator coming after the ones it depends on.
+
+            Raise ValueError if an indicator depends on itself.
+        """
+
+        ordered = []
+        visited = set()
+        visiting = set()
+
+        def visit(indicator):
+            if indicator.pk in visited:
+                return
+            if indicator.pk in visiting:
+                raise ValueError(u'Indicator "%s" depends on itself' % indicator)
+            visiting.add(indicator.pk)
+            if indicator.strategy.is_calculated:
+                for dependancy in indicator.get_dependancies():
+                    visit(dependancy)
+            visiting.remove(indicator.pk)
+            visited.add(indicator.pk)
+            ordered.append(indicator)
+
+        for indicator in indicators:
+            visit(indicator)
+
+        return ordered
+
+
+    def evaluate(self, data):
+        """
+            Calculate all the indicators of the plan for this data dict.
+
+            WARNING:
+
+            This modifies the data in place but return it for convenience.
+        """
+        for step in self.steps:
+            step(data)
+        return data
+
+
+    def update_grid(self, grid, engine='python'):
+        """
+            Calculate all the indicators of the plan for each data dict of
+            the grid. 
+            
+            With the 'numpy' engine, the grid is turned into a columnar 
+            grid to calculate the indicators on whole columns, then the 
+            results are copied back into the data dicts.
+
+            WARNING:
+
+            This modifies the grid in place but return the grid for convenience.
+        """
+        if engine == 'numpy':
+            columns = ColumnarGrid.from_rows(grid).evaluate(self)
+            return columns.update_rows(grid, self.slugs)
+            
+        steps = self.steps
+        for data in grid:
+            for step in steps:
+                step(data)
+        return grid
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Aggregation done by the database: instead of loading every value of
+    every record to sum them in Python, the EAV values are grouped and
+    summed with a GROUP BY, and we only get one row per group back.
+"""
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.backends.util import typecast_timestamp
+
+from eav.models import Attribute, Value
+
+
+class SQLAggregation(object):
+    """
+        Sum the numerical EAV values of a set of records, grouped by the
+        value of one attribute (the key).
+
+        'key_sql' is a function getting the SQL of the column holding the
+        key value and returning the SQL expression of the key, e.g:
+        "DATE_TRUNC('month', column)".
+
+        Missing values are counted as None values, like in the data grid.
+    """
+
+    NUMERICAL_TYPES = (Attribute.TYPE_INT, Attribute.TYPE_FLOAT)
+
+
+    def __init__(self, records, key_attribute, key_sql, attributes):
+        self.records = records
+        self.key_attribute = key_attribute
+        self.key_sql = key_sql
+        self.attributes = [a for a in attributes
+                           if a.datatype in self.NUMERICAL_TYPES]
+        self.connection = connections[records.db]
+
+
+    def get_column(self, name):
+        return self.connection.ops.quote_name(Value._meta.get_field(name).column)
+
+
+    def get_from_sql(self):
+        """
+            Return the FROM clause shared by the queries, with its params:
+            the records joined to the value of their key.
+        """
+        qn = self.connection.ops.quote_name
+        records = self.records.values_list('pk', flat=True)
+        records_sql, records_params = records.query.get_compiler(
+                                                    self.records.db).as_sql()
+        sql = ('FROM (%(records)s) r '
+               'LEFT OUTER JOIN %(values)s k ON (k.%(ct)s = %%s '
+               'AND k.%(entity)s = r.%(pk)s AND k.%(attribute)s = %%s)') % {
+                    'records': records_sql,
+                    'values': qn(Value._meta.db_table),
+                    'ct': self.get_column('entity_ct'),
+                    'entity': self.get_column('entity_id'),
+                    'attribute': self.get_column('attribute'),
+                    'pk': qn(self.records.model._meta.pk.column)}
+        return sql, tuple(records_params) + (self.get_entity_ct().pk,
+                                             self.key_attribute.pk)
+
+
+    def get_key_sql(self):
+        column = 'value_%s' % self.key_attribute.datatype
+        return self.key_sql('k.%s' % self.get_column(column))
+
+
+    def get_entity_ct(self):
+        return ContentType.objects.get_for_model(self.records.model)
+
+
+    def get_counts(self):
+        """
+            Return a list of (key, number of records) in the order of the
+            first record of each group.
+        """
+        from_sql, params = self.get_from_sql()
+        sql = ('SELECT %(key)s, COUNT(*) %(from)s '
+               'GROUP BY %(key)s ORDER BY MIN(r.%(pk)s)') % {
+                    'key': self.get_key_sql(),
+                    'from': from_sql,
+                    'pk': self.connection.ops.quote_name(
+                                            self.records.model._meta.pk.column)}
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return [(self.convert_key(key), count) for key, count in cursor.fetchall()]
+
+
+    def get_sums(self):
+        """
+            Return a dict mapping each key to a dict
+            {attribute id: (sum, number of values)}
+        """
+        sums = {}
+        if not self.attributes:
+            return sums
+
+        from_sql, params = self.get_from_sql()
+        sql = ('SELECT %(key)s, v.%(attribute)s, SUM(v.%(int)s), '
+               'COUNT(v.%(int)s), SUM(v.%(float)s), COUNT(v.%(float)s) '
+               '%(from)s INNER JOIN %(values)s v ON (v.%(ct)s = %%s '
+               'AND v.%(entity)s = r.%(pk)s) WHERE v.%(attribute)s IN (%(ids)s) '
+               'GROUP BY %(key)s, v.%(attribute)s') % {
+                    'key': self.get_key_sql(),
+                    'from': from_sql,
+                    'values': self.connection.ops.quote_name(Value._meta.db_table),
+                    'ct': self.get_column('entity_ct'),
+                    'entity': self.get_column('entity_id'),
+                    'attribute': self.get_column('attribute'),
+                    'int': self.get_column('value_int'),
+                    'float': self.get_column('value_float'),
+                    'pk': self.connection.ops.quote_name(
+                                            self.records.model._meta.pk.column),
+                    'ids': ', '.join(['%s'] * len(self.attributes))}
+        params += (self.get_entity_ct().pk,)
+        params += tuple(a.pk for a in self.attributes)
+
+        datatypes = dict((a.pk, a.datatype) for a in self.attributes)
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        for key, attribute_id, int_sum, int_count, float_sum, float_count in cursor:
+            if datatypes[attribute_id] == Attribute.TYPE_INT:
+                total = int_sum is not None and int(int_sum) or 0
+                values = (total, int_count)
+            else:
+                total = float_sum is not None and float(float_sum) or 0
+                values = (total, float_count)
+            sums.setdefault(self.convert_key(key), {})[attribute_id] = values
+        return sums
+
+
+    def get_groups(self):
+        """
+            Return a list of (key, number of records, sums, nulls), 'sums'
+            and 'nulls' being dicts mapping the attributes slugs to the
+            sum of their values and their number of None values in the group.
+        """
+        all_sums = self.get_sums()
+        groups = []
+        for key, count in self.get_counts():
+            sums, nulls = {}, {}
+            key_sums = all_sums.get(key, {})
+            for attribute in self.attributes:
+                total, values = key_sums.get(attribute.pk, (0, 0))
+                sums[attribute.slug] = total
+                if count - values:
+                    nulls[attribute.slug] = count - values
+            groups.append((key, count, sums, nulls))
+        return groups
+
+
+    def convert_key(self, key):
+        """
+            Some databases return the result of a function as a string or
+            a boolean as an integer: turn the key back into what we would
+            get from the ORM.
+        """
+        datatype = self.key_attribute.datatype
+        if key is None:
+            return None
+        if datatype == Attribute.TYPE_DATE and isinstance(key, basestring):
+            return typecast_timestamp(key)
+        if datatype == Attribute.TYPE_BOOLEAN:
+            return bool(key)
+        return key
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Export of the data of a report view as CSV or Excel files, written row
+    by row from the data grid iterator so the whole grid is never loaded.
+
+    xlwt is optional, you need it only for Excel files.
+"""
+
+import re
+import csv
+from cStringIO import StringIO
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import smart_str
+
+try:
+    import xlwt
+except ImportError:
+    xlwt = None
+
+
+def iter_rows(view, chunk_size=None):
+    """
+        Yield the labels of the view, then the formated values of each
+        data dict, as lists in the same order.
+    """
+    slugs = [i.concept.slug for i in view.get_indicators_to_display()]
+    yield view.get_labels()
+    # exports may be big, the grid is not kept in memory to be cached
+    for data in view.iter_data_grid(chunk_size, cache=False):
+        yield [data.get(slug) for slug in slugs]
+
+
+def iter_csv(view, chunk_size=None, **fmtparams):
+    """
+        Yield the data of the view as CSV lines, encoded in UTF-8, the
+        first one being the labels. 'fmtparams' are passed to csv.writer().
+    """
+    buf = StringIO()
+    writer = csv.writer(buf, **fmtparams)
+    for row in iter_rows(view, chunk_size):
+        writer.writerow(['' if cell is None else smart_str(cell)
+                         for cell in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+
+class SpreadsheetWriter(object):
+    """
+        Excel workbook the data is added to row by row.
+
+        Styles are created once and shared by all the cells, column widths
+        are set once per sheet, and rows are flushed to the workbook
+        binary data as we go instead of being kept as cell objects. When a
+        sheet is full, the next rows go to a new sheet with the same
+        header.
+    """
+
+    MAX_ROWS = 65536
+    FLUSH_INTERVAL = 1000
+
+    # width of the columns, in 1/256 of the width of the '0' character
+    FIRST_COLUMN_WIDTH = 0x0d00 * 3
+    COLUMN_WIDTH = 0x0d00
+
+    # Excel sheet names have at most 31 characters, none of these ones, 
+    # and don't start with a quote
+    MAX_SHEET_NAME = 31
+    INVALID_SHEET_CHARS = re.compile(r"[\[\]:\\/?*\x00]")
+
+
+    def __init__(self, labels, sheet_name='Data'):
+        if xlwt is None:
+            raise ImproperlyConfigured('You must install xlwt to export '\
+                                       'Excel files')
+        self.labels = list(labels)
+        self.sheet_name = self.clean_sheet_name(sheet_name)
+        self.workbook = xlwt.Workbook(encoding='utf-8')
+        self.styles = {
+            'header': xlwt.easyxf('font: bold on, height 210'),
+            'odd': xlwt.easyxf(''),
+            'even': xlwt.easyxf('pattern: pattern solid, '\
+                                'fore_colour gray25;'),
+        }
+        self.sheets = 0
+        self.sheet = None
+        self.rownum = 0
+        self.add_sheet()
+
+
+    @classmethod
+    def clean_sheet_name(cls, name, number=1):
+        """
+            Return a sheet name Excel accepts from this name, with the 
+            number of the sheet if it's not the first one.
+        """
+        name = cls.INVALID_SHEET_CHARS.sub(' ', name).strip(" '") or 'Data'
+        suffix = number > 1 and ' %s' % number or ''
+        return name[:cls.MAX_SHEET_NAME - len(suffix)].rstrip() + suffix
+
+
+    def add_sheet(self):
+        """
+            Start a new sheet, with the labels as first row.
+        """
+        if self.sheet is not None:
+            self.sheet.flush_row_data()
+        self.sheets += 1
+        name = self.clean_sheet_name(self.sheet_name, self.sheets)
+        self.sheet = self.workbook.add_sheet(name)
+
+        for i, label in enumerate(self.labels):
+            width = i and self.COLUMN_WIDTH or self.FIRST_COLUMN_WIDTH
+            self.sheet.col(i).width = width
+            self.sheet.write(0, i, label, self.styles['header'])
+        self.rownum = 1
+
+
+    def write_row(self, cells):
+        if self.rownum >= self.MAX_ROWS:
+            self.add_sheet()
+        style = self.styles[self.rownum % 2 and 'odd' or 'even']
+        for i, cell in enumerate(cells):
+            self.sheet.write(self.rownum, i, cell, style)
+        self.rownum += 1
+        if not self.rownum % self.FLUSH_INTERVAL:
+            self.sheet.flush_row_data()
+
+
+    def save(self, stream):
+        self.sheet.flush_row_data()
+        self.workbook.save(stream)
+
+
+
+def write_spreadsheet(view, stream, chunk_size=None):
+    """
+        Write the data of the view as an Excel file in this file object.
+    """
+    rows = iter_rows(view, chunk_size)
+    writer = SpreadsheetWriter(rows.next(), sheet_name=view.name)
+    for row in rows:
+        writer.write_row(row)
+    writer.save(stream)
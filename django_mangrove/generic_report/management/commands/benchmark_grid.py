@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Benchmark the data grid pipeline on a synthetic report (see
+    generic_report.benchmark) in a temporary SQLite database, and write
+    the results as JSON.
+"""
+
+import os
+import tempfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+from generic_report.benchmark import run_benchmark, AGGREGATIONS
+
+
+def get_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--records', type='int', default=1000,
+                    help='Number of records of the report'),
+        make_option('--values', type='int', default=4,
+                    help='Number of stored number indicators'),
+        make_option('--depth', type='int', default=3,
+                    help='Levels of nested calculated indicators'),
+        make_option('--districts', type='int', default=5,
+                    help='Number of districts'),
+        make_option('--villages', type='int', default=10,
+                    help='Number of villages per district'),
+        make_option('--aggregations', default=','.join(AGGREGATIONS),
+                    help='Comma separated aggregations of the views, among '\
+                         '%s' % ', '.join(AGGREGATIONS)),
+        make_option('--workers', default='1,2,4',
+                    help='Comma separated numbers of processes to compare'),
+        make_option('--engine', default=None,
+                    help="'python' or 'numpy', default to the settings"),
+        make_option('--repeat', type='int', default=3,
+                    help='Runs of each measure, the fastest one is kept'),
+        make_option('--seed', type='int', default=0,
+                    help='Seed of the generated records'),
+        make_option('--output', default=None,
+                    help='File to write the results to, default to stdout'),
+    )
+    help = 'Benchmark the data grid of synthetic reports'
+
+
+    def handle(self, *args, **options):
+
+        if not connection.settings_dict['ENGINE'].endswith('sqlite3'):
+            raise CommandError('The benchmark runs on SQLite only')
+
+        aggregations = get_list(options['aggregations'])
+        for aggregation in aggregations:
+            if aggregation not in AGGREGATIONS:
+                raise CommandError('Unknown aggregation: %s' % aggregation)
+        try:
+            workers = get_list(options['workers'], int)
+        except ValueError:
+            raise CommandError('Workers must be numbers')
+
+        # the database is in a file so the workers processes share it
+        fd, path = tempfile.mkstemp(suffix='.db', prefix='benchmark_grid')
+        os.close(fd)
+        connection.settings_dict['TEST_NAME'] = path
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = run_benchmark(options['records'], options['values'],
+                                    options['depth'], options['districts'],
+                                    options['villages'], aggregations,
+                                    options['engine'], workers or [1],
+                                    options['repeat'], options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if os.path.exists(path):
+                os.remove(path)
+
+        output = simplejson.dumps(results, indent=2)
+        if options['output']:
+            f = open(options['output'], 'w')
+            try:
+                f.write(output)
+            finally:
+                f.close()
+        else:
+            print output
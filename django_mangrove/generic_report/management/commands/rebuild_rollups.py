@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Create the period rollups again from the records, e.g: after adding
+    an indicator to a report that already has records.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from generic_report.models import Report, PeriodRollup
+
+
+class Command(BaseCommand):
+    
+    args = '[report_id report_id ...]'
+    help = 'Rebuild the period rollups of the given reports, or all reports'
+
+
+    def handle(self, *args, **options):
+    
+        reports = Report.objects.all()
+        if args:
+            reports = reports.filter(pk__in=args)
+            if reports.count() != len(set(args)):
+                raise CommandError('Some of the reports do not exist')
+        
+        for report in reports:
+            PeriodRollup.rebuild(report)
+            count = report.rollups.count()
+            print u'%s: %s rollups' % (report, count)
@@ -8,3 +8,6 @@ from _orderer import *
 from _paginator import *
 from _report import *
 from _indicator import *
+from _rollup import *
+from _version import *
+from _signals import *
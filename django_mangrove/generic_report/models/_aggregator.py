@@ -11,12 +11,14 @@
 import datetime
 
 from django.utils.translation import ugettext as _, ugettext_lazy as __
-from django.db import models
+from django.db import models, connection
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.utils.datastructures import SortedDict
 
 from simple_locations.models import AreaType
+from eav.models import Attribute
+
+from generic_report.engine import GridState, area_index
 
 
 class Aggregator(models.Model):
@@ -69,6 +71,31 @@ class Aggregator(models.Model):
         return self.strategy.get_aggregated_data(matrice)
 
 
+    def get_aggregated_value(self, value):
+        """
+            Return the value the data will be grouped around.
+        """
+        return self.strategy.get_aggregated_value(value)
+
+
+    def get_order_key(self, value):
+        """
+            Return what the group of this aggregated value is sorted by, or
+            None if groups are in the order of their first record.
+        """
+        return self.strategy.get_order_key(value)
+
+
+    def get_key_sql(self, column):
+        """
+            Return the SQL expression, using this value column, the 
+            database can group the data around, or None if the aggregation
+            can't be done in SQL.
+        """
+        return self.strategy.get_key_sql(self.indicator.concept.datatype, 
+                                         column)
+
+
     def format(self, value):
         """
             Return the aggregated value formated according to the type
@@ -124,38 +151,45 @@ class AggregatorType(models.Model):
             values related to the linked indicator.
         """
         
-        new_matrice = {}
         proxy = self.proxy.latest()
-        indicator = proxy.indicator
-        slug = indicator.concept.slug
-        view = proxy.view
+        slug = proxy.indicator.concept.slug
         
-        # aggregate the matrice
-        for data in matrice:
-            ref_value = indicator.value(view, data)
+        # the matrice must have been calculated already, so the value of 
+        # the indicator is in it
+        state = GridState(key_slug=slug, 
+                          aggregations=proxy.view.get_aggregations())
+        for i, data in enumerate(matrice):
+            ref_value = data[slug]
             
             # filter the data, excluding impossible to aggregate data
-            if not self.filter(ref_value):
-                continue
-            
-            aggreated_ref_value = self.get_aggregated_value(ref_value)
-            
-            new_data = new_matrice.setdefault(aggreated_ref_value, SortedDict())
-            
-            for name, value in data.iteritems():
-                print name, value
-                if name == slug:
-                    new_data[slug] = aggreated_ref_value
-                else:
-                    new = new_data.get(name, 0)
-                    # if an indicator is added later, they will be None values
-                    if value == None or new == None:
-                        new_data[name] = None   
-                    else:
-                        new_data[name] = new_data.get(name, 0) + value
+            if self.filter(ref_value):
+                state.add(i, data, self.get_aggregated_value(ref_value))
          
         # reformat it the way it was
-        return [value for key, value in new_matrice.iteritems()]
+        return state.get_grid()
+
+
+    def get_key_sql(self, datatype, column):
+        """
+            Return the SQL expression, using the given value column, the 
+            database can group the data around. The groups will be
+            aggregated again with get_aggregated_value() so the expression
+            doesn't have to give the exact same groups, just the same ones
+            or smaller ones.
+            
+            Return None if the database can't do it, which is the default.
+        """
+        return None
+
+
+    def get_order_key(self, value):
+        """
+            Return what the group of this aggregated value is sorted by. 
+            
+            This one returns None: groups are in the order of their first
+            record.
+        """
+        return None
 
 
     def format(self, value):
@@ -216,6 +250,19 @@ class DateAggregator(AggregatorType):
         self.formating_strategy = formating_strategies[self.time_period]
 
 
+    def get_key_sql(self, datatype, column):
+        """
+            Months and years are truncated by the database. There is no
+            portable way to truncate a week, so days and weeks are grouped
+            by date then aggregated again in Python.
+        """
+        if datatype != Attribute.TYPE_DATE:
+            return None
+        if self.time_period in ('month', 'year'):
+            return connection.ops.date_trunc_sql(self.time_period, column)
+        return column
+
+
     def get_aggregated_value(self, date):
         """
             Return the value, as an integer representing the day, month,
@@ -225,6 +272,24 @@ class DateAggregator(AggregatorType):
         return self.aggregation_strategy(date)
     
     
+    def filter(self, date):
+        """
+            Records without a date are not in any period.
+        """
+        return date is not None
+        
+        
+    def get_order_key(self, value):
+        """
+            Periods are in chronological order, whichever way the data was
+            aggregated (records, database or rollups).
+        """
+        if isinstance(value, tuple):
+            # (month or week, year)
+            return tuple(reversed(value))
+        return value
+        
+        
     def format(self, value):
         """
             Return the value, as a verbose string representing the 
@@ -253,6 +318,39 @@ class DateAggregator(AggregatorType):
         return date.year
     
 
+    @classmethod
+    def get_period_start(cls, period, date):
+        """
+            Return the first day of the period of this type containing the
+            date, as a date object. 
+            
+            Weeks starting the previous year start on January 1st, so all
+            the days of a period give the same aggregated value.
+        """
+        return dict(cls.PERIOD_STARTS)[period](date)
+
+
+    @classmethod
+    def start_of_day(cls, date):
+        return datetime.date(date.year, date.month, date.day)
+
+
+    @classmethod
+    def start_of_week(cls, date):
+        start = cls.start_of_day(date) - datetime.timedelta(days=date.weekday())
+        return max(start, datetime.date(date.year, 1, 1))
+
+
+    @classmethod
+    def start_of_month(cls, date):
+        return datetime.date(date.year, date.month, 1)
+
+
+    @classmethod
+    def start_of_year(cls, date):
+        return datetime.date(date.year, 1, 1)
+    
+
     @classmethod
     def format_day(cls, date):
         return format(date, "M dS, Y") # use the django format function
@@ -281,6 +379,11 @@ DateAggregator.AGGREGATION_STRATEGIES = (('day', DateAggregator.aggregate_by_day
                                          ('month', DateAggregator.aggregate_by_month),
                                          ('year', DateAggregator.aggregate_by_year),)  
                                              
+DateAggregator.PERIOD_STARTS = (('day', DateAggregator.start_of_day),
+                                ('week', DateAggregator.start_of_week),
+                                ('month', DateAggregator.start_of_month),
+                                ('year', DateAggregator.start_of_year),)
+
 DateAggregator.FORMATING_STRATEGIES = (('day', DateAggregator.format_day),
                                      ('week', DateAggregator.format_week),
                                      ('month', DateAggregator.format_month),
@@ -326,18 +429,9 @@ class LocationAggregator(AggregatorType):
             if it doesn't exist.
         """
         
-        # todo: ensure in simple location that you can't make an infinite 
-        # reference loop
-        
-        while 1:
-        
-            if location.kind == self.area_type:
-                return location
-                
-            location = location.parent
-            
-            if not location:
-                return None
+        # areas come from an index loaded once, so we don't query the 
+        # parent of each location for each record
+        return area_index.get_ancestor(location, self.area_type_id)
      
      
     def filter(self, location):
@@ -365,5 +459,16 @@ class ValueAggregator(AggregatorType):
         
         return value
         
+        
+    def get_key_sql(self, datatype, column):
+        """
+            Stored values can be grouped as is, except objects which are 
+            not stored in only one column.
+        """
+        if datatype in (Attribute.TYPE_INT, Attribute.TYPE_FLOAT, 
+                        Attribute.TYPE_TEXT, Attribute.TYPE_BOOLEAN):
+            return column
+        return None
+        
      
  
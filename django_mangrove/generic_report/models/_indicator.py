@@ -207,6 +207,19 @@ class Indicator(models.Model):
             raise ValueError('Can not format with an unsaved indicator')
         
         return self.strategy.format(view, data)    
+
+
+    def get_formatter(self, view):
+        """
+            Return a function formating the values of this indicator for
+            this view, so the strategy and the aggregators are looked up
+            once per column instead of once per value.
+        """
+        
+        if not self.strategy:
+            raise ValueError('Can not format with an unsaved indicator')
+        
+        return self.strategy.get_formatter(view, self)
     
     
     @classmethod
@@ -275,6 +288,26 @@ class Indicator(models.Model):
             This method is delegated to the strategy.
         """
         return self.strategy.get_dependancies()
+
+
+    def get_operands(self):
+        """
+            Returns the slugs of the indicators to pass, in order, to the
+            strategy calculate() method.
+            
+            This method is delegated to the strategy.
+        """
+        return self.strategy.get_operands(self)
+
+        
+    def get_aggregation(self):
+        """
+            Returns the way the values of this indicator are aggregated, or
+            None if it's calculated from aggregated values.
+            
+            This method is delegated to the strategy.
+        """
+        return self.strategy.aggregation
   
      
     def __unicode__(self):
@@ -294,12 +327,31 @@ class IndicatorType(models.Model):
     # todo: make proxy => _proxy and real 'proxy' an accessor
     proxy = generic.GenericRelation(Indicator, object_id_field="strategy_id",
                                     content_type_field="strategy_type")
+
+    # calculated indicators get their value from other indicators instead
+    # of the records, using the calculate() method. The operation name 
+    # is used by the columnar engine to calculate whole columns at once.
+    is_calculated = False
+    operation = None
+    
+    # the way the values are aggregated when the data is grouped (see
+    # engine.PARTIAL_STATES), or None if the value is calculated from the
+    # aggregated values of its operands, like a ratio of two sums.
+    aggregation = 'sum'
     
     def format(self, view, data):
         # don't call value() here as you don't want calculation
         # calculation run between strings
-    
-        return unicode(data[self.proxy.all()[0].concept.slug])
+        indicator = self.proxy.all()[0]
+        return self.get_formatter(view, indicator)(data[indicator.concept.slug])
+
+
+    def get_formatter(self, view, indicator):
+        """
+            Return a function taking a value of the indicator and returning
+            it formated.
+        """
+        return unicode
 
 
     def value(self, view, data):
@@ -338,6 +390,16 @@ class IndicatorType(models.Model):
         """
         proxy = self.proxy.all()[0]
         return [p.indicator for p in Parameter.objects.filter(param_of=proxy)]
+
+
+    def get_operands(self, indicator):
+        """
+            Returns the slugs of the indicators declared as parameters, 
+            in order.
+        """
+        parameters = indicator.params.all().order_by('order')
+        return [p.indicator.concept.slug for p in parameters.select_related(
+                                                        'indicator__concept')]
         
         
     
@@ -391,15 +453,24 @@ class RatioIndicator(IndicatorType):
     denominator = models.ForeignKey(Indicator, 
                                     related_name='denominator_of_ratio')
 
+    is_calculated = True
+    operation = 'ratio'
+    aggregation = None
+
     # todo: add checks for ratio to accept 2 and only two args
     def value(self, view, data):
         """
             Return a ratio between the values of the 2 indicators in this
             record.
         """
-        val = operator.truediv(self.numerator.value(view, data), 
-                               self.denominator.value(view, data))
-        return round(val, 2)
+        return self.calculate(self.numerator.value(view, data), 
+                              self.denominator.value(view, data))
+
+
+    def calculate(self, numerator, denominator):
+        if not denominator:
+            return None
+        return round(operator.truediv(numerator, denominator), 2)
 
 
     def get_dependancies(self):
@@ -409,6 +480,10 @@ class RatioIndicator(IndicatorType):
         return [self.numerator, self.denominator]
 
 
+    def get_operands(self, indicator):
+        return [self.numerator.concept.slug, self.denominator.concept.slug]
+
+
 
 # todo: add rate formating in the view
 class RateIndicator(IndicatorType): 
@@ -423,22 +498,31 @@ class RateIndicator(IndicatorType):
     numerator = models.ForeignKey(Indicator, related_name='numerator_of_rate')
     denominator = models.ForeignKey(Indicator, related_name='denominator_of_rate')
 
+    is_calculated = True
+    operation = 'rate'
+    aggregation = None
+
     # todo: add checks for rate to accept 2 and only two args
     def value(self, view, data):
         """
             Return a rate between the values of the 2 indicators in this
             record.
         """
-        val = operator.truediv(self.numerator.value(view, data), 
-                               self.denominator.value(view, data))
-        return round(val * 100, 2)
+        return self.calculate(self.numerator.value(view, data), 
+                              self.denominator.value(view, data))
 
 
-    def format(self, view, data):
+    def calculate(self, numerator, denominator):
+        if not denominator:
+            return None
+        return round(operator.truediv(numerator, denominator) * 100, 2)
+
+
+    def get_formatter(self, view, indicator):
         """
             Return the rate with a "%" sign
         """
-        return "%s %%" % data[self.proxy.all()[0].concept.slug]
+        return lambda value: "%s %%" % value
 
 
     def get_dependancies(self):
@@ -448,6 +532,10 @@ class RateIndicator(IndicatorType):
         return [self.numerator, self.denominator]
 
 
+    def get_operands(self, indicator):
+        return [self.numerator.concept.slug, self.denominator.concept.slug]
+
+
 class AverageIndicator(IndicatorType): 
     """
         Indicator strategy calculating the average of several EAV values 
@@ -457,13 +545,23 @@ class AverageIndicator(IndicatorType):
     class Meta:
         app_label = 'generic_report'
         
+    is_calculated = True
+    operation = 'average'
+    
+    # averages of each record are averaged again
+    aggregation = 'mean'
+        
     def value(self, view, data):
         """
             Return the average of the values for these indicators in this
             record.
         """
         parameters = self.proxy.all()[0].params.all().order_by('order')
-        values = [param.indicator.value(view, data) for param in parameters]
+        return self.calculate(*[p.indicator.value(view, data) 
+                                for p in parameters])
+
+
+    def calculate(self, *values):
         return round(operator.truediv(sum(values), len(values)), 2)  
 
 
@@ -476,13 +574,21 @@ class SumIndicator(IndicatorType):
     class Meta:
         app_label = 'generic_report'
 
+    is_calculated = True
+    operation = 'sum'
+
     def value(self, view, data):
         """
             Return the sum of the values for these indicators in this
             record.
         """
         parameters = self.proxy.all()[0].params.all().order_by('order')
-        return sum(param.indicator.value(view, data) for param in parameters)
+        return self.calculate(*[p.indicator.value(view, data) 
+                                for p in parameters])
+
+
+    def calculate(self, *values):
+        return sum(values)
 
 
 
@@ -495,14 +601,21 @@ class ProductIndicator(IndicatorType):
     class Meta:
         app_label = 'generic_report'
 
+    is_calculated = True
+    operation = 'product'
+
     def value(self, view, data):
         """
             Return the product of the values for these indicators in this
             record.
         """
         parameters = self.proxy.all()[0].params.all().order_by('order')
-        return reduce(operator.mul, 
-                     (param.indicator.value(view, data) for param in parameters))
+        return self.calculate(*[p.indicator.value(view, data) 
+                                for p in parameters])
+
+
+    def calculate(self, *values):
+        return reduce(operator.mul, values)
 
 
 # todo: check parameters: you can't subtract non numeric values
@@ -518,13 +631,20 @@ class DifferenceIndicator(IndicatorType):
     term_to_substract = models.ForeignKey(Indicator, 
                                           related_name='term_to_substract_of')
 
+    is_calculated = True
+    operation = 'difference'
+
     def value(self, view, data):
         """
             Return the difference of the values for these indicators in this
             record.
         """
-        return self.first_term.value(view, data) -\
-               self.term_to_substract.value(view, data)
+        return self.calculate(self.first_term.value(view, data),
+                              self.term_to_substract.value(view, data))
+
+
+    def calculate(self, first_term, term_to_substract):
+        return first_term - term_to_substract
 
 
     def get_dependancies(self):
@@ -532,6 +652,11 @@ class DifferenceIndicator(IndicatorType):
             Returns first_term and term_to_substract 
         """
         return [self.first_term, self.term_to_substract ]        
+
+
+    def get_operands(self, indicator):
+        return [self.first_term.concept.slug, 
+                self.term_to_substract.concept.slug]
         
 
 
@@ -546,20 +671,25 @@ class DateIndicator(IndicatorType):
         verbose_name_plural = __("Date Indicators")
         
         
-    # todo: make format more efficient        
-    def format(self, view, data):
+    def get_formatter(self, view, indicator):
         """
             Return a date according to the view format or any aggregator format.
-        """
-        indicator = self.proxy.all()[0]
-        date = self.value(view, data)
-
-        if not date:
-            return None
-
-        if view.aggregators.all().exists():
-            aggregator = view.aggregators.all()[0]
-            if aggregator.indicator == indicator:
-                return aggregator.format(date)
-
-        return date.strftime(view.time_format)
+            
+            Formated values are memorized since the same dates, months or
+            years appear again and again in a grid.
+        """
+        format = lambda date: date.strftime(view.time_format)
+        for aggregator in view.get_aggregators():
+            if aggregator.indicator_id == indicator.pk:
+                format = aggregator.format
+                break
+        
+        formated = {None: None}
+        def formatter(date):
+            if not date:
+                return None
+            try:
+                return formated[date]
+            except KeyError:
+                return formated.setdefault(date, format(date))
+        return formatter
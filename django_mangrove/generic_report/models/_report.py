@@ -2,15 +2,30 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4
 
+import math
 import datetime
-import eav
+import threading
+import multiprocessing
 
 from django.utils.translation import ugettext as _, ugettext_lazy as __
-from django.db import models
+from django.db import models, connections, transaction
+from django.contrib.contenttypes.models import ContentType
 from django.utils.datastructures import SortedDict
+from django.db.models import Max
 from django.db.models.signals import m2m_changed
 
+from eav.models import Value
+
 from _indicator import SelectedIndicator, ValueIndicator, LocationIndicator
+from _aggregator import DateAggregator
+from _rollup import PeriodRollup
+from _view_plan import ViewPlan
+
+from generic_report import conf
+from generic_report.engine import (RecordLoader, EvaluationPlan, ColumnarGrid,
+                                   GridState, SQLAggregation, grid_cache,
+                                   bulk_insert, GRID_ENGINES)
+from generic_report.signals import record_changed
 
 
 """
@@ -54,6 +69,38 @@ class Report(models.Model):
         sa_inds = ('valueindicator', 'dateindicator', 'locationindicator')
         indicators = self.indicators.all()
         return [i for i in indicators if i.strategy_type.model in sa_inds]
+        
+        
+    def get_extraction(self, engine=None):
+        """
+            Return the data of all the records for all the indicators of
+            the report, calculated but not aggregated nor formated, as a
+            sorted dict mapping each record id to its data.
+            
+            The extraction is cached until the report data or definition 
+            changes, and all the views of the report start from it instead 
+            of reading the records again. It must not be modified.
+        """
+        engine = engine or conf.GRID_ENGINE
+        key = grid_cache.get_report_key(self, 'extraction.%s' % engine)
+        extraction = grid_cache.get(key)
+        if extraction is None:
+            extraction = self._create_extraction(engine)
+            grid_cache.set(key, extraction)
+        return extraction
+        
+        
+    def _create_extraction(self, engine=None):
+        """
+            Load the values of all the indicators of the report and the 
+            indicators they depend on, then calculate them.
+        """
+        indicators = self.indicators.select_related('concept')
+        plan = EvaluationPlan(indicators)
+        indicators = plan.sort(indicators)
+        rows = RecordLoader(indicators).get_rows(self.records.all())
+        plan.update_grid(rows.values(), engine or conf.GRID_ENGINE)
+        return rows
             
 
 
@@ -90,8 +137,18 @@ class ReportView(models.Model):
                                    blank=True)  
 
    
-    # todo: rework this part. Too many get_something_indicators. This is
-    # neither efficient nor clear.
+    def get_view_plan(self):
+        """
+            Return the indicators and aggregators of this view, loaded at
+            once (see ViewPlan). Plans are loaded only once per view object
+            and schema version.
+        """
+        version = grid_cache.get_schema_version()
+        plan = self.__dict__.get('_view_plan')
+        if plan is None or plan[0] != version:
+            plan = self.__dict__['_view_plan'] = (version, ViewPlan(self))
+        return plan[1]
+
 
     def get_selected_indicators(self):
         """
@@ -99,8 +156,7 @@ class ReportView(models.Model):
             - get indicators from the selected indicator proxys
             - remove indicators that can not be displayed for this specific view
         """
-        sis = self.selected_indicators.all().order_by('order')
-        return [si.indicator for si in sis]
+        return list(self.get_view_plan().selected_indicators)
 
 
     def get_indicators(self):
@@ -108,17 +164,15 @@ class ReportView(models.Model):
             Return all indicators, but with selected indicator ordered first
             so order is kept.
         """
-        inds = self.get_selected_indicators()
-        return inds + [i for i in self.report.indicators.all() if i not in inds]
+        return list(self.get_view_plan().indicators)
         
     
     def get_numerical_indicators(self, queryset=None):  
         """
             Return indicators with INT or FLOAT concepts
         """
-        indicators = queryset or self.get_indicators()
-        types = (eav.models.Attribute.TYPE_INT, eav.models.Attribute.TYPE_FLOAT) 
-        return [i for i in indicators if i.concept.datatype in types]
+        plan = self.get_view_plan()
+        return plan.get_numerical(queryset or plan.indicators)
 
 
     # todo: add unit test for this
@@ -127,18 +181,45 @@ class ReportView(models.Model):
             Return the indicators that can be displayed for this view by
             removing indicators that can not be displayed for this specific view
         """
+        plan = self.get_view_plan()
+        if not queryset:
+            return list(plan.selectable_indicators)
         
-        indicators = queryset or self.get_indicators()
+        # if there is an aggregation, remove non numeric indicators except
+        # the ones the data is grouped around
+        return plan.get_selectable(queryset)
         
-        # if there is an aggregation, remove non numeric indicators
-        if self.aggregators.all().exists():
-            aggregator = self.aggregators.all()[0]
-            filtered_indicators = self.get_numerical_indicators(indicators)
-            for indicator in indicators:
-                if indicator.concept == aggregator.indicator.concept:
-                   filtered_indicators.append(indicator)
-            return filtered_indicators
-        return indicators
+        
+    def get_demanded_indicators(self):
+        """
+            Return the indicators we need to calculate to display this view:
+            the displayed ones, the ones the data is grouped around, and all
+            the indicators they depend on. Other indicators of the report 
+            are neither loaded nor calculated.
+        """
+        return list(self.get_view_plan().demanded_indicators)
+        
+        
+    def get_aggregators(self):
+        """
+            Return the aggregators of this view, in the order they were
+            added.
+        """
+        return list(self.get_view_plan().aggregators)
+        
+        
+    def get_key_slug(self, aggregators=None):
+        """
+            Return the slug of the indicator the data is grouped around, a
+            tuple of slugs if there are several aggregators, or None if the
+            data is not aggregated.
+        """
+        if aggregators is None:
+            aggregators = self.get_aggregators()
+        slugs = tuple(a.indicator.concept.slug for a in aggregators)
+        if len(slugs) < 2:
+            return slugs and slugs[0] or None
+        return slugs
 
     
     def get_indicators_to_display(self):
@@ -146,7 +227,7 @@ class ReportView(models.Model):
             Filter selected indicators to get only the one we want and can 
             display
         """
-        return self.get_selectable_indicators(self.get_selected_indicators())
+        return list(self.get_view_plan().indicators_to_display)
 
 
     def get_labels(self):
@@ -155,14 +236,94 @@ class ReportView(models.Model):
    
     def _create_data_grid(self):
         """
-            Turn records into a list or sorted dicts
+            Turn records into a list or sorted dicts. 
+            
+            Values are loaded in bulk for all records, so the number of 
+            queries doesn't depend of the number of records.
+        """
+        indicators, rows = self._create_data_rows()
+        return indicators, rows.values()
+        
+        
+    def _create_data_rows(self):
+        """
+            Same as _create_data_grid() but the data is returned as a sorted
+            dict mapping each record id to its data.
         """
         records = self.report.records.all()
-        indicators = self.get_selectable_indicators()
-        grid = [record.to_sorted_dict(indicators) for record in records]
-        return indicators, grid
+        indicators = self.get_demanded_indicators()
+        return indicators, RecordLoader(indicators).get_rows(records)
+        
+        
+    def _shares_extraction(self):
+        """
+            Return True if the views of the report should start from the 
+            report extraction: with several views, calculating all the 
+            indicators once is cheaper than reading the records for each 
+            view. With only one, the view calculates only what it needs.
+        """
+        return self.report.views.count() > 1
+        
+        
+    def _get_extracted_rows(self, indicators, engine=None, create=True):
+        """
+            Return a sorted dict mapping each record id to its data for 
+            these indicators, calculated, taken from the report extraction.
+            
+            Return None if the extraction doesn't have all the indicators,
+            which happens if they are not all in the report, or if it's not
+            cached and 'create' is False.
+        """
+        if create:
+            extraction = self.report.get_extraction(engine)
+        else:
+            engine = engine or conf.GRID_ENGINE
+            extraction = grid_cache.get(grid_cache.get_report_key(self.report,
+                                                'extraction.%s' % engine))
+            if extraction is None:
+                return None
+        slugs = []
+        for indicator in indicators:
+            if indicator.concept.slug not in slugs:
+                slugs.append(indicator.concept.slug)
+        
+        rows = SortedDict()
+        for record_id, data in extraction.iteritems():
+            try:
+                rows[record_id] = SortedDict((slug, data[slug]) for slug in slugs)
+            except KeyError:
+                return None
+        return rows
        
     
+    def get_evaluation_plan(self, indicators=None, aggregated=False):
+        """
+            Return the evaluation plan calculating these indicators, or if
+            'aggregated' is True, the ones derived from aggregated values. 
+            
+            Plans are compiled only once per view object, set of indicators
+            and schema version.
+        """
+        indicators = indicators or self.get_demanded_indicators()
+        plans = self.__dict__.setdefault('_evaluation_plans', {})
+        key = (grid_cache.get_schema_version(), aggregated)
+        key += tuple(i.pk for i in indicators)
+        try:
+            return plans[key]
+        except KeyError:
+            return plans.setdefault(key, EvaluationPlan(indicators, aggregated))
+            
+            
+    def get_aggregations(self, indicators=None):
+        """
+            Return a sorted dict mapping the slug of each indicator to the
+            way its values are aggregated (see Indicator.get_aggregation()).
+        """
+        indicators = indicators or self.get_demanded_indicators()
+        return SortedDict((i.concept.slug, i.get_aggregation()) 
+                          for i in indicators)
+
+
     def _update_grid_with_calculated_data(self, grid, indicators=None):
         """
             Fill the grid with data calculated from it.
@@ -171,24 +332,67 @@ class ReportView(models.Model):
             
             This modifies the grid in place but return the grid for convenience.
         """
-        # todo: optimise this to only call value indicator that calculate it
-        indicators = indicators or self.get_selectable_indicators()
-        for record in grid:
-            for indic in indicators:
-                record[indic.concept.slug] = indic.value(self, record) 
-        return grid
+        return self.get_evaluation_plan(indicators).update_grid(grid)
                 
 
     def _aggregate_data_grid(self, grid):
         """
-            Fill the grid with data calculated from it
+            Group the data of the calculated grid around the values of all 
+            the aggregators at once.
         """
-        for aggregator in self.aggregators.all():
-            grid = aggregator.get_aggregated_data(grid)
+        aggregators = self.get_aggregators()
+        state = GridState(key_slug=self.get_key_slug(aggregators),
+                          aggregations=self.get_aggregations())
+        for i, data in enumerate(grid):
+            keep, key = self._get_group_key(aggregators, data)
+            if keep:
+                state.add(i, data, key)
+        grid = state.get_grid(self.get_evaluation_plan(aggregated=True))
+        return self._sort_groups(grid, aggregators)
+        
+        
+    def _sort_groups(self, grid, aggregators=None):
+        """
+            Sort the groups of an aggregated grid, not formated yet, if the
+            view has one aggregator giving an order (e.g: by date). Else 
+            they stay in the order of their first record.
+            
+            WARNING:
+            
+            This modifies the grid in place but return the grid for convenience.
+        """
+        if aggregators is None:
+            aggregators = self.get_aggregators()
+        if len(aggregators) == 1:
+            aggregator = aggregators[0]
+            slug = aggregator.indicator.concept.slug
+            if grid and aggregator.get_order_key(grid[0].get(slug)) is not None:
+                grid.sort(key=lambda data: aggregator.get_order_key(
+                                                            data.get(slug)))
         return grid
 
 
-    def _format_data_grid(self, grid, indicators=None):
+    def get_formatters(self, indicators=None):
+        """
+            Return a sorted dict mapping the slug of each indicator to 
+            display to the function formating its values (see 
+            Indicator.get_formatter()).
+            
+            Formatters are created only once per view object, set of 
+            indicators and schema version, so the values they memorize are
+            reused from a chunk of data to another.
+        """
+        indicators = indicators or self.get_indicators_to_display()
+        formatters = self.__dict__.setdefault('_formatters', {})
+        key = (grid_cache.get_schema_version(),) + tuple(i.pk for i in indicators)
+        try:
+            return formatters[key]
+        except KeyError:
+            return formatters.setdefault(key, SortedDict(
+                        (i.concept.slug, i.get_formatter(self)) for i in indicators))
+
+
+    def _format_data_grid(self, grid, indicators=None, formatters=None):
         """
             Fill the grid with formated data, and removing data that is
             not meant to be displayed.
@@ -200,39 +404,556 @@ class ReportView(models.Model):
             You can't call update_grid_with_calulated_data() after it since 
             all values will be strings.
         """
-        indicators = indicators or self.get_indicators_to_display()
-        sis = SortedDict((i.concept.slug, i) for i in indicators)
+        formatters = formatters or self.get_formatters(indicators)
         for record in grid:
             for key in record.keys():
-                try:
-                    record[key] = sis[key].format(self, record)
-                except KeyError:
+                if key not in formatters:
                     del record[key]
+        
+        # format column by column, each one with its own formatter
+        for slug, formatter in formatters.iteritems():
+            for record in grid:
+                if slug in record:
+                    record[slug] = formatter(record[slug])
         return grid
         
 
-    # cache that
-    def get_data_grid(self):
+    def _create_columnar_grid(self, indicators, grid):
+        """
+            Turn the grid into a ColumnarGrid and calculate the calculated
+            indicators on whole columns.
+        """
+        columns = ColumnarGrid.from_rows(grid, [i.concept.slug 
+                                                for i in indicators])
+        return columns.evaluate(self.get_evaluation_plan(indicators))
+        
     
-        indicators, grid = self._create_data_grid()
-         
-        # Todo: cache this basic extraction, use it as a base for the other views
-        self._update_grid_with_calculated_data(grid, indicators)
+    def get_columnar_grid(self):
+        """
+            Return the data of the report with the calculated indicators,
+            but not aggregated nor formated, as a ColumnarGrid object:
+            one numpy array per indicator. Requires numpy.
+        """
+        return self._create_columnar_grid(*self._create_data_grid())
 
-        grid = self._aggregate_data_grid(grid)
 
-        # calculate the calculated indicators again so stuff like average get
-        # it right
-        self._update_grid_with_calculated_data(grid, indicators)
+    def get_data_grid(self, engine=None, workers=None):
+        """
+            Return the data of the report for this view as a list of 
+            sorted dicts of formated values.
+            
+            'engine' is the way to calculate the indicators: 'python', or
+            'numpy' to use the columnar grid. Default to the 
+            GENERIC_REPORT_GRID_ENGINE setting.
+            
+            'workers' is the number of processes computing the grid if the
+            database can't aggregate it. Default to the 
+            GENERIC_REPORT_WORKERS setting.
+            
+            The grid is cached for each engine until the report data or 
+            definition changes. The number of workers doesn't change the
+            result, so it's not part of the cache key.
+        """
+        engine = engine or conf.GRID_ENGINE
+        key = grid_cache.get_view_key(self, 'grid.%s' % engine)
+        grid = grid_cache.get(key)
+        if grid is None:
+            grid = self._compute_data_grid(engine, workers=workers)
+            grid_cache.set(key, grid)
+        
+        # the cached grid must not be modified by the caller
+        return [data.copy() for data in grid]
+        
+        
+    def iter_data_grid(self, chunk_size=None, cache=True):
+        """
+            Same as get_data_grid() but yield the formated data dicts one by
+            one. 
+            
+            If the grid is not cached, records are read by chunks of 
+            'chunk_size' (default to the GENERIC_REPORT_CHUNK_SIZE setting).
+            For aggregated views, only the groups are kept in memory, and
+            the grid state is cached as get_grid_state() does.
+            
+            If 'cache' is True, the formated grid is kept as it's yielded
+            and cached once it's complete, so the next calls don't read the
+            records. Pass False for exports of big views: the memory used 
+            then doesn't depend of the number of records.
+        """
+        
+        engine = conf.GRID_ENGINE
+        grid_key = grid_cache.get_view_key(self, 'grid.%s' % engine)
+        grid = grid_cache.get(grid_key)
+        if grid is not None:
+            for data in grid:
+                yield data.copy()
+            return
+        
+        # another view already loaded all the records, or will: exports 
+        # not caching the grid still read the records by chunks
+        extraction_key = grid_cache.get_report_key(self.report, 
+                                                   'extraction.%s' % engine)
+        if (grid_cache.get(extraction_key) is not None or 
+            (cache and self._shares_extraction())):
+            for data in self.get_data_grid():
+                yield data
+            return
+        
+        grid = []
+        for data in self._iter_data_grid(engine, chunk_size):
+            if cache:
+                grid.append(data.copy())
+            yield data
+        if cache:
+            grid_cache.set(grid_key, grid)
+            
+            
+    def _iter_data_grid(self, engine, chunk_size=None):
+    
+        aggregators = self.get_aggregators()
+        
+        indicators = self.get_demanded_indicators()
+        formatters = self.get_formatters()
+        plan = self.get_evaluation_plan(indicators)
+        
+        state_key = grid_cache.get_view_key(self, 'state.%s' % engine)
+        state = grid_cache.get(state_key)
+        
+        if state is None and not aggregators:
+            loader = RecordLoader(indicators)
+            chunks = loader.iter_rows(self.report.records.all(), 
+                                      chunk_size or conf.GRID_CHUNK_SIZE)
+            for rows in chunks:
+                grid = plan.update_grid(rows.values())
+                for data in self._format_data_grid(grid, formatters=formatters):
+                    yield data
+            return
+        
+        if state is None and conf.GRID_SQL_AGGREGATION:
+            state = self._create_grid_state_in_db(indicators)
+        
+        if state is None:
+            state = GridState(key_slug=self.get_key_slug(aggregators),
+                              aggregations=self.get_aggregations(indicators))
+            loader = RecordLoader(indicators)
+            chunks = loader.iter_rows(self.report.records.all(), 
+                                      chunk_size or conf.GRID_CHUNK_SIZE)
+            for rows in chunks:
+                for record_id, data in rows.iteritems():
+                    plan.evaluate(data)
+                    keep, key = self._get_group_key(aggregators, data)
+                    if keep:
+                        state.add(record_id, data, key)
+        
+        # the state is small, and updated when records change
+        grid_cache.set(state_key, state)
+        
+        plan = self.get_evaluation_plan(indicators, aggregated=True)
+        grid = self._sort_groups(state.get_grid(plan), aggregators)
+        for data in grid:
+            yield self._format_data_grid([data], formatters=formatters)[0]
+        
+        
+    def _compute_data_grid(self, engine=None, state=None, workers=None):
+    
+        state = state or self.get_grid_state(engine, workers)
+        
+        # indicators derived from aggregated values, like ratios, are 
+        # calculated for each group
+        grid = state.get_grid(self.get_evaluation_plan(aggregated=True))
+        self._sort_groups(grid)
        
         # enventually, format the data 
         self._format_data_grid(grid)
         
         return grid
+        
+        
+    def get_grid_state(self, engine=None, workers=None):
+        """
+            Return the data of the report for this view, calculated and 
+            aggregated but not formated, as a GridState object.
+            
+            The state is cached until the report definition changes, and 
+            it's updated when a record is saved or deleted (see 
+            update_grid_state()).
+        """
+        engine = engine or conf.GRID_ENGINE
+        key = grid_cache.get_view_key(self, 'state.%s' % engine)
+        state = grid_cache.get(key)
+        if state is None:
+            state = self._create_grid_state(engine, workers=workers)
+            grid_cache.set(key, state)
+        return state
+        
+        
+    def _create_grid_state(self, engine=None, sql_aggregation=None, 
+                           workers=None):
+        """
+            Create the grid state from all the records of the report.
+            
+            If 'sql_aggregation' is True (default to the 
+            GENERIC_REPORT_SQL_AGGREGATION setting), the data is aggregated
+            by the database when it's possible.
+            
+            Else, if 'workers' is more than 1 (default to the 
+            GENERIC_REPORT_WORKERS setting), the report extraction is
+            not in the cache and processes can be used (see 
+            _can_use_processes()), the records are computed by several 
+            processes (see _create_grid_state_in_parallel()).
+        """
+    
+        engine = engine or conf.GRID_ENGINE
+        workers = workers or conf.GRID_WORKERS
+        
+        if sql_aggregation is None:
+            sql_aggregation = conf.GRID_SQL_AGGREGATION
+        if sql_aggregation:
+            state = self._create_grid_state_in_db()
+            if state is not None:
+                return state
+        
+        # the extraction of the report is used if the report has several
+        # views or if it's already cached, else only the indicators of this
+        # view are calculated
+        indicators = self.get_demanded_indicators()
+        rows = self._get_extracted_rows(indicators, engine, 
+                                        create=self._shares_extraction())
+        if rows is None and workers > 1 and _can_use_processes():
+            return self._create_grid_state_in_parallel(engine, workers)
+        
+        if rows is None:
+            indicators, rows = self._create_data_rows()
+            plan = self.get_evaluation_plan(indicators)
+            plan.update_grid(rows.values(), engine)
+        return self._create_grid_state_from_rows(rows, indicators)
+        
+        
+    def _create_grid_state_from_rows(self, rows, indicators):
+        """
+            Create the grid state from a sorted dict mapping record ids to
+            their calculated data.
+        """
+        # with several aggregators, the data is grouped around all their 
+        # values at once
+        aggregators = self.get_aggregators()
+        state = GridState(key_slug=self.get_key_slug(aggregators),
+                          aggregations=self.get_aggregations(indicators))
+        for record_id, data in rows.iteritems():
+            keep, key = self._get_group_key(aggregators, data)
+            if keep:
+                state.add(record_id, data, key)
+        return state
+        
+        
+    def _create_grid_state_in_parallel(self, engine=None, workers=None, 
+                                       partitions=None):
+        """
+            Split the records in 'partitions' ranges of ids (default to 
+            the number of workers), create the grid state of each range in
+            a pool of 'workers' processes, then combine them in the order 
+            of the ids. The result is the same than with one process.
+            
+            With only one worker, the partitions are computed one after the
+            other in this process.
+            
+            The connections of this process are closed before starting the
+            pool: several workers are refused if it's not possible (see 
+            _can_use_processes()).
+        """
+        engine = engine or conf.GRID_ENGINE
+        workers = workers or conf.GRID_WORKERS
+        if workers > 1 and not _can_use_processes():
+            raise ValueError(u'The grid state can not be computed by several '
+                             u'processes in a managed transaction or with an '
+                             u'in-memory database')
+        
+        ranges = self.get_partitions(partitions or workers)
+        tasks = [(self.pk, first_id, next_id, engine) 
+                 for first_id, next_id in ranges]
+        
+        if workers > 1 and len(tasks) > 1:
+            # the processes must not share the connections of this one
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+            try:
+                states = pool.map(_compute_partition_state, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            states = map(_compute_partition_state, tasks)
+        
+        state = GridState(key_slug=self.get_key_slug(), 
+                          aggregations=self.get_aggregations())
+        for partition_state in states:
+            state.combine(partition_state)
+        return state
+        
+        
+    def get_partitions(self, count):
+        """
+            Return at most 'count' ranges of ids of the records of the 
+            report with the same number of records, as a list of (first 
+            id, first id of the next range), the last one being None.
+        """
+        ids = self.report.records.order_by('pk').values_list('pk', flat=True)
+        total = ids.count()
+        if not total:
+            return []
+        size = int(math.ceil(float(total) / max(count, 1)))
+        starts = [ids[offset] for offset in range(0, total, size)]
+        return zip(starts, starts[1:] + [None])
+        
+        
+    def _create_partition_state(self, first_id, next_id, engine=None):
+        """
+            Create the grid state of the records of the report with an id 
+            in this range ('next_id' being excluded, or None for no limit).
+        """
+        records = self.report.records.filter(pk__gte=first_id)
+        if next_id is not None:
+            records = records.filter(pk__lt=next_id)
+        indicators = self.get_demanded_indicators()
+        rows = RecordLoader(indicators).get_rows(records.order_by('pk'))
+        self.get_evaluation_plan(indicators).update_grid(rows.values(), 
+                                                         engine)
+        return self._create_grid_state_from_rows(rows, indicators)
+        
+        
+    def _create_grid_state_in_db(self, indicators=None):
+        """
+            Create the grid state with the database doing the grouping and
+            the summing, then apply the calculated indicators on the groups.
+            
+            It's possible only if the view has one aggregator that can give
+            an SQL expression to group around, and if all other indicators
+            are stored numbers aggregated by sum or derived from aggregated 
+            values. Return None otherwise.
+            
+            Views aggregated by date read the period rollups of the report
+            if they are complete, instead of the records.
+        """
+        
+        aggregators = self.get_aggregators()
+        if len(aggregators) != 1:
+            return None
+        aggregator = aggregators[0]
+        key_indicator = aggregator.indicator
+        
+        if key_indicator.strategy.is_calculated:
+            return None
+        if aggregator.get_key_sql('column') is None:
+            return None
+            
+        indicators = indicators or self.get_demanded_indicators()
+        key_slug = key_indicator.concept.slug
+        attributes = []
+        aggregations = self.get_aggregations(indicators)
+        for indicator in indicators:
+            concept = indicator.concept
+            if concept.slug == key_slug:
+                continue
+            aggregation = aggregations[concept.slug]
+            if indicator.strategy.is_calculated and aggregation is None:
+                continue
+            if indicator.strategy.is_calculated or aggregation != 'sum':
+                return None
+            if concept.datatype not in SQLAggregation.NUMERICAL_TYPES:
+                return None
+            attributes.append(concept)
+        
+        groups = None
+        strategy = aggregator.strategy
+        if conf.GRID_ROLLUPS and isinstance(strategy, DateAggregator):
+            groups = PeriodRollup.get_groups(self.report, key_indicator.concept,
+                                             strategy.time_period, attributes)
+        if groups is None:
+            query = SQLAggregation(self.report.records.all(), 
+                                   key_indicator.concept, 
+                                   aggregator.get_key_sql, attributes)
+            groups = query.get_groups()
+        
+        names = [i.concept.slug for i in indicators]
+        state = GridState(key_slug=key_slug, aggregations=aggregations)
+        for value, count, sums, nulls in groups:
+            keep, key = self._get_group_key(aggregators, {key_slug: value})
+            if keep:
+                state.add_group(key, names, count, sums, nulls)
+        return state
+        
+        
+    def _get_group_key(self, aggregators, data):
+        """
+            Return a tuple (keep, key): if the data can be aggregated by all
+            the aggregators and which value it will be grouped around. With
+            several aggregators, the key is a tuple of their values.
+        """
+        if not aggregators:
+            return True, None
+        key = []
+        for aggregator in aggregators:
+            value = data[aggregator.indicator.concept.slug]
+            if not aggregator.filter(value):
+                return False, None
+            key.append(aggregator.get_aggregated_value(value))
+        if len(key) == 1:
+            return True, key[0]
+        return True, tuple(key)
+        
+        
+    def get_columns(self):
+        """
+            Return the data of the view as a sorted dict mapping the slug of
+            each displayed indicator to the list of its values, in the same
+            order for all the indicators. 
+            
+            Numbers are not formated so they can be used for graphs, other 
+            values are formated like in the data grid.
+        """
+        indicators = self.get_indicators_to_display()
+        numerical = self.get_view_plan().get_numerical(indicators)
+        formatters = self.get_formatters(indicators)
+        columns = SortedDict((i.concept.slug, []) for i in indicators)
+        
+        fillers = []
+        for indicator in indicators:
+            slug = indicator.concept.slug
+            formatter = None
+            if indicator not in numerical:
+                formatter = formatters[slug]
+            fillers.append((slug, columns[slug].append, formatter))
+        
+        plan = self.get_evaluation_plan(aggregated=True)
+        for data in self.get_grid_state().iter_grid(plan):
+            for slug, append, formatter in fillers:
+                value = data.get(slug)
+                if formatter is not None:
+                    value = formatter(value)
+                append(value)
+        return columns
+        
+        
+    def get_etag(self):
+        """
+            Return a string that changes each time the data of this view
+            may change: when the records of the report or the definition 
+            of the reports change.
+            
+            It's made of the versions of the grid cache, which are shared
+            by all the processes (see GridCache.versions) and read again at
+            the start of each request, so all the processes give the same 
+            ETag for the same data.
+        """
+        versions = grid_cache.get_versions('report.%s' % self.report_id, 
+                                           'schema')
+        return '%s-%s-%s' % tuple([self.pk] + versions)
+        
+        
+    def get_crosstab(self, indicator=None):
+        """
+            Return the data of a view with two aggregators as a matrix for 
+            one indicator, e.g: districts by months. By default, the 
+            indicator is the first displayed one that is not aggregated 
+            around.
+            
+            The matrix is a dict:
+            
+            {'rows': [labels of the values of the first aggregator],
+             'columns': [labels of the values of the second aggregator],
+             'cells': [[value, value, ...], ...]}
+             
+            Labels are formated by the aggregators. Values are not formated 
+            so they can be used for graphs, and are None if there is no 
+            data for this row and this column.
+        """
+        aggregators = self.get_aggregators()
+        if len(aggregators) != 2:
+            raise ValueError(u'A crosstab needs a view with two aggregators')
+        
+        key_slug = self.get_key_slug(aggregators)
+        if indicator is None:
+            slugs = [i.concept.slug for i in self.get_indicators_to_display()
+                     if i.concept.slug not in key_slug]
+            if not slugs:
+                raise ValueError(u'No indicator to display in the crosstab')
+            slug = slugs[0]
+        else:
+            slug = indicator.concept.slug
+        
+        state = self.get_grid_state()
+        plan = self.get_evaluation_plan(aggregated=True)
+        row_keys, column_keys, cells = state.get_crosstab(plan)
+        
+        return {'rows': [aggregators[0].format(k) for k in row_keys],
+                'columns': [aggregators[1].format(k) for k in column_keys],
+                'cells': [[data and data[slug] for data in row.itervalues()]
+                          for row in cells.itervalues()]}
+        
+        
+    def update_grid_state(self, record_id, old_data, new_data, data_version):
+        """
+            Update the cached grid state with the change of one record, 
+            without reading the other records.
+            
+            'old_data' and 'new_data' are the raw data of the record before 
+            and after the change (None if it's created or deleted), 
+            'data_version' the version of the report data before the change.
+            
+            If there is no cached state for this version, it will be 
+            created from all the records the next time we need it.
+        """
+        
+        # there is one state per engine
+        for engine in GRID_ENGINES:
+            name = 'state.%s' % engine
+            state = grid_cache.get(grid_cache.get_view_key(self, name, 
+                                                           data_version))
+            if state is not None and state.incremental:
+                self._update_grid_state(state, record_id, old_data, new_data)
+                grid_cache.set(grid_cache.get_view_key(self, name), state)
+                
+                
+    def _update_grid_state(self, state, record_id, old_data, new_data):
+        
+        indicators = self.get_demanded_indicators()
+        plan = self.get_evaluation_plan(indicators)
+        aggregators = state.aggregated and self.get_aggregators() or []
+        
+        changes = []
+        for raw_data in (old_data, new_data):
+            change = None
+            if raw_data is not None:
+                data = SortedDict((i.concept.slug, raw_data.get(i.concept.slug)) 
+                                   for i in indicators)
+                plan.evaluate(data)
+                keep, group_key = self._get_group_key(aggregators, data)
+                if keep:
+                    change = (data, group_key)
+            changes.append(change)
+            
+        old, new = changes
+        if old and new:
+            state.replace(record_id, old[0], new[0], old[1], new[1])
+        elif old:
+            state.remove(record_id, *old)
+        elif new:
+            state.add(record_id, *new)
             
         
     def get_extracted_data(self):
-        return []
+        """
+            Return the data of the records for the indicators of this view,
+            calculated but not aggregated nor formated, as a list of sorted
+            dicts.
+        """
+        indicators = self.get_demanded_indicators()
+        rows = self._get_extracted_rows(indicators)
+        if rows is None:
+            indicators, rows = self._create_data_rows()
+            self._update_grid_with_calculated_data(rows.values(), indicators)
+        return rows.values()
        
        
     @classmethod
@@ -307,10 +1028,174 @@ class Record(models.Model):
     validated = models.BooleanField(default=False)
     report =  models.ForeignKey(Report, related_name='records') 
     
+    # records this thread is saving or deleting
+    _changing = threading.local()
+    
+    
+    @classmethod
+    def is_changing(cls, record_id):
+        """
+            Return True if this thread is saving or deleting the record with
+            this id: the data version of its report will be bumped once at 
+            the end, not for each of its values.
+        """
+        stack = getattr(cls._changing, 'stack', ())
+        return record_id in [record.pk for record in stack]
+        
+        
+    def _change(self, method, *args, **kwargs):
+        """
+            Call the Model method saving or deleting the record, then bump 
+            the data version of the report once.
+        """
+        if not hasattr(self._changing, 'stack'):
+            self._changing.stack = []
+        stack = self._changing.stack
+        stack.append(self)
+        try:
+            method(self, *args, **kwargs)
+        finally:
+            stack.pop()
+        grid_cache.bump_data_version(self.report_id)
+    
+    
     def __unicode__(self):
         return _("Record %(record)s (sent on %(date)s) of report %(report)s") % {
                  'record': self.pk, 'report': self.report, 'date': self.date}
 
+    def save(self, *args, **kwargs):
+        """
+            Save the record then send the 'record_changed' signal with the 
+            data of the record before and after the change.
+        """
+        old_data = None
+        if self.pk:
+            old_data = self.get_data()
+        # the version must not be an old one this thread read before 
+        # an other process changed the data
+        grid_cache.forget_versions()
+        data_version = grid_cache.get_data_version(self.report_id)
+        
+        self._change(models.Model.save, *args, **kwargs)
+        
+        record_changed.send(sender=Record, record=self, record_id=self.pk,
+                            old_data=old_data, new_data=self.get_data(),
+                            data_version=data_version)
+
+
+    def delete(self, *args, **kwargs):
+        """
+            Delete the record then send the 'record_changed' signal with the 
+            data of the record before the deletion.
+        """
+        record_id = self.pk
+        old_data = self.get_data()
+        # the version must not be an old one this thread read before 
+        # an other process changed the data
+        grid_cache.forget_versions()
+        data_version = grid_cache.get_data_version(self.report_id)
+        
+        self._change(models.Model.delete, *args, **kwargs)
+        
+        record_changed.send(sender=Record, record=self, record_id=record_id,
+                            old_data=old_data, new_data=None, 
+                            data_version=data_version)
+        
+        
+    @classmethod
+    @transaction.commit_on_success
+    def create_in_bulk(cls, report, data_list, dates=None):
+        """
+            Create a record of the report for each data dict of the list,
+            mapping slugs of stand alone indicators to values, in one
+            transaction. Return the ids of the records.
+            
+            'dates' is the list of the dates of the records, in the same 
+            order. Records without date (None, or no list) are dated today.
+            
+            Records and values are inserted by batches, without saving 
+            the records one by one: no 'record_changed' signal is sent, the data 
+            version of the report is bumped once and the new records are 
+            added to its rollups, in the same transaction.
+        """
+        grid_cache.forget_versions()
+        data_version = grid_cache.get_data_version(report.pk)
+        
+        ids = cls._insert_in_bulk(report, data_list, dates)
+        grid_cache.bump_data_version(report.pk)
+        if conf.GRID_ROLLUPS and ids:
+            # the records after the first one are the new ones
+            records = report.records.filter(pk__gte=ids[0])
+            PeriodRollup.add_records(report, records, data_version)
+        return ids
+        
+        
+    @classmethod
+    def _insert_in_bulk(cls, report, data_list, dates=None):
+    
+        attributes = dict((i.concept.slug, i.concept) 
+                          for i in report.get_stand_alone_indicators())
+        entity_ct = ContentType.objects.get_for_model(cls)
+        
+        ids = []
+        dates = dates or ()
+        data_list = list(data_list)
+        for start in xrange(0, len(data_list), conf.GRID_CHUNK_SIZE):
+            chunk = data_list[start:start + conf.GRID_CHUNK_SIZE]
+            records = []
+            for index in xrange(start, start + len(chunk)):
+                record = cls(report=report)
+                if index < len(dates) and dates[index] is not None:
+                    record.date = dates[index]
+                records.append(record)
+            chunk_ids = cls._insert_records(report, records)
+            
+            values = []
+            for record_id, data in zip(chunk_ids, chunk):
+                for slug, value in data.iteritems():
+                    if value is not None and slug in attributes:
+                        eav_value = Value(entity_ct=entity_ct, 
+                                          entity_id=record_id,
+                                          attribute=attributes[slug])
+                        eav_value.value = value
+                        values.append(eav_value)
+            bulk_insert(Value, values)
+            ids.extend(chunk_ids)
+        return ids
+        
+        
+    @classmethod
+    def _insert_records(cls, report, records):
+        """
+            Insert these unsaved records of the report with one query and
+            return their ids, in the same order.
+            
+            The ids are read back as the ones after the last record of the
+            report. If records of the report were created at the same time
+            they would be mixed up, so it raises a ValueError instead.
+        """
+        last_id = report.records.aggregate(last_id=Max('id'))['last_id']
+        bulk_insert(cls, records)
+        ids = report.records.filter(pk__gt=last_id or 0).order_by('pk')
+        ids = list(ids.values_list('pk', flat=True))
+        if len(ids) != len(records):
+            raise ValueError("Records of the report %s were created during "
+                             "the import" % report.pk)
+        return ids
+        
+        
+    def get_data(self, indicators=None):
+        """
+            Load the data of this record for these indicators (default to
+            all indicators of the report) from the database, as a sorted 
+            dict. Return None if the record is not in the database.
+        """
+        if indicators is None:
+            indicators = self.report.indicators.select_related('concept')
+        records = Record.objects.filter(pk=self.pk)
+        return RecordLoader(indicators).get_rows(records).get(self.pk)
+        
+
     def to_sorted_dict(self, indicators):
     
         data = SortedDict()
@@ -323,3 +1208,32 @@ class Record(models.Model):
         return data
 
 
+
+
+
+def _can_use_processes():
+    """
+        Return True if the grid state can be computed by worker processes.
+        
+        They open their own connections, so the database must be in a file
+        or a server, and the connections of this process must not be in a 
+        managed transaction: closing them would lose it, and the workers
+        would not see its changes.
+    """
+    for connection in connections.all():
+        if connection.settings_dict['NAME'] == ':memory:':
+            return False
+        if transaction.is_managed(using=connection.alias):
+            return False
+    return True
+
+
+def _compute_partition_state(task):
+    """
+        Create the grid state of a range of records for a view, in a 
+        worker process (see ReportView._create_grid_state_in_parallel()).
+        The view is loaded again by the worker.
+    """
+    view_id, first_id, next_id, engine = task
+    view = ReportView.objects.get(pk=view_id)
+    return view._create_partition_state(first_id, next_id, engine)
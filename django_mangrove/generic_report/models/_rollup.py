@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Pre-aggregated data: sums of the numerical values of the records of a
+    report for each period of time, updated each time a record changes, so
+    views aggregated by date don't need to read the records.
+"""
+
+import datetime
+
+from django.utils.translation import ugettext as _, ugettext_lazy as __
+from django.db import models, transaction, connection
+from django.db.models import Q, Sum
+
+from eav.models import Attribute
+
+from generic_report.engine import RecordLoader, grid_cache, bulk_insert
+
+from _aggregator import DateAggregator
+
+
+class PeriodRollup(models.Model):
+    """
+        Sum of the values of one numerical attribute for all the records
+        of a report with a date (the value of 'date_attribute') in the
+        same period.
+
+        'records' is the number of records of the period, 'count' the
+        number of them with a value for this attribute. Rollups with no
+        attribute just count the records.
+        
+        The rollups of a report are used only if they were built or 
+        updated at the current data version of the report: records or
+        values changed without Record.save() make them stale until they
+        are rebuilt.
+    """
+
+    class Meta:
+        verbose_name = __('period rollup')
+        verbose_name_plural = __('period rollups')
+        app_label = 'generic_report'
+
+
+    report = models.ForeignKey('generic_report.Report',
+                               related_name='rollups')
+    date_attribute = models.ForeignKey(Attribute,
+                                       related_name='date_rollups')
+    period = models.CharField(max_length=10,
+                              choices=DateAggregator.TIME_PERIOD_CHOISES)
+    start = models.DateField(null=True, blank=True)
+    attribute = models.ForeignKey(Attribute, null=True, blank=True,
+                                  related_name='rollups')
+    records = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+    total = models.FloatField(default=0)
+
+    NUMERICAL_TYPES = (Attribute.TYPE_INT, Attribute.TYPE_FLOAT)
+
+
+    def __unicode__(self):
+        return _(u'%(attribute)s for the %(period)s of %(start)s') % {
+                 'attribute': self.attribute or _(u'records'),
+                 'period': self.period, 'start': self.start}
+
+
+    @classmethod
+    def get_version_key(cls, report_id):
+        return grid_cache.make_key('rollups', report_id)
+
+
+    @classmethod
+    def get_version(cls, report_id):
+        """
+            Return the data version of the report the rollups match, or 
+            None if they may not match any.
+        """
+        return grid_cache.versions.get(cls.get_version_key(report_id))
+
+
+    @classmethod
+    def set_version(cls, report_id):
+        """
+            Save that the rollups match the current data of the report.
+        """
+        grid_cache.versions.set(cls.get_version_key(report_id),
+                                grid_cache.get_data_version(report_id),
+                                grid_cache.VERSION_TIMEOUT)
+
+
+    @classmethod
+    def get_dimensions(cls, report):
+        """
+            Return the attributes of the stored indicators of the report
+            the rollups are made of: (date attributes, numerical 
+            attributes).
+        """
+        dates, numbers = [], []
+        for indicator in report.get_stand_alone_indicators():
+            concept = indicator.concept
+            if concept.datatype == Attribute.TYPE_DATE:
+                dates.append(concept)
+            elif concept.datatype in cls.NUMERICAL_TYPES:
+                numbers.append(concept)
+        return dates, numbers
+
+
+    @classmethod
+    def get_contributions(cls, dimensions, data):
+        """
+            Return what this data dict adds to the rollups: a dict mapping
+            each rollup key (date attribute id, period, start, attribute id)
+            to (records, count, total).
+        """
+        dates, numbers = dimensions
+
+        contributions = {}
+        for date_attribute in dates:
+            date = data.get(date_attribute.slug)
+            for period, name in DateAggregator.TIME_PERIOD_CHOISES:
+                start = date and DateAggregator.get_period_start(period, date)
+                key = (date_attribute.pk, period, start)
+                contributions[key + (None,)] = (1, 0, 0)
+                for attribute in numbers:
+                    value = data.get(attribute.slug)
+                    if value is None:
+                        contributions[key + (attribute.pk,)] = (1, 0, 0)
+                    else:
+                        contributions[key + (attribute.pk,)] = (1, 1, value)
+        return contributions
+
+
+    @classmethod
+    def update_record(cls, report, old_data, new_data, data_version):
+        """
+            Remove the old data of a record from the rollups and add the
+            new one (any of them can be None).
+            
+            'data_version' is the version of the report data before the
+            change. If the rollups didn't match it, they are left stale.
+        """
+        if cls.get_version(report.pk) != data_version:
+            return
+        
+        dimensions = cls.get_dimensions(report)
+        changes = {}
+        for data, sign in ((old_data, -1), (new_data, 1)):
+            if data is None or not dimensions[0]:
+                continue
+            contributions = cls.get_contributions(dimensions, data)
+            for key, values in contributions.iteritems():
+                change = changes.get(key, (0, 0, 0))
+                changes[key] = tuple(c + sign * v for c, v in zip(change, values))
+
+        cls.add(report, dict((key, change) 
+                             for key, change in changes.iteritems() 
+                             if [value for value in change if value]))
+        cls.set_version(report.pk)
+
+
+    @classmethod
+    def add(cls, report, changes):
+        """
+            Add the numbers of the dict, mapping rollup keys to (records, 
+            count, total), to the rollups matching the keys. Existing 
+            rollups are updated in one query, the missing ones are created
+            in one query.
+        """
+        if not changes:
+            return
+        
+        starts = set(key[2] for key in changes)
+        dates = Q(start__isnull=True)
+        if starts != set([None]):
+            dates = Q(start__in=[start for start in starts if start is not None])
+            if None in starts:
+                dates |= Q(start__isnull=True)
+        rollups = cls.objects.filter(dates, report=report, 
+                        date_attribute__in=set(key[0] for key in changes),
+                        period__in=set(key[1] for key in changes))
+        ids = {}
+        for row in rollups.values_list('pk', 'date_attribute', 'period', 
+                                       'start', 'attribute'):
+            ids[row[1:]] = row[0]
+        
+        updates = [(ids[key], change) for key, change in changes.iteritems()
+                   if key in ids]
+        if updates:
+            cls._update_in_bulk(updates)
+        
+        missing = []
+        for key, (records, count, total) in changes.iteritems():
+            if key not in ids:
+                date_attribute_id, period, start, attribute_id = key
+                missing.append(cls(report=report, 
+                                   date_attribute_id=date_attribute_id,
+                                   period=period, start=start,
+                                   attribute_id=attribute_id, records=records,
+                                   count=count, total=total))
+        bulk_insert(cls, missing)
+        transaction.commit_unless_managed()
+
+
+    @classmethod
+    def _update_in_bulk(cls, updates):
+        """
+            Add (records, count, total) to each rollup of the list of (id,
+            numbers) with one UPDATE. The numbers are added by the database,
+            so concurrent updates of the same rollup don't overwrite each 
+            other.
+        """
+        qn = connection.ops.quote_name
+        pk = qn(cls._meta.pk.column)
+        columns = []
+        params = []
+        for index, name in enumerate(('records', 'count', 'total')):
+            column = qn(cls._meta.get_field(name).column)
+            cases = ' '.join(['WHEN %s THEN %s'] * len(updates))
+            columns.append('%s = %s + CASE %s %s ELSE 0 END' % (column, column, 
+                                                               pk, cases))
+            for rollup_id, numbers in updates:
+                params.extend((rollup_id, numbers[index]))
+        params.extend(rollup_id for rollup_id, numbers in updates)
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+                    qn(cls._meta.db_table), ', '.join(columns), pk,
+                    ', '.join(['%s'] * len(updates)))
+        connection.cursor().execute(sql, params)
+
+
+    @classmethod
+    def add_records(cls, report, records, data_version, chunk_size=500):
+        """
+            Add these new records of the report, saved without Record.save(),
+            to the rollups, updating them with a few queries.
+            
+            'data_version' is the version of the report data before they 
+            were saved. If the rollups didn't match it, they are built again
+            from all the records instead.
+            
+            Call it in the transaction saving the records: the rollups must
+            not be committed without them.
+        """
+        if cls.get_version(report.pk) != data_version:
+            return cls._build(report, chunk_size)
+        
+        dimensions = cls.get_dimensions(report)
+        if dimensions[0]:
+            totals = cls.get_totals(report, dimensions, records, chunk_size)
+            cls.add(report, totals)
+        cls.set_version(report.pk)
+
+
+    @classmethod
+    def get_totals(cls, report, dimensions, records, chunk_size=500):
+        """
+            Return the sum of the contributions of these records of the
+            report to the rollups, as a dict like get_contributions().
+        """
+        loader = RecordLoader(report.get_stand_alone_indicators())
+        totals = {}
+        for rows in loader.iter_rows(records, chunk_size):
+            for data in rows.itervalues():
+                contributions = cls.get_contributions(dimensions, data)
+                for key, values in contributions.iteritems():
+                    total = totals.get(key, (0, 0, 0))
+                    totals[key] = tuple(t + v for t, v in zip(total, values))
+        return totals
+
+
+    @classmethod
+    @transaction.commit_on_success
+    def rebuild(cls, report, chunk_size=500):
+        """
+            Delete the rollups of the report and create them again from all
+            its records.
+        """
+        cls._build(report, chunk_size)
+
+
+    @classmethod
+    def _build(cls, report, chunk_size=500):
+        cls.objects.filter(report=report).delete()
+
+        dimensions = cls.get_dimensions(report)
+        if not dimensions[0]:
+            cls.set_version(report.pk)
+            return
+
+        totals = cls.get_totals(report, dimensions, report.records.all(),
+                                chunk_size)
+        for key, (records, count, total) in totals.iteritems():
+            date_attribute_id, period, start, attribute_id = key
+            cls.objects.create(report=report, date_attribute_id=date_attribute_id,
+                               period=period, start=start,
+                               attribute_id=attribute_id, records=records,
+                               count=count, total=total)
+        cls.set_version(report.pk)
+
+
+    @classmethod
+    def get_groups(cls, report, date_attribute, period, attributes):
+        """
+            Return the sums of these attributes by period, as a list of 
+            (start, number of records, sums, nulls) like 
+            SQLAggregation.get_groups(). Start are datetime objects, like 
+            the dates of the records.
+
+            Return None if the rollups are not up to date: they were not 
+            built at the current data version, or they don't count all 
+            the records for each attribute, e.g: because an indicator has
+            been added to the report after the records were saved.
+        """
+        if cls.get_version(report.pk) != grid_cache.get_data_version(report.pk):
+            return None
+        
+        rollups = cls.objects.filter(report=report, period=period,
+                                     date_attribute=date_attribute)
+        rows = rollups.values('start', 'attribute').order_by('start')
+        rows = rows.annotate(sum_records=Sum('records'), sum_count=Sum('count'),
+                             sum_total=Sum('total'))
+
+        attributes = dict((a.pk, a) for a in attributes)
+        periods = {}
+        starts = []
+        totals = dict((pk, 0) for pk in attributes)
+        totals[None] = 0
+        for row in rows:
+            attribute_id = row['attribute']
+            if attribute_id not in totals:
+                continue
+            totals[attribute_id] += row['sum_records']
+            if row['start'] not in periods:
+                starts.append(row['start'])
+            periods.setdefault(row['start'], {})[attribute_id] = row
+
+        # every record has a rollup for each date attribute, even without
+        # date: no rollup means the date attribute is newer than them
+        expected = totals[None]
+        if not expected:
+            return None
+        if [total for total in totals.itervalues() if total != expected]:
+            return None
+
+        groups = []
+        for start in starts:
+            count = periods[start].get(None, {}).get('sum_records', 0)
+            if not count:
+                continue
+            sums, nulls = {}, {}
+            for attribute in attributes.itervalues():
+                row = periods[start].get(attribute.pk, {})
+                total = row.get('sum_total') or 0
+                if attribute.datatype == Attribute.TYPE_INT:
+                    total = int(round(total))
+                sums[attribute.slug] = total
+                if count - row.get('sum_count', 0):
+                    nulls[attribute.slug] = count - row.get('sum_count', 0)
+            if start is not None:
+                start = datetime.datetime(start.year, start.month, start.day)
+            groups.append((start, count, sums, nulls))
+        return groups
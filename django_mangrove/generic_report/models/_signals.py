@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Signal handlers keeping the data grid cache up to date: any change in
+    the records bumps the data version of their report, any change in the
+    way reports are defined bumps the schema version.
+"""
+
+import eav.models
+
+from simple_locations.models import Area, AreaType
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.core.signals import request_started
+
+from generic_report import conf
+from generic_report.engine import grid_cache, area_index
+from generic_report.signals import record_changed
+
+from _report import Report, ReportView, Record
+from _indicator import SelectedIndicator, Parameter, Indicator, IndicatorType
+from _aggregator import Aggregator, AggregatorType
+from _rollup import PeriodRollup
+
+
+def invalidate_record_data(sender, instance, **kwargs):
+    # Record.save() and delete() bump the version once they are done
+    if not Record.is_changing(instance.pk):
+        grid_cache.bump_data_version(instance.report_id)
+
+
+def invalidate_value_data(sender, instance, **kwargs):
+    """
+        EAV values are not linked directly to the report, so we need to
+        get the report from the record.
+
+        Values saved or deleted with their record are skipped: the record
+        bumps the version once for all of them.
+    """
+    if instance.entity_ct_id == ContentType.objects.get_for_model(Record).pk:
+        if Record.is_changing(instance.entity_id):
+            return
+        records = Record.objects.filter(pk=instance.entity_id)
+        for report_id in records.values_list('report', flat=True):
+            grid_cache.bump_data_version(report_id)
+
+
+def invalidate_schema(sender, **kwargs):
+    grid_cache.bump_schema_version()
+
+
+def invalidate_areas(sender, **kwargs):
+    """
+        Grids aggregated by location depend on the areas hierarchy, so
+        this invalidates them as well. Area types are in the index too.
+    """
+    area_index.invalidate()
+    grid_cache.bump_version('areas')
+    grid_cache.bump_schema_version()
+
+
+def update_area_index(sender, instance, **kwargs):
+    """
+        Same as invalidate_areas() but the area is just replaced in the 
+        index of this process.
+    """
+    version = grid_cache.bump_version('areas')
+    area_index.update_area(instance, version, 
+                           deleted=kwargs.get('signal') is post_delete)
+    grid_cache.bump_schema_version()
+
+
+post_save.connect(invalidate_record_data, sender=Record)
+post_delete.connect(invalidate_record_data, sender=Record)
+
+post_save.connect(invalidate_value_data, sender=eav.models.Value)
+post_delete.connect(invalidate_value_data, sender=eav.models.Value)
+
+m2m_changed.connect(invalidate_schema, sender=Indicator.report.through)
+
+SCHEMA_MODELS = [Report, ReportView, SelectedIndicator, Parameter, Indicator,
+                 Aggregator, eav.models.Attribute]
+SCHEMA_MODELS += IndicatorType.__subclasses__()
+SCHEMA_MODELS += AggregatorType.__subclasses__()
+
+for model in SCHEMA_MODELS:
+    post_save.connect(invalidate_schema, sender=model)
+    post_delete.connect(invalidate_schema, sender=model)
+
+post_save.connect(update_area_index, sender=Area)
+post_delete.connect(update_area_index, sender=Area)
+post_save.connect(invalidate_areas, sender=AreaType)
+post_delete.connect(invalidate_areas, sender=AreaType)
+
+
+def update_grid_states(sender, record, record_id, old_data, new_data, 
+                       data_version, **kwargs):
+    for view in ReportView.objects.filter(report=record.report_id):
+        view.update_grid_state(record_id, old_data, new_data, data_version)
+
+record_changed.connect(update_grid_states, sender=Record)
+
+
+def update_rollups(sender, record, old_data, new_data, data_version, 
+                   **kwargs):
+    if conf.GRID_ROLLUPS:
+        PeriodRollup.update_record(record.report, old_data, new_data, 
+                                   data_version)
+
+record_changed.connect(update_rollups, sender=Record)
+
+
+# versions may have been changed by an other process since the last request
+request_started.connect(grid_cache.forget_versions)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Versions of the data grid cache (see engine/_cache.py), stored in the
+    database so all the processes see the same ones.
+"""
+
+from django.db import models
+from django.db.models import F
+from django.utils.translation import ugettext_lazy as __
+
+
+class GridVersion(models.Model):
+    """
+        A version number, by name.
+    """
+
+    class Meta:
+        verbose_name = __('grid version')
+        verbose_name_plural = __('grid versions')
+        app_label = 'generic_report'
+
+
+    name = models.CharField(max_length=255, unique=True,
+                            verbose_name=__(u'name'))
+    version = models.BigIntegerField(verbose_name=__(u'version'))
+
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.version)
+
+
+
+class DatabaseVersions(object):
+    """
+        Store for the versions of the grid cache using the GridVersion
+        table. It has the methods of a Django cache backend the grid cache
+        needs, the timeouts being ignored.
+    """
+
+
+    def get_many(self, keys):
+        versions = GridVersion.objects.filter(name__in=keys)
+        return dict(versions.values_list('name', 'version'))
+
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+
+    def add(self, key, value, timeout=None):
+        created = GridVersion.objects.get_or_create(name=key,
+                                             defaults={'version': value})[1]
+        return created
+
+
+    def set(self, key, value, timeout=None):
+        if not GridVersion.objects.filter(name=key).update(version=value):
+            self.add(key, value)
+
+
+    def incr(self, key, delta=1):
+        """
+            Increment the version in the database, so two processes
+            bumping it at the same time both change it.
+        """
+        versions = GridVersion.objects.filter(name=key)
+        if not versions.update(version=F('version') + delta):
+            raise ValueError("Key '%s' not found" % key)
+        return self.get(key)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Definition of a view (indicators, concepts, strategies, aggregators)
+    loaded at once, so rendering a view doesn't query it again and again.
+"""
+
+import eav
+
+from django.contrib.contenttypes.models import ContentType
+
+from generic_report.engine import EvaluationPlan
+
+
+class ViewPlan(object):
+    """
+        Indicators and aggregators of a view, with their concepts and their
+        strategies, loaded with a few queries: one for the selected
+        indicators, one for the report indicators, one for the aggregators
+        and one per type of strategy.
+
+        A plan doesn't change once created. Views keep theirs until the
+        schema version changes (see ReportView.get_view_plan()).
+    """
+
+    NUMERICAL_TYPES = (eav.models.Attribute.TYPE_INT,
+                       eav.models.Attribute.TYPE_FLOAT)
+
+
+    def __init__(self, view):
+
+        selected = view.selected_indicators.select_related(
+                                                'indicator__concept',
+                                                'indicator__strategy_type')
+        self.selected_indicators = [si.indicator
+                                    for si in selected.order_by('order')]
+
+        pks = set(i.pk for i in self.selected_indicators)
+        report_indicators = view.report.indicators.select_related(
+                                                'concept', 'strategy_type')
+        self.indicators = self.selected_indicators + [i for i in report_indicators
+                                                      if i.pk not in pks]
+
+        aggregators = view.aggregators.select_related('indicator__concept',
+                                                      'strategy_type')
+        self.aggregators = list(aggregators.order_by('pk'))
+
+        self.load_strategies(self.indicators + self.aggregators)
+        self.load_strategies([a.indicator for a in self.aggregators])
+
+        self.selectable_indicators = self.get_selectable(self.indicators)
+        self.indicators_to_display = self.get_selectable(
+                                                    self.selected_indicators)
+        self.slugs = [i.concept.slug for i in self.selectable_indicators]
+        self.demanded_indicators = self.get_demanded(
+                                    self.indicators_to_display + 
+                                    [a.indicator for a in self.aggregators])
+        self.datatypes = dict((i.concept.slug, i.concept.datatype)
+                              for i in self.indicators)
+
+
+    @classmethod
+    def load_strategies(cls, objects):
+        """
+            Load the strategies of these indicators or aggregators with one
+            query per type of strategy, and put them in the cache of the
+            generic foreign key.
+        """
+        by_type = {}
+        for obj in objects:
+            if obj.strategy_type_id is not None:
+                by_type.setdefault(obj.strategy_type_id, []).append(obj)
+
+        for ct_id, objs in by_type.iteritems():
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            strategies = model._default_manager.in_bulk(
+                                            [o.strategy_id for o in objs])
+            for obj in objs:
+                obj._strategy_cache = strategies.get(obj.strategy_id)
+
+
+    def get_demanded(self, indicators):
+        """
+            Return these indicators, in the same order, followed by all the
+            indicators they depend on, directly or not, and that are not
+            already in the list. Each indicator appears only once, even if
+            several indicators depend on it.
+        """
+        demanded = []
+        pks = set()
+        for indicator in indicators + EvaluationPlan.sort(indicators):
+            if indicator.pk not in pks:
+                pks.add(indicator.pk)
+                demanded.append(indicator)
+        return demanded
+
+
+    def get_numerical(self, indicators):
+        return [i for i in indicators
+                if i.concept.datatype in self.NUMERICAL_TYPES]
+
+
+    def get_selectable(self, indicators):
+        """
+            Remove the indicators that can't be displayed: when the data is
+            aggregated, only numerical indicators and the indicators the
+            data is grouped around.
+        """
+        if not self.aggregators:
+            return list(indicators)
+
+        concepts = [a.indicator.concept_id for a in self.aggregators]
+        selectable = self.get_numerical(indicators)
+        for indicator in indicators:
+            if indicator.concept_id in concepts and indicator not in selectable:
+                selectable.append(indicator)
+        return selectable
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Signals sent by generic_report
+"""
+
+from django.dispatch import Signal
+
+
+# sent after a record has been saved or deleted, with its data before
+# ('old_data', None for a new record) and after ('new_data', None for a 
+# deleted record), and the version of the report data before the change
+record_changed = Signal(providing_args=['record', 'record_id', 'old_data', 
+                                        'new_data', 'data_version'])
@@ -1,2 +1,3 @@
 from report import *
 from indicator import *
+from utils import *
@@ -2,7 +2,13 @@ from datetime import datetime
 
 from django.test import TestCase
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from ..models import *
+from ..engine import EvaluationPlan, grid_cache, area_index
 from eav.models import *
 
 eav.register(Record)
@@ -16,6 +22,11 @@ class IndicatorTests(TestCase):
 
     def setUp(self):
     
+        # the caches are process globals, they are not rolled back with
+        # the database between tests
+        grid_cache.clear()
+        area_index.invalidate()
+        
         self.report = Report.objects.create(name='Test')
         
         self.a = Indicator.create_with_attribute('A')
@@ -195,3 +206,128 @@ class IndicatorTests(TestCase):
         formated_value = i.format(self.view, grid[0])
         
         self.assertEqual(formated_value , '01/02/2000')
+        
+        
+    def test_formatters_are_created_once_per_column(self):
+    
+        i = Indicator.create_with_attribute('Date', Attribute.TYPE_DATE,
+                                            DateIndicator)
+        self.view.add_indicator(i)
+        Aggregator.objects.create(view=self.view, indicator=i,
+                       strategy=DateAggregator.objects.create(time_period='month'))
+        view = ReportView.objects.get(pk=self.view.pk)
+        
+        formatters = view.get_formatters()
+        self.assertTrue(view.get_formatters() is formatters)
+        self.assertEqual(formatters.keys(), ['a', 'b', 'c', 'date'])
+        self.assertEqual(formatters['date']((1, 2000)), 'January, 2000')
+        self.assertEqual(formatters['date'](None), None)
+        self.assertEqual(formatters['a'](10), '10')
+        
+        grid = [{'a': 10, 'b': 2, 'c': 3, 'date': (1, 2000), 'x': 0},
+                {'a': 4, 'b': 1, 'c': 1, 'date': (1, 2000), 'x': 0}]
+        self.assertEqual(view._format_data_grid(grid), 
+                         [{'a': '10', 'b': '2', 'c': '3', 
+                           'date': 'January, 2000'},
+                          {'a': '4', 'b': '1', 'c': '1', 
+                           'date': 'January, 2000'}])
+        
+        
+    def test_evaluation_plan(self):
+    
+        d = Indicator.create_with_attribute('D', Attribute.TYPE_INT, 
+                                            SumIndicator, 
+                                            (self.a, self.b))
+        e = Indicator.create_with_attribute('E', Attribute.TYPE_FLOAT, 
+                                            RatioIndicator, 
+                                            kwargs={
+                                             'numerator': d,
+                                             'denominator': self.c
+                                            })
+        
+        # dependancies are calculated first, whatever the view order is
+        self.view.add_indicator(e)
+        self.view.add_indicator(d)
+        
+        plan = EvaluationPlan(self.view.get_selected_indicators())
+        
+        self.assertEqual(plan.slugs, ['d', 'e'])
+        self.assertEqual(plan.evaluate({'a': 10, 'b': 2, 'c': 3}),
+                         {'a': 10, 'b': 2, 'c': 3, 'd': 12, 'e': 4.0})
+        self.assertEqual(e.value(self.view, self.record), 4.0)
+
+        
+        
+    def test_columnar_engine_match_python_engine(self):
+    
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+    
+        Indicator.create_with_attribute('D', Attribute.TYPE_INT, 
+                                        SumIndicator, (self.a, self.b, self.c))
+        for ind_type in (RatioIndicator, RateIndicator):
+            Indicator.create_with_attribute(ind_type.__name__, 
+                                            Attribute.TYPE_FLOAT, 
+                                            ind_type, 
+                                            kwargs={'numerator': self.a,
+                                                    'denominator': self.c})
+        Indicator.create_with_attribute('F', Attribute.TYPE_FLOAT, 
+                                        AverageIndicator, (self.a, self.c))
+        for i in Indicator.objects.filter(name__in=('D', 'RatioIndicator',
+                                                    'RateIndicator', 'F')):
+            self.view.add_indicator(i)
+        
+        # zero denominator, and missing value
+        record = Record.objects.create(report=self.report)
+        record.eav.a = 7
+        record.eav.c = 0
+        record.save()
+        
+        # grids are cached per engine
+        self.assertEqual(self.view.get_data_grid(engine='numpy'),
+                         self.view.get_data_grid(engine='python'))
+        
+        columns = self.view.get_columnar_grid()
+        self.assertEqual(columns.get_values('ratioindicator'), [3.33, None])
+        self.assertEqual(columns.get_values('d'), [15, None])
+        
+        
+    def test_columnar_rounding_match_python_rounding(self):
+    
+        if numpy is None:
+            self.skipTest('numpy is not installed')
+        
+        from numpy import ma
+        from ..engine._columnar import COLUMN_OPERATIONS, round_column
+        operations = dict(COLUMN_OPERATIONS)
+        
+        # many of these ratios are on .xx5 boundaries
+        numerators, denominators = [], []
+        for denominator in (8, 40, 200, 400, 1000):
+            for numerator in range(1, 3000):
+                numerators.append(numerator)
+                denominators.append(denominator)
+        columns = ma.array(numerators), ma.array(denominators)
+        
+        for name, ind_type in (('ratio', RatioIndicator), 
+                               ('rate', RateIndicator)):
+            expected = [ind_type().calculate(n, d) 
+                        for n, d in zip(numerators, denominators)]
+            self.assertEqual(list(operations[name](*columns)), expected)
+        self.assertEqual(list(operations['average'](*columns)), 
+                         [AverageIndicator().calculate(n, d) 
+                          for n, d in zip(numerators, denominators)])
+            
+        ratio = operations['ratio'](ma.array([2675, 1997]), 
+                                    ma.array([1000, 200]))
+        self.assertEqual(list(ratio), [2.67, 9.98])
+        
+        # halves are rounded away from zero, missing values are kept
+        ratio = operations['ratio'](ma.array([1, -1, 3, 0], 
+                                             mask=[0, 0, 1, 0]), 
+                                    ma.array([8, 8, 4, 0]))
+        self.assertEqual(ratio.tolist(), [0.13, -0.13, None, None])
+        rounded = round_column(ma.array([float('nan'), 0.125]), 2)
+        self.assertTrue(numpy.isnan(rounded[0]))
+        self.assertEqual(rounded[1], 0.13)
+
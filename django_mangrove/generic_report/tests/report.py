@@ -1,12 +1,46 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.db.models import F
+from django.contrib.contenttypes.models import ContentType
+
+from simple_locations.models import Area, AreaType
 
 from ..models import *
+from ..engine import (RecordLoader, LRUCache, grid_cache, area_index, BKTree,
+                      levenshtein, Group)
+from .. import conf
+from ..export import iter_csv, SpreadsheetWriter
+from ..benchmark import run_benchmark, SyntheticReport, STAGES
 from eav.models import *
 
 eav.register(Record)
 
+
+def count_queries(func, *args, **kwargs):
+    """
+        Call the function and return its result with the SQL queries it
+        made.
+    """
+    old_debug = settings.DEBUG
+    settings.DEBUG = True
+    reset_queries()
+    try:
+        result = func(*args, **kwargs)
+        return result, list(connection.queries)
+    finally:
+        settings.DEBUG = old_debug
+        
+        
+def get_value_queries(queries):
+    """
+        Return the queries reading the values of the records.
+    """
+    return [q for q in queries if Value._meta.db_table in q['sql']]
+
+
 class ReportTests(TestCase):
 
     """
@@ -15,6 +49,11 @@ class ReportTests(TestCase):
 
 
     def setUp(self):
+        # the caches are process globals, they are not rolled back with
+        # the database between tests
+        grid_cache.clear()
+        area_index.invalidate()
+        
         self.report = Report.objects.create(name='Square')
         self.height = Attribute.objects.create(name='Height', 
                                                datatype=Attribute.TYPE_INT)
@@ -319,3 +358,819 @@ class ReportTests(TestCase):
         self.assertEqual(self.report.default_view, v)
         
                                                                   
+
+
+    def test_bulk_loading_match_record_values(self):
+        at = AreaType.objects.create(name='City')
+        paris = Area.objects.create(name='Paris', code='paris', kind=at)
+        city = Indicator.create_with_attribute('City', Attribute.TYPE_OBJECT, 
+                                               LocationIndicator,
+                                               kwargs={'area_type': at})
+        self.view.add_indicator(city)
+        
+        self.record.eav.city = paris
+        self.record.save()
+        
+        record = Record.objects.create(report=self.report)
+        record.eav.height = 5
+        record.save()
+        
+        indicators = self.view.get_indicators()
+        grid = RecordLoader(indicators).get_grid(self.report.records.all())
+        
+        self.assertEqual(grid, [r.to_sorted_dict(indicators) 
+                                for r in self.report.records.all()])
+        self.assertEqual(grid[0]['city'], paris)
+        self.assertEqual(grid[1]['width'], None)
+
+
+
+    def test_bulk_loading_queries_dont_depend_on_record_count(self):
+        at = AreaType.objects.create(name='City')
+        city = Indicator.create_with_attribute('City', Attribute.TYPE_OBJECT, 
+                                               LocationIndicator,
+                                               kwargs={'area_type': at})
+        self.view.add_indicator(city)
+        self.record.eav.city = Area.objects.create(name='Paris', code='paris',
+                                                   kind=at)
+        self.record.save()
+        
+        loader = RecordLoader(self.view.get_indicators())
+        # content types are cached by the first call
+        loader.get_grid(self.report.records.all())
+        
+        # one query for the ids, one for the values, one for the areas
+        grid, queries = count_queries(loader.get_grid, 
+                                      self.report.records.all())
+        self.assertEqual(len(grid), 1)
+        self.assertEqual(len(queries), 3)
+        
+        for i in range(10):
+            record = Record.objects.create(report=self.report)
+            record.eav.height = i
+            record.eav.city = Area.objects.create(name='City %s' % i, 
+                                                  code='city%s' % i, kind=at)
+            record.save()
+        grid, queries = count_queries(loader.get_grid, 
+                                      self.report.records.all())
+        self.assertEqual(len(grid), 11)
+        self.assertEqual(len(queries), 3)
+
+
+    def test_data_grid_cache_is_invalidated(self):
+        self.assertEqual(self.view.get_data_grid(), [{'height': '10', 
+                                                      'width': '2'}])
+        
+        self.record.eav.height = 20
+        self.record.save()
+        self.assertEqual(self.view.get_data_grid(), [{'height': '20', 
+                                                      'width': '2'}])
+        
+        record = Record.objects.create(report=self.report)
+        record.eav.height = 1
+        record.eav.width = 1
+        record.save()
+        self.assertEqual(len(self.view.get_data_grid()), 2)
+        
+        self.view.selected_indicators.filter(indicator=self.width_indicator)\
+                                     .delete()
+        self.assertEqual(self.view.get_data_grid(), [{'height': '20'}, 
+                                                     {'height': '1'}])
+        
+    
+    def test_cache_versions_are_shared_by_processes(self):
+        self.assertEqual(self.view.get_data_grid(), [{'height': '10', 
+                                                      'width': '2'}])
+        
+        # an other process changes the data and bumps the version in the 
+        # database, this process reads it again at the next request
+        Value.objects.filter(entity_id=self.record.pk, 
+                             attribute=self.height).update(value_int=20)
+        key = grid_cache.make_key('version', 'report.%s' % self.report.pk)
+        GridVersion.objects.filter(name=key).update(version=F('version') + 1)
+        grid_cache.forget_versions()
+        self.assertEqual(self.view.get_data_grid(), [{'height': '20', 
+                                                      'width': '2'}])
+        
+    
+    def test_saving_a_record_bumps_the_version_once(self):
+        self.view.get_data_grid()
+        self.record.eav.height = 30
+        self.record.eav.width = 3
+        queries = count_queries(self.record.save)[1]
+        table = GridVersion._meta.db_table
+        updates = [q for q in queries
+                     if table in q['sql'] and q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.view.get_data_grid(), [{'height': '30',
+                                                      'width': '3'}])
+
+        # values changed without their record still bump the version
+        value = Value.objects.get(entity_id=self.record.pk,
+                                  attribute=self.height)
+        value.value_int = 40
+        value.save()
+        self.assertEqual(self.view.get_data_grid(), [{'height': '40',
+                                                      'width': '3'}])
+        
+    
+    def test_lru_cache(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.incr('c'), 4)
+        self.assertEqual(len(cache), 2)
+
+
+    def test_grid_state_is_updated_when_a_record_changes(self):
+        Aggregator.objects.create(view=self.view, 
+                                  indicator=self.width_indicator,
+                                  strategy=ValueAggregator.objects.create())
+        state = self.view.get_grid_state()
+        
+        record = Record.objects.create(report=self.report)
+        record.eav.height = 5
+        record.eav.width = 2
+        record.save()
+        
+        # the cached state has been updated, not created again
+        self.assertTrue(self.view.get_grid_state() is state)
+        self.assertEqual(state.get_grid(), [{'height': 15, 'width': 2}])
+        
+        record.eav.width = 3
+        record.save()
+        self.assertEqual(self.view.get_grid_state().get_grid(), 
+                         [{'height': 10, 'width': 2}, 
+                          {'height': 5, 'width': 3}])
+        
+        record.delete()
+        self.assertTrue(self.view.get_grid_state() is state)
+        self.assertEqual(state.get_grid(), [{'height': 10, 'width': 2}])
+
+
+    def test_iter_data_grid_match_data_grid(self):
+        for i in range(3):
+            record = Record.objects.create(report=self.report)
+            record.eav.height = i
+            record.eav.width = 2
+            record.save()
+        
+        # read the records one by one, before anything is cached
+        grid = self.view.get_data_grid()
+        grid_cache.clear()
+        self.assertEqual(list(self.view.iter_data_grid(chunk_size=1, 
+                                                       cache=False)), grid)
+                         
+        Aggregator.objects.create(view=self.view, 
+                                  indicator=self.width_indicator,
+                                  strategy=ValueAggregator.objects.create())
+        grid = self.view.get_data_grid()
+        grid_cache.clear()
+        self.assertEqual(list(self.view.iter_data_grid(chunk_size=2, 
+                                                       cache=False)), grid)
+        
+        
+    def test_iter_data_grid_is_cached(self):
+        for aggregated in (False, True):
+            if aggregated:
+                Aggregator.objects.create(view=self.view, 
+                                    indicator=self.width_indicator,
+                                    strategy=ValueAggregator.objects.create())
+            view = ReportView.objects.get(pk=self.view.pk)
+            grid, queries = count_queries(list, view.iter_data_grid())
+            self.assertTrue(get_value_queries(queries))
+            
+            # the second time, no record is read
+            cached_grid, queries = count_queries(list, view.iter_data_grid())
+            self.assertEqual(cached_grid, grid)
+            self.assertEqual(get_value_queries(queries), [])
+
+
+    def test_sql_aggregation_match_python_aggregation(self):
+        date = Indicator.create_with_attribute('Date', Attribute.TYPE_DATE, 
+                                               DateIndicator)
+        ratio = Indicator.create_with_attribute('Ratio', Attribute.TYPE_FLOAT, 
+                                    RatioIndicator, 
+                                    kwargs={'numerator': self.height_indicator,
+                                            'denominator': self.width_indicator})
+        for indicator in (date, ratio):
+            self.report.indicators.add(indicator)
+            self.view.add_indicator(indicator)
+        
+        self.record.eav.date = datetime(2010, 1, 3)
+        self.record.save()
+        for day, height, width in ((5, 3, 2), (28, 4, None), (40, 1, 3)):
+            record = Record.objects.create(report=self.report)
+            record.eav.date = datetime(2010, 1, 1) + timedelta(days=day)
+            record.eav.height = height
+            record.eav.width = width
+            record.save()
+            
+        aggregators = ((self.width_indicator, ValueAggregator.objects.create()),
+                       (date, DateAggregator.objects.create(time_period='month')),
+                       (date, DateAggregator.objects.create(time_period='week')))
+        for indicator, strategy in aggregators:
+            self.view.aggregators.all().delete()
+            Aggregator.objects.create(view=self.view, indicator=indicator,
+                                      strategy=strategy)
+            view = ReportView.objects.get(pk=self.view.pk)
+            state = view._create_grid_state(sql_aggregation=False)
+            sql_state = view._create_grid_state_in_db()
+            self.assertTrue(sql_state is not None)
+            self.assertEqual(view._compute_data_grid(state=sql_state),
+                             view._compute_data_grid(state=state))
+
+
+    def test_location_aggregation_with_area_index(self):
+        country_type = AreaType.objects.create(name='Country')
+        district_type = AreaType.objects.create(name='District')
+        village_type = AreaType.objects.create(name='Village')
+        mali = Area.objects.create(name='Mali', code='mali', kind=country_type)
+        bamako = Area.objects.create(name='Bamako', code='bamako', 
+                                     kind=district_type, parent=mali)
+        sikasso = Area.objects.create(name='Sikasso', code='sikasso', 
+                                      kind=district_type, parent=mali)
+        koro = Area.objects.create(name='Koro', code='koro', 
+                                   kind=village_type, parent=bamako)
+        
+        self.assertEqual(area_index.get_ancestor(koro, district_type), bamako)
+        self.assertEqual(area_index.get_ancestor(bamako, district_type), bamako)
+        self.assertEqual(area_index.get_ancestor(mali, district_type), None)
+        
+        # the index is loaded again when an area changes
+        koro.parent = sikasso
+        koro.save()
+        self.assertEqual(area_index.get_ancestor(koro, district_type), sikasso)
+        self.assertEqual(area_index.get_ancestor(koro, country_type), mali)
+        
+        place = Indicator.create_with_attribute('Place', Attribute.TYPE_OBJECT, 
+                                                LocationIndicator,
+                                                kwargs={'area_type': village_type})
+        self.report.indicators.add(place)
+        self.view.add_indicator(place)
+        for area, height in ((koro, 3), (sikasso, 4), (mali, 5)):
+            record = Record.objects.create(report=self.report)
+            record.eav.place = area
+            record.eav.height = height
+            record.eav.width = 1
+            record.save()
+        
+        Aggregator.objects.create(view=self.view, indicator=place,
+                       strategy=LocationAggregator.objects.create(
+                                                    area_type=district_type))
+        grid = ReportView.objects.get(pk=self.view.pk).get_grid_state().get_grid()
+        self.assertEqual(grid, [{'height': 7, 'width': 2, 'place': sikasso}])
+
+
+    def test_period_rollups(self):
+        date = Indicator.create_with_attribute('Date', Attribute.TYPE_DATE, 
+                                               DateIndicator)
+        self.report.indicators.add(date)
+        self.view.add_indicator(date)
+        
+        # the record was saved before the report had a date
+        PeriodRollup.rebuild(self.report)
+        
+        self.record.eav.date = datetime(2010, 1, 3)
+        self.record.save()
+        for day, height in ((5, 3), (28, None), (40, 1)):
+            record = Record.objects.create(report=self.report)
+            record.eav.date = datetime(2010, 1, 1) + timedelta(days=day)
+            record.eav.height = height
+            record.eav.width = 2
+            record.save()
+            
+        self.assertEqual(DateAggregator.get_period_start('week', 
+                                                         datetime(2010, 1, 3)),
+                         datetime(2010, 1, 1).date())
+        
+        groups = PeriodRollup.get_groups(self.report, date.concept, 'month',
+                                         [self.height, self.width])
+        self.assertEqual(groups, 
+                         [(datetime(2010, 1, 1), 3, {'height': 13, 'width': 6}, 
+                           {'height': 1}),
+                          (datetime(2010, 2, 1), 1, {'height': 1, 'width': 2}, 
+                           {})])
+        
+        Aggregator.objects.create(view=self.view, indicator=date,
+                       strategy=DateAggregator.objects.create(time_period='week'))
+        view = ReportView.objects.get(pk=self.view.pk)
+        state = view._create_grid_state(sql_aggregation=False)
+        self.assertEqual(view._compute_data_grid(state=view._create_grid_state_in_db()),
+                         view._compute_data_grid(state=state))
+        
+        # a save updates all the rollups of the record at once
+        record = Record.objects.create(report=self.report)
+        record.eav.date = datetime(2010, 3, 1)
+        record.eav.height = 2
+        queries = count_queries(record.save)[1]
+        table = PeriodRollup._meta.db_table
+        self.assertEqual(len([q for q in queries if table in q['sql']]), 3)
+        
+        # rebuilding give the same rollups as updating them record by record
+        def get_rollups():
+            rollups = self.report.rollups.exclude(records=0)
+            return sorted(rollups.values_list('date_attribute', 'period', 
+                                              'start', 'attribute',
+                                              'records', 'count', 'total'))
+        rollups = get_rollups()
+        PeriodRollup.rebuild(self.report)
+        self.assertEqual(get_rollups(), rollups)
+
+        # imported records are added to the rollups without rebuilding them
+        data_list = [{'date': datetime(2010, 3, 2), 'height': 4},
+                     {'date': None, 'width': 1}]
+        queries = count_queries(Record.create_in_bulk, self.report,
+                                data_list)[1]
+        self.assertEqual([q for q in queries
+                            if table in q['sql'] and 'DELETE' in q['sql']], [])
+        rollups = get_rollups()
+        PeriodRollup.rebuild(self.report)
+        self.assertEqual(get_rollups(), rollups)
+
+        # rollups are not used if they don't have all the data 
+        depth = Indicator.create_with_attribute('Depth', Attribute.TYPE_INT)
+        self.report.indicators.add(depth)
+        self.assertEqual(PeriodRollup.get_groups(self.report, date.concept, 
+                                                 'month', [depth.concept]),
+                         None)
+        
+        # nor if the data changed without updating them
+        value = Value.objects.get(entity_id=self.record.pk, 
+                          entity_ct=ContentType.objects.get_for_model(Record),
+                          attribute=self.height)
+        value.value_int = 20
+        value.save()
+        self.assertEqual(PeriodRollup.get_groups(self.report, date.concept, 
+                                                 'month', [self.height]),
+                         None)
+        PeriodRollup.rebuild(self.report)
+        groups = PeriodRollup.get_groups(self.report, date.concept, 'month', 
+                                         [self.height])
+        self.assertEqual(groups[0][2], {'height': 23})
+
+
+    def test_date_groups_are_in_the_same_order_on_all_paths(self):
+        date = Indicator.create_with_attribute('Date', Attribute.TYPE_DATE, 
+                                               DateIndicator)
+        self.report.indicators.add(date)
+        self.view.add_indicator(date)
+        
+        # the first records are in the last months
+        for month in (3, 1, 2):
+            record = Record.objects.create(report=self.report)
+            record.eav.date = datetime(2010, month, 5)
+            record.eav.height = month
+            record.save()
+        Aggregator.objects.create(view=self.view, indicator=date,
+                       strategy=DateAggregator.objects.create(time_period='month'))
+        PeriodRollup.rebuild(self.report)
+        view = ReportView.objects.get(pk=self.view.pk)
+        
+        def get_heights(state):
+            return [data['height'] 
+                    for data in view._compute_data_grid(state=state)]
+        
+        # from the rollups, then from the records with the database and 
+        # in Python
+        self.assertEqual(get_heights(view._create_grid_state_in_db()), 
+                         ['1', '2', '3'])
+        grid_cache.bump_data_version(self.report.pk)
+        self.assertEqual(PeriodRollup.get_groups(self.report, date.concept, 
+                                                 'month', [self.height]),
+                         None)
+        self.assertEqual(get_heights(view._create_grid_state_in_db()), 
+                         ['1', '2', '3'])
+        state = view._create_grid_state(sql_aggregation=False)
+        self.assertEqual(get_heights(state), ['1', '2', '3'])
+        self.assertEqual([data['height'] for data in 
+                          view.iter_data_grid(cache=False)], ['1', '2', '3'])
+        
+        
+    def test_views_share_the_report_extraction(self):
+        area = Indicator.create_with_attribute('Area', Attribute.TYPE_INT, 
+                                               ProductIndicator, 
+                                               (self.height_indicator, 
+                                                self.width_indicator))
+        self.report.indicators.add(area)
+        other_view = ReportView.create_from_report(report=self.report, 
+                                                   name='other')
+        
+        extraction = self.report.get_extraction()
+        self.assertEqual(extraction.values(), 
+                         [{'height': 10, 'width': 2, 'area': 20}])
+        self.assertTrue(self.report.get_extraction() is extraction)
+        
+        self.assertEqual(other_view.get_extracted_data(), 
+                         [{'height': 10, 'width': 2, 'area': 20}])
+        self.assertEqual(self.view.get_extracted_data(),
+                         [{'height': 10, 'width': 2, 'area': 20}])
+        self.assertTrue(self.report.get_extraction() is extraction)
+        
+        # the views data must not change the extraction
+        self.view.get_extracted_data()[0]['height'] = 0
+        self.assertEqual(extraction.values()[0]['height'], 10)
+        
+        self.record.eav.height = 5
+        self.record.save()
+        self.assertEqual(self.report.get_extraction().values(), 
+                         [{'height': 5, 'width': 2, 'area': 10}])
+
+
+    def test_views_of_a_report_read_the_records_once(self):
+        other_view = ReportView.create_from_report(report=self.report, 
+                                                   name='other')
+        
+        def get_grids():
+            return [ReportView.objects.get(pk=view.pk).get_data_grid()
+                    for view in (self.view, other_view)]
+        grids, queries = count_queries(get_grids)
+        self.assertEqual(grids, [[{'height': '10', 'width': '2'}], 
+                                 [{'height': '10', 'width': '2'}]])
+        self.assertEqual(len(get_value_queries(queries)), 1)
+        
+        grid_cache.clear()
+        grids, queries = count_queries(lambda: list(
+                                       self.view.iter_data_grid()))
+        self.assertEqual(len(get_value_queries(queries)), 1)
+        self.assertTrue(grid_cache.get(grid_cache.get_report_key(self.report,
+                                    'extraction.%s' % conf.GRID_ENGINE)))
+
+
+    def test_aggregation_partial_states(self):
+        kind = Indicator.create_with_attribute('Kind', Attribute.TYPE_TEXT)
+        peak = Indicator.create_with_attribute('Peak', Attribute.TYPE_INT)
+        ratio = Indicator.create_with_attribute('Ratio', Attribute.TYPE_FLOAT, 
+                                    RatioIndicator, 
+                                    kwargs={'numerator': self.height_indicator,
+                                            'denominator': self.width_indicator})
+        average = Indicator.create_with_attribute('Average', 
+                                                  Attribute.TYPE_FLOAT, 
+                                                  AverageIndicator, 
+                                                  (self.height_indicator,
+                                                   self.width_indicator))
+        for indicator in (kind, peak, ratio, average):
+            self.view.add_indicator(indicator)
+            
+        for height, width, value in ((4, 2, 7), (6, 3, 9)):
+            record = Record.objects.create(report=self.report)
+            record.eav.height = height
+            record.eav.width = width
+            record.eav.peak = value
+            record.eav.kind = u'a'
+            record.save()
+        
+        Aggregator.objects.create(view=self.view, indicator=kind,
+                                  strategy=ValueAggregator.objects.create())
+        view = ReportView.objects.get(pk=self.view.pk)
+        plan = view.get_evaluation_plan(aggregated=True)
+        
+        # ratios are derived from the sums, averages are averaged again
+        self.assertEqual(view.get_grid_state().get_grid(plan),
+                         [{'height': 10, 'width': 2, 'kind': None, 'peak': None,
+                           'ratio': 5.0, 'average': 6.0},
+                          {'height': 10, 'width': 5, 'kind': u'a', 'peak': 16,
+                           'ratio': 2.0, 'average': 3.75}])
+        
+        # the minimum and maximum are kept when a record is removed
+        group = Group('kind', u'a', {'peak': 'max', 'height': 'min', 
+                                     'width': 'count'})
+        for data in ({'peak': 7, 'height': 4, 'width': None}, 
+                     {'peak': 9, 'height': 6, 'width': 3}):
+            group.add(data)
+        self.assertEqual(group.get_data(), {'peak': 9, 'height': 4, 
+                                            'width': 1})
+        group.remove({'peak': 9, 'height': 6, 'width': 3})
+        self.assertEqual(group.get_data(), {'peak': 7, 'height': 4, 
+                                            'width': 0})
+
+
+    def test_composite_aggregation_and_crosstab(self):
+        kind = Indicator.create_with_attribute('Kind', Attribute.TYPE_TEXT)
+        date = Indicator.create_with_attribute('Date', Attribute.TYPE_DATE, 
+                                               DateIndicator)
+        for indicator in (kind, date):
+            self.view.add_indicator(indicator)
+            
+        self.record.eav.kind = u'a'
+        self.record.eav.date = datetime(2010, 1, 3)
+        self.record.save()
+        for value, day, height in ((u'a', datetime(2010, 2, 5), 4), 
+                                   (u'b', datetime(2010, 1, 10), 6),
+                                   (u'b', None, 1)):
+            record = Record.objects.create(report=self.report)
+            record.eav.kind = value
+            record.eav.date = day
+            record.eav.height = height
+            record.eav.width = 1
+            record.save()
+            
+        Aggregator.objects.create(view=self.view, indicator=kind,
+                                  strategy=ValueAggregator.objects.create())
+        Aggregator.objects.create(view=self.view, indicator=date,
+                       strategy=DateAggregator.objects.create(time_period='month'))
+        view = ReportView.objects.get(pk=self.view.pk)
+        
+        self.assertEqual(view.get_key_slug(), ('kind', 'date'))
+        self.assertEqual(view.get_grid_state().get_grid(),
+                         [{'height': 10, 'width': 2, 'kind': u'a', 
+                           'date': (1, 2010)},
+                          {'height': 4, 'width': 1, 'kind': u'a', 
+                           'date': (2, 2010)},
+                          {'height': 6, 'width': 1, 'kind': u'b', 
+                           'date': (1, 2010)}])
+        
+        self.assertEqual(view.get_crosstab(),
+                         {'rows': [u'a', u'b'],
+                          'columns': ['January, 2010', 'February, 2010'],
+                          'cells': [[10, 4], [6, None]]})
+        self.assertEqual(view.get_crosstab(self.width_indicator)['cells'],
+                         [[2, 1], [1, None]])
+
+
+    def test_view_plan_is_loaded_once(self):
+        plan = self.view.get_view_plan()
+        self.assertTrue(self.view.get_view_plan() is plan)
+        self.assertEqual(plan.slugs, ['height', 'width'])
+        self.assertEqual(self.view.get_indicators_to_display(), 
+                         [self.height_indicator, self.width_indicator])
+        self.assertTrue(plan.indicators[0].__dict__.get('_strategy_cache'))
+        
+        # changing the view loads the plan again
+        kind = Indicator.create_with_attribute('Kind', Attribute.TYPE_TEXT)
+        self.view.add_indicator(kind)
+        self.assertFalse(self.view.get_view_plan() is plan)
+        self.assertEqual(self.view.get_view_plan().slugs, 
+                         ['height', 'width', 'kind'])
+        
+        Aggregator.objects.create(view=self.view, indicator=kind,
+                                  strategy=ValueAggregator.objects.create())
+        plan = self.view.get_view_plan()
+        self.assertEqual(plan.aggregators[0].indicator, kind)
+        self.assertEqual(plan.datatypes['kind'], Attribute.TYPE_TEXT)
+        self.assertEqual(self.view.get_selectable_indicators([kind]), [kind])
+
+
+    def test_only_demanded_indicators_are_calculated(self):
+        area = Indicator.create_with_attribute('Area', Attribute.TYPE_INT, 
+                                               ProductIndicator, 
+                                               (self.height_indicator, 
+                                                self.width_indicator))
+        double = Indicator.create_with_attribute('Double', Attribute.TYPE_INT, 
+                                                 SumIndicator, (area, area))
+        perimeter = Indicator.create_with_attribute('Perimeter', 
+                                                    Attribute.TYPE_INT, 
+                                                    SumIndicator, 
+                                                    (self.height_indicator, 
+                                                     self.width_indicator))
+        self.report.indicators.add(perimeter)
+        
+        # with only one view, the report extraction is not created
+        self.view.delete()
+        view = ReportView.objects.create(report=self.report, name='double')
+        view.add_indicator(double)
+        
+        self.assertEqual(view.get_demanded_indicators(),
+                         [double, self.height_indicator, 
+                          self.width_indicator, area])
+        
+        # the perimeter is in the report but not in the view
+        calls = []
+        calculate = SumIndicator.calculate
+        def counted_calculate(strategy, *values):
+            calls.append(strategy.pk)
+            return calculate(strategy, *values)
+        SumIndicator.calculate = counted_calculate
+        try:
+            self.assertEqual(view.get_data_grid(), [{'double': '40'}])
+        finally:
+            SumIndicator.calculate = calculate
+        self.assertEqual(calls, [double.strategy.pk])
+        self.assertFalse(perimeter.strategy.pk in calls)
+        
+        self.assertEqual(view.get_extracted_data(), 
+                         [{'double': 40, 'area': 20, 'height': 10, 
+                           'width': 2}])
+        self.assertEqual(view.get_data_grid(), [{'double': '40'}])
+
+
+    def test_partitioned_grid_state_match_serial_grid_state(self):
+        for height, width in ((3, 2), (None, 1), (5, 1), (7, 4), (1, 2)):
+            record = Record.objects.create(report=self.report)
+            record.eav.height = height
+            record.eav.width = width
+            record.save()
+        
+        self.assertEqual(len(self.view.get_partitions(4)), 3)
+        self.assertEqual(self.view.get_partitions(1)[0][1], None)
+        
+        for aggregated in (False, True):
+            if aggregated:
+                Aggregator.objects.create(view=self.view, 
+                                          indicator=self.width_indicator,
+                                          strategy=ValueAggregator.objects.create())
+            view = ReportView.objects.get(pk=self.view.pk)
+            serial = view._create_grid_state(sql_aggregation=False, workers=1)
+            parallel = view._create_grid_state_in_parallel(workers=1, 
+                                                           partitions=4)
+            self.assertEqual(parallel.get_grid(), serial.get_grid())
+        
+        # the test runs in a transaction the workers would not see
+        self.assertRaises(ValueError, view._create_grid_state_in_parallel,
+                          workers=2)
+        state = view._create_grid_state(sql_aggregation=False, workers=2)
+        self.assertEqual(state.get_grid(), serial.get_grid())
+
+
+    def test_csv_export(self):
+        record = Record.objects.create(report=self.report)
+        record.eav.height = 3
+        record.eav.width = 1
+        record.save()
+        
+        self.assertEqual(''.join(iter_csv(self.view, chunk_size=1)),
+                         'Height,Width\r\n10,2\r\n3,1\r\n')
+        
+        
+    def test_spreadsheet_names(self):
+        clean = SpreadsheetWriter.clean_sheet_name
+        self.assertEqual(clean(u'Cases [2010]: a/b?'), u'Cases  2010   a b')
+        self.assertEqual(clean(u"'*'"), u'Data')
+        self.assertEqual(len(clean(u'x' * 40)), 31)
+        self.assertEqual(clean(u'x' * 40, 2), u'x' * 29 + u' 2')
+
+
+    def test_columns_and_etag(self):
+        date = Indicator.create_with_attribute('Date', Attribute.TYPE_DATE, 
+                                               DateIndicator)
+        self.view.add_indicator(date)
+        self.record.eav.date = datetime(2010, 1, 3)
+        self.record.save()
+        
+        etag = self.view.get_etag()
+        self.assertEqual(self.view.get_etag(), etag)
+        self.assertEqual(self.view.get_columns(), 
+                         {'height': [10], 'width': [2], 
+                          'date': ['01/03/2010']})
+        
+        record = Record.objects.create(report=self.report)
+        record.eav.height = 3
+        record.save()
+        self.assertNotEqual(self.view.get_etag(), etag)
+        self.assertEqual(self.view.get_columns()['height'], [10, 3])
+        
+        # an other process changing the data changes the ETag, and the 
+        # same ETag is given for the same versions by any process
+        etag = self.view.get_etag()
+        key = grid_cache.make_key('version', 'report.%s' % self.report.pk)
+        GridVersion.objects.filter(name=key).update(version=F('version') + 1)
+        grid_cache.forget_versions()
+        self.assertNotEqual(self.view.get_etag(), etag)
+        etag = self.view.get_etag()
+        grid_cache.forget_versions()
+        self.assertEqual(self.view.get_etag(), etag)
+
+
+    def test_create_records_in_bulk(self):
+        data_list = [{'height': height, 'width': 1} for height in (1, 2, 3)]
+        dates = [datetime(2010, 1, 1), None, datetime(2010, 1, 3)]
+        ids, queries = count_queries(Record.create_in_bulk, self.report,
+                                     data_list, dates)
+
+        # the records are inserted with one query
+        table = Record._meta.db_table
+        inserts = [q for q in queries
+                     if 'INSERT' in q['sql'] and table in q['sql']]
+        self.assertEqual(len(inserts), 1)
+
+        records = [Record.objects.get(pk=record_id) for record_id in ids]
+        self.assertEqual([r.get_data()['height'] for r in records], [1, 2, 3])
+        self.assertEqual(records[0].date, datetime(2010, 1, 1).date())
+        self.assertEqual(records[1].date, datetime.today().date())
+        self.assertEqual(records[2].date, datetime(2010, 1, 3).date())
+        self.assertEqual(len(self.view.get_data_grid()), 4)
+
+
+    def test_area_codes_index(self):
+        district_type = AreaType.objects.create(name='District', 
+                                                slug='district')
+        bamako = Area.objects.create(name='Bamako', code='BKO', 
+                                     kind=district_type)
+        
+        self.assertEqual(area_index.get_by_code(' bko'), 
+                         (bamako.pk, 'district', 'Bamako'))
+        self.assertEqual(area_index.get_by_code('kati'), None)
+        self.assertEqual(area_index.get_kind_name('district'), 'District')
+        self.assertEqual(area_index.get_area(bamako.pk), bamako)
+        
+        # the index is loaded again when an area changes
+        bamako.code = 'bamako'
+        bamako.save()
+        self.assertEqual(area_index.get_by_code('BKO'), None)
+        self.assertEqual(area_index.get_by_code('Bamako')[0], bamako.pk)
+        
+        
+    def test_area_codes_suggestions(self):
+        district_type = AreaType.objects.create(name='District', 
+                                                slug='district')
+        bamako = Area.objects.create(name='Bamako', code='bko', 
+                                     kind=district_type)
+        kati = Area.objects.create(name='Kati', code='kti', 
+                                   kind=district_type)
+        
+        self.assertEqual(area_index.get_suggestions('bk0'), ['bko'])
+        self.assertEqual(area_index.get_suggestions('bamak'), ['bko'])
+        self.assertEqual(area_index.get_suggestions('xyzxyz'), [])
+        
+        # the tree is updated when areas change
+        sikasso = Area.objects.create(name='Sikasso', code='sko', 
+                                      kind=district_type)
+        kati.delete()
+        self.assertEqual(area_index.get_suggestions('bk0'), ['bko', 'sko'])
+        
+        
+    def test_bktree(self):
+        tree = BKTree()
+        for i, word in enumerate(('book', 'books', 'cake', 'boo', 'cape')):
+            tree.add(word, i)
+        self.assertEqual([r[1] for r in tree.search('bok', 1)], 
+                         ['boo', 'book'])
+        
+        tree.remove('boo', 3)
+        self.assertEqual([r[1] for r in tree.search('bok', 1)], ['book'])
+        self.assertEqual(tree.tombstones, 1)
+        tree.add('boo', 5)
+        self.assertEqual(tree.search('boo', 0), [(0, 'boo', set([5]))])
+        self.assertEqual(levenshtein('kitten', 'sitting'), 3)
+        
+        
+    def test_synthetic_report(self):
+        synthetic = SyntheticReport(records=4, values=2, depth=3, 
+                                    districts=1, villages=2)
+        report = synthetic.build()
+        
+        self.assertEqual(report.records.count(), 4)
+        self.assertEqual([i.strategy.__class__ for i in synthetic.calculated],
+                         [SumIndicator, RatioIndicator, AverageIndicator])
+        ratio = synthetic.calculated[1].strategy
+        self.assertEqual((ratio.numerator, ratio.denominator), 
+                         (synthetic.calculated[0], synthetic.values[0]))
+        
+        view = ReportView.create_from_report(report, name='all')
+        slug = synthetic.calculated[-1].concept.slug
+        for data in view.get_extracted_data():
+            self.assertNotEqual(data[slug], None)
+        
+        
+    def test_benchmark(self):
+        results = run_benchmark(records=6, values=2, depth=3, districts=2, 
+                                villages=2, aggregations=('none', 'location'))
+        
+        self.assertEqual(results['parameters']['records'], 6)
+        none, location = results['views']
+        self.assertEqual([s['stage'] for s in none['stages']], list(STAGES))
+        self.assertEqual(none['groups'], 6)
+        self.assertTrue(0 < location['groups'] <= 2)
+        self.assertEqual(location['parallel'][0]['workers'], 1)
+        self.assertEqual(location['parallel'][0]['speedup'], 1.0)
+
+
+
+class ParallelReportTests(TransactionTestCase):
+
+    """
+        Testing the grid computed by several processes, which need the 
+        records to be committed.
+    """
+
+
+    def setUp(self):
+        grid_cache.clear()
+        area_index.invalidate()
+        
+        self.report = Report.objects.create(name='Square')
+        self.height = Attribute.objects.create(name='Height', 
+                                               datatype=Attribute.TYPE_INT)
+        self.report.indicators.add(Indicator.create_from_attribute(self.height))
+        self.view = ReportView.create_from_report(report=self.report, 
+                                                  name='main')
+        for height in (3, None, 5, 7, 1):
+            record = Record.objects.create(report=self.report)
+            record.eav.height = height
+            record.save()
+
+
+    def test_grid_state_computed_by_two_workers(self):
+        if connection.settings_dict['NAME'] == ':memory:':
+            self.skipTest('the workers can not share an in-memory database')
+        
+        view = ReportView.objects.get(pk=self.view.pk)
+        serial = view._create_grid_state(sql_aggregation=False, workers=1)
+        parallel = view._create_grid_state_in_parallel(workers=2)
+        self.assertEqual(parallel.get_grid(), serial.get_grid())
+        self.assertEqual(len(parallel.get_grid()), 5)
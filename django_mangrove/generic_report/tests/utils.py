@@ -0,0 +1,93 @@
+from django.test import TestCase
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.db.models.signals import post_save, post_delete
+
+from simple_locations.models import Area, AreaType
+
+from ..engine import area_index
+
+try:
+    from .. import utils
+except ImportError:
+    utils = None
+
+
+class ReportManagerCacheTests(TestCase):
+
+    """
+        Testing the cache of the report managers of the contacts
+    """
+
+
+    def setUp(self):
+        if utils is None:
+            self.skipTest('report_parts is not installed')
+        utils.report_managers.clear()
+        for contact_id in (1, 2):
+            utils.report_managers.set(contact_id, (None, True, False))
+
+
+    def test_status_change_evicts_report_manager(self):
+        status = utils.Status(contact_id=1)
+        post_save.send(sender=utils.Status, instance=status, created=False)
+        self.assertEqual(utils.report_managers.get(1), None)
+        self.assertNotEqual(utils.report_managers.get(2), None)
+
+
+    def test_report_change_evicts_report_manager(self):
+        # a report without status has no contact to evict
+        report = utils.Report(status_id=None)
+        post_save.send(sender=utils.Report, instance=report, created=True)
+        self.assertNotEqual(utils.report_managers.get(1), None)
+        
+        get_status_contact_id = utils.get_status_contact_id
+        utils.get_status_contact_id = {10: 1, 20: 2}.get
+        try:
+            report.status_id = 10
+            post_save.send(sender=utils.Report, instance=report, created=True)
+            self.assertEqual(utils.report_managers.get(1), None)
+            self.assertNotEqual(utils.report_managers.get(2), None)
+            
+            report.status_id = 20
+            post_delete.send(sender=utils.Report, instance=report)
+            self.assertEqual(utils.report_managers.get(2), None)
+        finally:
+            utils.get_status_contact_id = get_status_contact_id
+
+
+
+class CheckLocationTests(TestCase):
+
+    """
+        Testing the lookup of the locations sent by SMS
+    """
+
+
+    def setUp(self):
+        if utils is None:
+            self.skipTest('report_parts is not installed')
+        area_index.invalidate()
+        district_type = AreaType.objects.create(name='District',
+                                                slug='district')
+        self.bamako = Area.objects.create(name='Bamako', code='BKO',
+                                          kind=district_type)
+
+
+    def test_check_location_reads_the_index(self):
+        utils.check_location('bko')
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        reset_queries()
+        try:
+            location = utils.check_location(' BKO', 'District')
+            self.assertEqual(connection.queries, [])
+        finally:
+            settings.DEBUG = old_debug
+        self.assertEqual(location, self.bamako)
+        
+        # the caller can change the area without changing the index
+        location.name = 'Kati'
+        self.assertEqual(area_index.get_area(self.bamako.pk).name, 'Bamako')
+        self.assertRaises(utils.ExitHandle, utils.check_location, 'bko',
+                          'Region')
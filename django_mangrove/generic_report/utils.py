@@ -6,17 +6,19 @@
     Various helpers and shortcuts
 """
 
+import copy
 import string
 import datetime
 from StringIO import StringIO
 
 from xlwt import *
 from django.template.defaultfilters import slugify
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext as _
 
 from rapidsms.contrib.handlers.exceptions import ExitHandle
 
-from simple_locations.models import Area
+from generic_report.engine import area_index, LRUCache
 
 from report_parts.models import Report
 from models import Results
@@ -27,26 +29,40 @@ def check_location(location_code, location_type=None):
         Exit the handle if the location does not exists.
         
         If it does, returns it.
+        
+        Codes, types and areas are read from the areas index, loaded once 
+        and updated when areas change, so this doesn't query the database.
+        The area returned is a copy, not the object shared by the index, so
+        the caller can change it.
     """
     
-    try:
-        location = Area.objects.get(code__iexact=location_code)
-    except Area.DoesNotExist:
+    location = area_index.get_by_code(location_code)
+    if location is None:
     
+        # agents often mistype codes, so we suggest the closest ones
+        suggestions = area_index.get_suggestions(location_code)
+        if suggestions:
+            raise ExitHandle(_(u"The code %(code)s doesn't match any known "\
+                               u"location. Did you mean %(suggestions)s?") % {
+                               'code': location_code,
+                               'suggestions': _(u' or ').join(suggestions)})
+                               
         raise ExitHandle(_(u"The code %(code)s doesn't match any known "\
                            u"location. Ask your administrator the right code "\
                            u"for your location") % {'code': location_code})
-    else:
-        if location_type and location.type.slug != slugify(location_type):
-            current_type = location.type.name
-            expected_type = AreaType.objects.get(slug=slugify(location_type)).name
-            raise ExitHandle(_(u"You can only do this with a %(expected_type)s"\
-                               u" but %(location)s is a %(current_type)s.") % {
-                               'expected_type': _(expected_type),
-                               'location': location,
-                               'current_type': _(current_type)})
+                           
+    area_id, kind_slug, name = location
+    if location_type and kind_slug != slugify(location_type):
+        expected_slug = slugify(location_type)
+        current_type = area_index.get_kind_name(kind_slug) or kind_slug
+        expected_type = area_index.get_kind_name(expected_slug) or location_type
+        raise ExitHandle(_(u"You can only do this with a %(expected_type)s"\
+                           u" but %(location)s is a %(current_type)s.") % {
+                           'expected_type': _(expected_type),
+                           'location': name,
+                           'current_type': _(current_type)})
                                
-    return location                        
+    return copy.copy(area_index.get_area(area_id))
 
 
     
@@ -66,25 +82,83 @@ def fix_date_year(date):
     return date           
     
     
+# state of the last report manager of the contacts who sent a message
+# recently, so checking each message doesn't query it again. Entries
+# expire since a report manager gets outdated with time, and are removed
+# when the report manager or its status change in this process.
+REPORT_MANAGER_CACHE_SIZE = 1000
+REPORT_MANAGER_TIMEOUT = 60
+report_managers = LRUCache(REPORT_MANAGER_CACHE_SIZE, REPORT_MANAGER_TIMEOUT)
+
+
+def get_report_manager_state(contact):
+    """
+        Return (report manager or None, is outdated, has a population
+        report) for the last report manager of the contact.
+    """
+    
+    state = report_managers.get(contact.pk)
+    if state is None:
+        try:
+            report_manager = Report.objects.filter(status__contact=contact.pk)\
+                                           .select_related('status')\
+                                           .latest('updated')
+        except Report.DoesNotExist:
+            state = (None, True, False)
+        else:
+            state = (report_manager, report_manager.is_outdated(),
+                     bool(report_manager.status.vil))
+        report_managers.set(contact.pk, state)
+    return state
+    
+    
+def forget_report_manager(contact_id):
+    """
+        Remove the state of the report manager of this contact from the
+        cache, e.g: when the contact sends a new 'VIL'.
+    """
+    report_managers.delete(contact_id)
+
+
+def get_status_contact_id(status_id):
+    """
+        Return the id of the contact of this report manager status, 
+        without loading the status.
+    """
+    statuses = Status.objects.filter(pk=status_id)
+    for contact_id in statuses.values_list('contact', flat=True):
+        return contact_id
+    return None
+
+
+def forget_report_manager_of_report(sender, instance, **kwargs):
+    # the report may not have a status yet
+    if instance.status_id is not None:
+        forget_report_manager(get_status_contact_id(instance.status_id))
+
+
+def forget_report_manager_of_status(sender, instance, **kwargs):
+    forget_report_manager(instance.contact_id)
+
+Status = Report.status.field.rel.to
+post_save.connect(forget_report_manager_of_report, sender=Report)
+post_delete.connect(forget_report_manager_of_report, sender=Report)
+post_save.connect(forget_report_manager_of_status, sender=Status)
+    
+    
 def check_against_last_report(contact):
     """
         Check if the report manager is not outdated and is initialized 
         properly
     """
     
-    try:
-        report_manager = Report.objects.filter(status__contact=contact.pk)\
-                                       .latest('updated')
-    except Report.DoesNotExist:
-        is_outdated = True
-    else:
-        is_outdated = report_manager.is_outdated()
+    report_manager, is_outdated, has_vil = get_report_manager_state(contact)
     
     if is_outdated:
         raise ExitHandle(_(u"You must specify the campaign and location you "\
                            u"are reporting for. Send 'VIL' first."))
                        
-    if not report_manager.status.vil:
+    if not has_vil:
         raise ExitHandle(_(u"You must specify the population of the location "\
                            u"your are reporting for. Send a complete "\
                            u"population report with 'VIL' first."))
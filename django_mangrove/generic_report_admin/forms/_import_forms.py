@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+    Import of many records at once in a report, from CSV or JSON files.
+"""
+
+import csv
+
+from django import forms
+from django.utils import simplejson
+from django.utils.translation import ugettext as _, ugettext_lazy as __
+from django.core.validators import EMPTY_VALUES
+
+from generic_report.models import Record
+
+from _report_forms import RecordForm
+
+
+class PreloadedChoiceField(forms.Field):
+    """
+        Choice of an object among the objects of a queryset, by id, like a
+        ModelChoiceField. The objects are loaded once, so validating
+        thousands of values doesn't make thousands of queries.
+    """
+
+    default_error_messages = {
+        'invalid_choice': __(u'Select a valid choice. That choice is not one '\
+                             u'of the available choices.'),
+    }
+
+
+    def __init__(self, queryset, *args, **kwargs):
+        forms.Field.__init__(self, *args, **kwargs)
+        self.queryset = queryset
+        self.objects = None
+
+
+    def to_python(self, value):
+        if value in EMPTY_VALUES:
+            return None
+        if self.objects is None:
+            self.objects = dict((obj.pk, obj) for obj in self.queryset)
+        try:
+            return self.objects[int(value)]
+        except (KeyError, ValueError, TypeError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'])
+
+
+
+class RecordImport(object):
+    """
+        Validate rows of data (dicts mapping slugs of the report stand
+        alone indicators to values) with the record form of the report,
+        then create all the records in one transaction.
+
+        If any row is invalid, no record is created, and 'errors' lists
+        (row number, form errors) for each invalid row. Row numbers start
+        at 1, as in a spreadsheet without header.
+
+        Rows can give the date of their record in the 'date_column' 
+        column, unless an indicator of the report has this slug. Records
+        without date are dated today.
+    """
+
+    DATE_COLUMN = 'record_date'
+
+
+    def __init__(self, report, date_column=DATE_COLUMN):
+        self.report = report
+        self.form_class = self.get_form_class(report, date_column)
+        self.date_column = None
+        if date_column in self.form_class.base_fields:
+            self.date_column = date_column
+        self.errors = []
+
+
+    @classmethod
+    def get_form_class(cls, report, date_column=None):
+        """
+            Return the record form of the report, with location fields
+            loading all their choices once, and an optional date field 
+            named 'date_column' for the date of the record.
+        """
+        form_class = RecordForm.get_form(report)
+        fields = {}
+        for name, field in form_class.base_fields.iteritems():
+            if isinstance(field, forms.ModelChoiceField):
+                fields[name] = PreloadedChoiceField(field.queryset,
+                                                    required=field.required)
+        if date_column and date_column not in form_class.base_fields:
+            fields[date_column] = forms.DateField(required=False)
+        return type(form_class.__name__, (form_class,), fields)
+
+
+    @classmethod
+    def read_csv(cls, stream):
+        """
+            Return the rows of a CSV file encoded in UTF-8, which first
+            line gives the slugs of the indicators.
+        """
+        rows = []
+        for row in csv.DictReader(stream):
+            rows.append(dict((key, value.decode('utf-8'))
+                             for key, value in row.iteritems()
+                             if key is not None and value is not None))
+        return rows
+
+
+    @classmethod
+    def read_json(cls, stream):
+        """
+            Return the rows of a JSON file containing a list of objects.
+        """
+        rows = simplejson.load(stream)
+        if not isinstance(rows, list):
+            raise ValueError(_(u'The file must contain a list of objects'))
+        return rows
+
+
+    def validate(self, rows):
+        """
+            Return the cleaned data of each row. Invalid rows are added to
+            'errors'.
+        """
+        cleaned = []
+        for number, row in enumerate(rows):
+            if not isinstance(row, dict):
+                self.errors.append((number + 1,
+                                    {'__all__': [_(u'Not an object')]}))
+                continue
+            form = self.form_class(row, report=self.report)
+            if form.is_valid():
+                cleaned.append(form.cleaned_data)
+            else:
+                self.errors.append((number + 1, form.errors))
+        return cleaned
+
+
+    def save(self, rows):
+        """
+            Validate the rows and create the records if they are all valid.
+            Return the ids of the records, or None if there are errors.
+        """
+        self.errors = []
+        cleaned = self.validate(rows)
+        if self.errors:
+            return None
+        dates = None
+        if self.date_column:
+            dates = [data.pop(self.date_column, None) for data in cleaned]
+        return Record.create_in_bulk(self.report, cleaned, dates)
+
+
+
+class RecordImportForm(forms.Form):
+    """
+        Upload of a CSV or a JSON file of records for a report.
+    """
+
+    FORMATS = (('csv', 'CSV'), ('json', 'JSON'))
+
+    file = forms.FileField(label=__(u'File'))
+    format = forms.ChoiceField(choices=FORMATS, label=__(u'Format'))
+
+
+    def __init__(self, *args, **kwargs):
+        self.report = kwargs.pop('report')
+        forms.Form.__init__(self, *args, **kwargs)
+        self.importer = RecordImport(self.report)
+        self.rows = None
+
+
+    def clean(self):
+        cleaned_data = self.cleaned_data
+        stream = cleaned_data.get('file')
+        format = cleaned_data.get('format')
+        if stream is not None and format:
+            try:
+                if format == 'csv':
+                    self.rows = self.importer.read_csv(stream)
+                else:
+                    self.rows = self.importer.read_json(stream)
+            except (ValueError, csv.Error, UnicodeDecodeError), e:
+                raise forms.ValidationError(_(u'Unable to read the file: '\
+                                              u'%(error)s') % {'error': e})
+        return cleaned_data
+
+
+    def save(self):
+        """
+            Import the rows of the file. Return the ids of the records, or
+            None if some rows are invalid (see 'importer.errors').
+        """
+        return self.importer.save(self.rows)
@@ -1,9 +1,11 @@
-from datetime import datetime
+from datetime import datetime, date
+from StringIO import StringIO
 
 from django.test import TestCase
 from django import forms
 
 from generic_report.models import *
+from generic_report.engine import grid_cache, area_index
 from generic_report_admin.forms import *
 from eav.models import *
 
@@ -17,6 +19,11 @@ class RecordFormsTests(TestCase):
 
 
     def setUp(self):
+        # the caches are process globals, they are not rolled back with
+        # the database between tests
+        grid_cache.clear()
+        area_index.invalidate()
+        
         self.report = Report.objects.create(name='Square')
         self.height = Attribute.objects.create(name='Height', 
                                                datatype=Attribute.TYPE_INT)
@@ -113,3 +120,27 @@ class RecordFormsTests(TestCase):
         self.assertEqual(rf.base_fields['t_bool'].__class__, forms.BooleanField)
         self.assertEqual(rf.base_fields['t_location'].__class__, forms.ModelChoiceField)   
 
+        
+        
+    def test_record_import(self):
+        importer = RecordImport(self.report)
+        rows = importer.read_csv(StringIO('height,width\n3,5\n4,\n'))
+        self.assertEqual(importer.save(rows), None)
+        self.assertEqual(importer.errors[0][0], 2)
+        self.assertEqual(self.report.records.count(), 1)
+        
+        rows = importer.read_json(StringIO('[{"height": 3, "width": 5,'\
+                                           '  "record_date": "2010-01-03"},'\
+                                           ' {"height": 4, "width": 1}]'))
+        ids = importer.save(rows)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(importer.errors, [])
+        first, second = [Record.objects.get(pk=pk) for pk in ids]
+        self.assertEqual((first.eav.height, first.eav.width), (3, 5))
+        self.assertEqual(first.date, date(2010, 1, 3))
+        self.assertEqual((second.eav.height, second.eav.width), (4, 1))
+        self.assertEqual(second.date, date.today())
+        self.assertEqual(self.view.get_data_grid(), 
+                         [{'height': '10', 'width': '2'},
+                          {'height': '3', 'width': '5'},
+                          {'height': '4', 'width': '1'}])
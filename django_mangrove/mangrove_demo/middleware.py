@@ -2,10 +2,355 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4
 
-class ViewNameMiddleware(object):  
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connections
+
+
+# number of requests per view the percentiles are calculated on
+INSTRUMENTATION_WINDOW = getattr(settings, 'INSTRUMENTATION_WINDOW', 1000)
+
+# requests with more queries or taking more seconds than this are logged
+# with their slowest queries. None to never log them.
+INSTRUMENTATION_QUERY_BUDGET = getattr(settings, 'INSTRUMENTATION_QUERY_BUDGET',
+                                       None)
+INSTRUMENTATION_TIME_BUDGET = getattr(settings, 'INSTRUMENTATION_TIME_BUDGET',
+                                      None)
+INSTRUMENTATION_SLOW_QUERIES = getattr(settings,
+                                       'INSTRUMENTATION_SLOW_QUERIES', 5)
+
+# upper bounds of the buckets of the histograms
+SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+logger = logging.getLogger('mangrove_demo.instrumentation')
+
+
+class ViewNameMiddleware(object):
     """
         Add the view name in the request
     """
-    def process_view(self, request, view_func, view_args, view_kwargs):  
-        request.view_name = ".".join((view_func.__module__, view_func.__name__))  
-  
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.view_name = ".".join((view_func.__module__, view_func.__name__))
+
+
+
+class RollingHistogram(object):
+    """
+        Count of the values in buckets since the start of the process,
+        and the last 'size' values to calculate percentiles on.
+    """
+
+
+    def __init__(self, buckets, size=None):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.values = deque(maxlen=size or INSTRUMENTATION_WINDOW)
+        self.count = 0
+        self.total = 0
+
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+
+    def get_buckets(self):
+        """
+            Return (upper bound, number of values lower or equal) for each
+            bucket, the last upper bound being None for no limit.
+        """
+        cumulated = 0
+        buckets = []
+        for bound, count in zip(self.buckets + (None,), self.counts):
+            cumulated += count
+            buckets.append((bound, cumulated))
+        return buckets
+
+
+    def get_percentile(self, percent):
+        """
+            Return the value under which are 'percent' % of the recent
+            values, or None if there is no value.
+        """
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        index = int(round(percent / 100.0 * (len(values) - 1)))
+        return values[index]
+
+
+    def get_mean(self):
+        if not self.values:
+            return None
+        return float(sum(self.values)) / len(self.values)
+
+
+
+class ViewStats(object):
+    """
+        Histograms of the latency, the number of SQL queries and the SQL
+        time of the requests, per view name. Shared by all the threads of
+        the process.
+    """
+
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.views = {}
+
+
+    def add(self, view_name, seconds, queries, sql_seconds):
+        with self._lock:
+            try:
+                histograms = self.views[view_name]
+            except KeyError:
+                histograms = self.views[view_name] = {
+                    'latency': RollingHistogram(SECONDS_BUCKETS),
+                    'queries': RollingHistogram(QUERIES_BUCKETS),
+                    'sql_time': RollingHistogram(SECONDS_BUCKETS),
+                }
+            histograms['latency'].add(seconds)
+            histograms['queries'].add(queries)
+            histograms['sql_time'].add(sql_seconds)
+
+
+    def get_summary(self):
+        """
+            Return a dict per view, ordered by view name, with the number
+            of requests and the mean and percentiles of the recent ones.
+        """
+        summary = []
+        with self._lock:
+            for view_name in sorted(self.views):
+                histograms = self.views[view_name]
+                row = {'view_name': view_name,
+                       'count': histograms['latency'].count}
+                for name, histogram in histograms.iteritems():
+                    row[name] = {'mean': histogram.get_mean(),
+                                 'p50': histogram.get_percentile(50),
+                                 'p95': histogram.get_percentile(95),
+                                 'max': histogram.get_percentile(100)}
+                summary.append(row)
+        return summary
+
+
+    def get_metrics(self):
+        """
+            Return the histograms as text, in the Prometheus exposition
+            format.
+        """
+        lines = []
+        metrics = (('latency', 'mangrove_request_seconds',
+                    'Time to answer the requests'),
+                   ('queries', 'mangrove_request_queries',
+                    'SQL queries made by the requests'),
+                   ('sql_time', 'mangrove_request_sql_seconds',
+                    'Time spent in SQL queries by the requests'))
+        with self._lock:
+            for name, metric, description in metrics:
+                lines.append('# HELP %s %s' % (metric, description))
+                lines.append('# TYPE %s histogram' % metric)
+                for view_name in sorted(self.views):
+                    histogram = self.views[view_name][name]
+                    label = 'view="%s"' % view_name.replace('"', '\\"')
+                    for bound, count in histogram.get_buckets():
+                        le = bound is None and '+Inf' or bound
+                        lines.append('%s_bucket{%s,le="%s"} %s' % (metric,
+                                                                   label, le,
+                                                                   count))
+                    lines.append('%s_count{%s} %s' % (metric, label,
+                                                      histogram.count))
+                    lines.append('%s_sum{%s} %s' % (metric, label,
+                                                    histogram.total))
+        return '\n'.join(lines) + '\n'
+
+
+    def clear(self):
+        with self._lock:
+            self.views = {}
+
+
+view_stats = ViewStats()
+
+
+
+class InstrumentedContent(object):
+    """
+        Content of a streamed response, generated after the middlewares
+        returned. 'on_end' is called once, when all the content has been
+        read or when the response is closed.
+        
+        'scope' is called with the function generating each chunk, and must
+        call it: it's used to record the queries made for this chunk only.
+    """
+
+
+    def __init__(self, content, on_end, scope=None):
+        self.content = content
+        self.on_end = on_end
+        self.scope = scope or (lambda func: func())
+
+
+    def __iter__(self):
+        chunks = iter(self.content)
+        while True:
+            try:
+                chunk = self.scope(chunks.next)
+            except StopIteration:
+                break
+            yield chunk
+        self.end()
+
+
+    def end(self):
+        if self.on_end is not None:
+            on_end, self.on_end = self.on_end, None
+            on_end()
+
+
+    def close(self):
+        try:
+            if hasattr(self.content, 'close'):
+                self.content.close()
+        finally:
+            self.end()
+
+
+
+class InstrumentationMiddleware(ViewNameMiddleware):
+    """
+        Add the view name in the request, and record the latency, the
+        number of SQL queries and the SQL time of each request in
+        'view_stats', by view name.
+
+        Queries are recorded even if DEBUG is False: the connections of
+        the thread use debug cursors while the view runs and while each 
+        chunk of a streamed response is generated, and their queries are
+        removed at the end of the request. The cursors are restored before
+        the response is returned, so a streamed response that is never 
+        read doesn't leave them.
+
+        Requests over INSTRUMENTATION_QUERY_BUDGET queries or
+        INSTRUMENTATION_TIME_BUDGET seconds are logged with their slowest
+        queries.
+
+        Streamed responses (e.g: the CSV export) make their queries while
+        their content is sent: they are recorded when it has been sent.
+    """
+
+
+    def process_request(self, request):
+        offsets = {}
+        for connection in connections.all():
+            if not settings.DEBUG:
+                # queries of a streamed response which content was never
+                # read are still there
+                del connection.queries[:]
+            offsets[connection.alias] = len(connection.queries)
+        request._instrumentation = (time.time(), offsets)
+        self.start_recording()
+
+
+    @classmethod
+    def get_debug_cursor(cls, connection):
+        def cursor():
+            return connection.make_debug_cursor(connection._cursor())
+        return cursor
+
+
+    @classmethod
+    def start_recording(cls):
+        """
+            Make the connections of this thread record their queries even
+            if DEBUG is False, until stop_recording() is called.
+        """
+        if settings.DEBUG:
+            return
+        for connection in connections.all():
+            # connections are thread locals: this cursor() is only used by
+            # this thread
+            connection.cursor = cls.get_debug_cursor(connection)
+
+
+    @classmethod
+    def stop_recording(cls):
+        for connection in connections.all():
+            connection.__dict__.pop('cursor', None)
+
+
+    @classmethod
+    def record_queries(cls, func):
+        """
+            Call the function, recording its queries, and return its result.
+        """
+        cls.start_recording()
+        try:
+            return func()
+        finally:
+            cls.stop_recording()
+
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_instrumentation'):
+            # an other middleware answered before this one was called
+            return response
+        self.stop_recording()
+        if getattr(response, '_is_string', True):
+            self.record_request(request)
+        else:
+            response._container = InstrumentedContent(response._container,
+                                         lambda: self.record_request(request),
+                                         self.record_queries)
+        return response
+
+
+    def record_request(self, request):
+        """
+            Add the request to the stats, and stop recording its queries.
+        """
+        start, offsets = request._instrumentation
+        seconds = time.time() - start
+
+        queries = []
+        for connection in connections.all():
+            offset = offsets.get(connection.alias, 0)
+            queries.extend(connection.queries[offset:])
+            if not settings.DEBUG:
+                del connection.queries[offset:]
+        sql_seconds = sum(float(query['time']) for query in queries)
+
+        view_name = getattr(request, 'view_name', None) or 'unresolved'
+        view_stats.add(view_name, seconds, len(queries), sql_seconds)
+
+        if self.is_over_budget(seconds, len(queries)):
+            self.log_request(request, view_name, seconds, queries,
+                             sql_seconds)
+
+
+    def is_over_budget(self, seconds, query_count):
+        query_budget = INSTRUMENTATION_QUERY_BUDGET
+        time_budget = INSTRUMENTATION_TIME_BUDGET
+        return ((query_budget is not None and query_count > query_budget) or
+                (time_budget is not None and seconds > time_budget))
+
+
+    def log_request(self, request, view_name, seconds, queries, sql_seconds):
+        slowest = sorted(queries, key=lambda query: float(query['time']),
+                         reverse=True)[:INSTRUMENTATION_SLOW_QUERIES]
+        lines = ['%s %s (%s): %.3fs, %s queries in %.3fs' % (request.method,
+                                                             request.path,
+                                                             view_name,
+                                                             seconds,
+                                                             len(queries),
+                                                             sql_seconds)]
+        for query in slowest:
+            lines.append('  %ss: %s' % (query['time'], query['sql']))
+        logger.warning('\n'.join(lines))
@@ -6,6 +6,12 @@ Replace these with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from django.contrib.auth.models import User
+
+from mangrove_demo.middleware import (RollingHistogram, 
+                                      InstrumentationMiddleware, view_stats)
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +27,77 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+class InstrumentationTests(TestCase):
+
+
+    def test_rolling_histogram(self):
+        histogram = RollingHistogram((1, 5, 10), size=3)
+        for value in (1, 2, 7, 20):
+            histogram.add(value)
+        
+        self.assertEqual(histogram.get_buckets(), 
+                         [(1, 1), (5, 2), (10, 3), (None, 4)])
+        self.assertEqual((histogram.count, histogram.total), (4, 30))
+        # percentiles are calculated on the last 3 values only
+        self.assertEqual(histogram.get_percentile(0), 2)
+        self.assertEqual(histogram.get_percentile(100), 20)
+        self.assertEqual(histogram.get_mean(), 29 / 3.0)
+
+
+    def test_middleware_counts_queries_by_view(self):
+        view_stats.clear()
+        middleware = InstrumentationMiddleware()
+        
+        request = HttpRequest()
+        middleware.process_request(request)
+        middleware.process_view(request, User.objects.count, (), {})
+        User.objects.count()
+        User.objects.count()
+        middleware.process_response(request, HttpResponse())
+        
+        row = view_stats.get_summary()[0]
+        self.assertEqual(row['count'], 1)
+        self.assertEqual(row['queries']['max'], 2)
+        self.assertTrue('mangrove_request_queries_count{view="%s"} 1' % 
+                        row['view_name'] in view_stats.get_metrics())
+
+
+    def test_middleware_counts_queries_of_streamed_responses(self):
+        view_stats.clear()
+        middleware = InstrumentationMiddleware()
+        
+        def iter_content():
+            yield '%s\n' % User.objects.count()
+            yield '%s\n' % User.objects.count()
+        
+        request = HttpRequest()
+        middleware.process_request(request)
+        middleware.process_view(request, User.objects.count, (), {})
+        response = middleware.process_response(request, 
+                                               HttpResponse(iter_content()))
+        self.assertEqual(view_stats.get_summary(), [])
+        
+        self.assertEqual(response.content, '0\n0\n')
+        row = view_stats.get_summary()[0]
+        self.assertEqual(row['queries']['max'], 2)
+
+
+    def test_middleware_restores_the_cursors(self):
+        middleware = InstrumentationMiddleware()
+        
+        def iter_content():
+            yield '%s\n' % User.objects.count()
+        
+        request = HttpRequest()
+        middleware.process_request(request)
+        middleware.process_view(request, User.objects.count, (), {})
+        response = middleware.process_response(request, 
+                                               HttpResponse(iter_content()))
+        
+        # the content is never read, the queries made after the response 
+        # are not recorded
+        self.assertFalse('cursor' in connection.__dict__)
+        queries = len(connection.queries)
+        User.objects.count()
+        self.assertEqual(len(connection.queries), queries)
@@ -48,6 +48,10 @@ urlpatterns = patterns("",
                        'template_object_name': 'report'}, 
         name="reports-list"),
      
+    url(r'report/(?P<id>\d+)/import/$',  
+        "mangrove_demo.views.import_records", 
+        name='import-records'), 
+        
     url(r'report/(?P<id>\d+)/add/view/$',  
         "mangrove_demo.views.add_view_to_report", 
         name='add-view-to-report'), 
@@ -78,11 +82,28 @@ urlpatterns = patterns("",
         "mangrove_demo.views.edit_view_aggregators",
         name='edit-view-aggregators'),       
         
+    url(r'view/(?P<id>\d+)/export/(?P<format>csv|xls)/$',  
+        "mangrove_demo.views.export_view",
+        name='export-view'), 
+        
+    url(r'view/(?P<id>\d+)/data.json$',  
+        "mangrove_demo.views.view_data_json",
+        name='view-data-json'), 
+        
     url(r'view/(?P<id>\d+)/edit/data-display/$',  
         "mangrove_demo.views.edit_view_data_display",
         name='edit-view-data-display'), 
    
         
+    url(r'stats/$',  
+        "mangrove_demo.views.stats",
+        name='view-stats'), 
+        
+    url(r'metrics/$',  
+        "mangrove_demo.views.metrics",
+        name='metrics'), 
+   
+        
     url(r'$',  redirect_to, { 'url': "/reports/manage/" }, name='dashboard')
 )
 
@@ -3,25 +3,36 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
+import tempfile
 from datetime import datetime
 
 from django.http import HttpResponse
 from django.shortcuts import render_to_response, redirect, HttpResponseRedirect
 from django.template import RequestContext
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.contrib.admin.views.decorators import staff_member_required
 from django.conf import settings
 from django.utils.translation import check_for_language
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404
+from django.core.servers.basehttp import FileWrapper
+from django.template.defaultfilters import slugify
+from django.views.decorators.http import etag
+from django.utils import simplejson
+from django.core.serializers.json import DjangoJSONEncoder
 
 from generic_report.models import Report, ReportView, SelectedIndicator, Indicator
+from generic_report.export import iter_csv, write_spreadsheet
+
+from mangrove_demo.middleware import view_stats
 
 from generic_report_admin.forms import (RecordForm, ViewForm, 
                                         ViewAggregationForm, 
                                         ViewIndicatorsForm, 
                                         IndicatorCreationForm,
-                                        IndicatorChooserForm)
+                                        IndicatorChooserForm,
+                                        RecordImportForm)
 
 
 @login_required
@@ -106,6 +117,63 @@ def display_report(request, id):
 
 
 
+@login_required
+def export_view(request, id, format='csv'):
+    """
+        Download the data of a view as a CSV or an Excel file. 
+        
+        The CSV file is sent while it's written, one row at a time. The 
+        Excel file must be complete before being sent, so it's written in
+        a temporary file rather than in memory.
+    """
+    view = get_object_or_404(ReportView, id=id)
+    filename = slugify(u'%s %s' % (view.report.name, view.name)) or 'export'
+    
+    if format == 'csv':
+        response = HttpResponse(iter_csv(view), mimetype='text/csv')
+    else:
+        stream = tempfile.TemporaryFile()
+        write_spreadsheet(view, stream)
+        size = stream.tell()
+        stream.seek(0)
+        response = HttpResponse(FileWrapper(stream), 
+                                mimetype='application/vnd.ms-excel')
+        response['Content-Length'] = size
+        
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+                                                        filename, format)
+    return response
+    
+    
+def view_data_etag(request, id):
+    try:
+        return ReportView.objects.get(pk=id).get_etag()
+    except ReportView.DoesNotExist:
+        return None
+        
+        
+@login_required
+@etag(view_data_etag)
+def view_data_json(request, id):
+    """
+        Return the data of a view as JSON, for graphs: the labels of the
+        indicators and one list of values per indicator.
+        
+        {"labels": ["Woman", "Man"], "slugs": ["woman", "man"],
+         "columns": [[15, 10], [25, 20]]}
+         
+        The ETag changes only when the data can change, so clients sending
+        it back in If-None-Match get a 304 without the grid being computed.
+    """
+    view = get_object_or_404(ReportView, id=id)
+    columns = view.get_columns()
+    data = {'labels': view.get_labels(), 
+            'slugs': columns.keys(), 
+            'columns': columns.values()}
+    return HttpResponse(simplejson.dumps(data, cls=DjangoJSONEncoder), 
+                        mimetype='application/json')
+    
+    
 @login_required
 def edit_view_indicators(request, id):
     # you can just brutally raise a 404 error if they try to edit a view
@@ -295,6 +363,26 @@ def add_view_to_report(request, id):
                       context_instance=RequestContext(request))
     
     
+@login_required
+def import_records(request, id):
+    """
+        Let you upload a file with many records and add them to the report
+        at once, then redirect to the report results.
+    """
+
+    report = get_object_or_404(Report, id=id)
+    
+    if request.method == 'POST':
+        form = RecordImportForm(request.POST, request.FILES, report=report)
+        if form.is_valid() and form.save() is not None:
+            return redirect(reverse('report-results', args=(report.pk,)))
+    else:
+        form = RecordImportForm(report=report)
+    
+    return render_to_response('import_records.html',  locals(),
+                      context_instance=RequestContext(request))
+    
+    
 # todo: protect default view
 @login_required
 def delete_view(request, id):
@@ -309,3 +397,25 @@ def delete_view(request, id):
         return redirect(url)
     return render_to_response('delete_view.html',  locals(),
                           context_instance=RequestContext(request))
+    
+    
+@staff_member_required
+def stats(request):
+    """
+        Latency and SQL queries of the requests to each view, since the 
+        start of this process.
+    """
+    
+    summary = view_stats.get_summary()
+    return render_to_response('stats.html',  locals(),
+                          context_instance=RequestContext(request))
+    
+    
+@user_passes_test(lambda u: u.is_staff)
+def metrics(request):
+    """
+        Same as stats() as plain text, for monitoring tools.
+    """
+    
+    return HttpResponse(view_stats.get_metrics(), 
+                        content_type='text/plain; version=0.0.4')
@@ -150,15 +150,22 @@ TEMPLATE_CONTEXT_PROCESSORS = [
 ]
 
 MIDDLEWARE_CLASSES = (
+    # first, so the time of the other middlewares is measured too
+    'mangrove_demo.middleware.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'mangrove_demo.middleware.ViewNameMiddleware',
 )
 
+# requests making more queries or taking more seconds than this are logged
+# with their slowest queries (see mangrove_demo.middleware). None to never
+# log them.
+INSTRUMENTATION_QUERY_BUDGET = None
+INSTRUMENTATION_TIME_BUDGET = None
+
 TEMPLATE_DIRS = (
     os.path.join(PROJECT_DIR, 'templates'),
 )